@@ -90,6 +90,13 @@ df_template = pd.DataFrame(template_data)
 import csv
 import re
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from types import MappingProxyType
+from typing import Optional
+
+from modules.forms_rows import StudySpecificFormsRow, StudySpecificFormsRows
+from modules.output_mode import node_kind
 
 
 def get_text(node):
@@ -185,35 +192,104 @@ def _visit_list_like(text: str) -> bool:
     return False
 
 
-def is_valid_form_label(text, config: dict | None = None):
+FORM_LABEL_INVALID_PATTERNS = [
+    r'^\s*V\d+[A-Z]*\s*$',  # Just visit numbers
+    r'Design\s*Notes?\s*:?$',
+    r'Oracle\s*item\s*design\s*notes?\s*:?$',
+    r'General\s*item\s*design\s*notes?\s*:?$',
+    r'^\s*Non-Visit\s*Related\s*$',
+    r'^Data from.*',
+    r'^Hidden item.*',
+    r'^The item.*',
+    r'^\d+\s+',
+    r'.*\|A\d+\|.*',
+    r'^\s*(Non-)?[Rr]epeating(\s+form)?\s*$',
+]
+DEFAULT_INSTRUCTION_KEYWORDS = [
+    'please','note','ensure','click','enter','complete','select','indicate','check','provide','collect','integration','Study ID'
+]
+DEFAULT_METADATA_KEYWORDS = [
+    r'Novo\s+Nordisk',
+    r'Trial\s+ID\s*:',
+    r'Sample\s+eCRF',
+    r'Mock-up',
+    r'requirement',
+    r'Version\s*:\s*\d+\.\d+',
+    r'Page\s*:\s*\d+\s+of\s+\d+',
+]
+DEFAULT_COMPANY_PATTERNS = [
+    r'Novo\s+Nordisk\s+A/S',
+    r'Clinical\s+Trial',
+    r'Protocol',
+]
+DEFAULT_DATE_TIME_PATTERN = r'Req.*?\(\d{4}[-–—/]{1,2}\d{4}\)'
+
+
+class FormRules:
+    """
+    The rules of config_study_specific_forms.json as an immutable object with
+    precompiled patterns. It is passed explicitly through the builders rather
+    than kept in module state, so several generations can run concurrently in
+    one process. Missing keys fall back to the built-in defaults.
+    """
+    __slots__ = ("config", "form_label_invalid", "instruction_keywords", "metadata_keywords",
+                 "company_patterns", "date_time_pattern")
+
+    def __init__(self, config: dict | None = None):
+        config = dict(config or {})
+        invalid_patterns = list(FORM_LABEL_INVALID_PATTERNS)
+        if isinstance(config.get('form_label_invalid_patterns'), list):
+            invalid_patterns.extend(config['form_label_invalid_patterns'])
+        kw_list = config.get('instruction_keywords', DEFAULT_INSTRUCTION_KEYWORDS)
+        values = {
+            "config": MappingProxyType(config),
+            "form_label_invalid": tuple(re.compile(p, re.IGNORECASE) for p in invalid_patterns),
+            "instruction_keywords": re.compile(r'\b(' + '|'.join(map(re.escape, kw_list)) + r')\b', re.IGNORECASE),
+            "metadata_keywords": tuple(
+                re.compile(p, re.IGNORECASE) for p in config.get('metadata_keywords', DEFAULT_METADATA_KEYWORDS)),
+            "company_patterns": tuple(
+                re.compile(p, re.IGNORECASE) for p in config.get('company_patterns', DEFAULT_COMPANY_PATTERNS)),
+            "date_time_pattern": re.compile(config.get('date_time_pattern', DEFAULT_DATE_TIME_PATTERN), re.IGNORECASE),
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FormRules is immutable")
+
+    def __reduce__(self):
+        # Recompile in the receiving process (process pool workers)
+        return (FormRules, (dict(self.config),))
+
+    @classmethod
+    def from_file(cls, config_path: str) -> "FormRules":
+        return cls(load_config(config_path))
+
+
+DEFAULT_FORM_RULES = FormRules()
+
+
+def form_rules(config=None) -> FormRules:
+    """FormRules from a FormRules, a config dict or None (built-in defaults)."""
+    if isinstance(config, FormRules):
+        return config
+    return FormRules(config) if config else DEFAULT_FORM_RULES
+
+
+def is_valid_form_label(text, config: "FormRules | dict | None" = None):
     """Check if text is a valid form label (exclude visit strings/metadata)."""
     if not text or len(text) < 3 or len(text) > 100:
         return False
 
-    invalid_patterns = [
-        r'^\s*V\d+[A-Z]*\s*$',  # Just visit numbers
-        r'Design\s*Notes?\s*:?$',
-        r'Oracle\s*item\s*design\s*notes?\s*:?$',
-        r'General\s*item\s*design\s*notes?\s*:?$',
-        r'^\s*Non-Visit\s*Related\s*$',
-        r'^Data from.*',
-        r'^Hidden item.*',
-        r'^The item.*',
-        r'^\d+\s+',
-        r'.*\|A\d+\|.*',
-        r'^\s*(Non-)?[Rr]epeating(\s+form)?\s*$',
-    ]
-    if config and isinstance(config.get('form_label_invalid_patterns'), list):
-        invalid_patterns.extend(config['form_label_invalid_patterns'])
-    for pattern in invalid_patterns:
-        if re.match(pattern, text, re.IGNORECASE):
+    for pattern in form_rules(config).form_label_invalid:
+        if pattern.match(text):
             return False
     if _visit_list_like(text):
         return False
     return True
 
 
-def clean_label_text(text: str, config: dict | None = None) -> str:
+def clean_label_text(text: str, config: "FormRules | dict | None" = None) -> str:
     """Normalize label text by removing visit tokens, bracketed codes, and noise."""
     if not isinstance(text, str):
         return "Unknown Section"
@@ -230,52 +306,185 @@ def clean_label_text(text: str, config: dict | None = None) -> str:
     return s
 
 
-def extract_forms_cleaned(data):
-    """Extract forms with improved duplicate handling and validation."""
-    results = []
-    seen_forms = set()
-
-    def process_h1_section(h1_node):
-        h1_text = get_text(h1_node)
-        if not is_valid_form_label(h1_text, CONFIG):
-            h1_text = "Unknown Section"
+def iter_child_edges(node):
+    """Like iter_children, paired with whether each child sits in the node's "children" list."""
+    if not isinstance(node, dict):
+        return []
+    edges = []
+    for key in ("children", "childNodes", "nodes", "items", "elements", "sections", "rows", "cols", "content"):
+        v = node.get(key)
+        if isinstance(v, list):
+            edges.extend((item, key == "children") for item in v if isinstance(item, dict))
+    for key in ("child", "node", "element", "section"):
+        v = node.get(key)
+        if isinstance(v, dict):
+            edges.append((v, False))
+    return edges
 
-        def find_forms_in_node(node, current_label=None):
-            if not isinstance(node, dict):
-                return
-            node_name, node_text = get_name(node), get_text(node)
 
-            if node_name.startswith("H2") and is_valid_form_label(node_text, CONFIG) and not is_valid_form_name(node_text):
-                current_label = clean_label_text(node_text, CONFIG)
+class EcrfScan:
+    """
+    Single visitor pass over the eCRF tree that finds the forms under every H1
+    section together with each form's tables, their TR rows and the text used
+    for the metadata-table check.
+
+    The result matches the former separate walks (extract_forms_cleaned, then
+    find_nodes_by_name_pattern for Tables and TRs per form): a nested H1 still
+    opens its own section, and a nested table's rows still belong to every
+    enclosing table (rows are collected once and analysed once). Tables and
+    rows are only collected through "children" lists, as before.
+    On the way it counts the nodes, Tables and TRs reached through "children"
+    lists (counts, the same figures as output_mode.measure_document).
+    rules: FormRules of the run (built-in defaults when omitted)
+    """
 
-            if is_valid_form_name(node_text):
-                form_name, form_label = node_text, clean_label_text(current_label if current_label else h1_text, CONFIG)
-                form_key = (form_label, form_name)
-                if form_key not in seen_forms:
-                    results.append({
-                        "Form Label": form_label,
-                        "Form Name": form_name,
-                        "H1_Text": h1_text,
+    def __init__(self, rules=None, collect_tables=True):
+        self.rules = form_rules(rules)
+        self.collect_tables = collect_tables
+        self.sections = []      # per H1 in document order: {"h1_text", "node", "forms"}
+        self.form_tables = {}   # id(form node) -> tables in document order
+        self._rows = {}         # id(TR node) -> (item group or None, item candidates)
+        self.features = {}      # id(node) -> node_features bitmask, for nodes inside tables
+        self.counts = {"nodes": 0, "tables": 0, "table_rows": 0}
+
+    def scan(self, data):
+        """Visit the whole document."""
+        self._visit(data, [], [], [])
+        return self
+
+    def scan_form(self, form_node):
+        """Collect the tables of a single form node (no section handling)."""
+        self.form_tables[id(form_node)] = tables = []
+        self._visit(form_node, [], [tables], [])
+        return self
+
+    def _visit(self, node, sections, form_tables, open_tables, counted=True):
+        """
+        sections: (section, current label) of every H1 above node
+        form_tables: table lists of the forms whose table walk reaches node
+        open_tables: tables whose row walk reaches node
+        counted: node is reached through "children" lists only
+        Returns the node's text for the metadata check and its feature bitmask
+        (both only inside tables).
+        """
+        node_name, node_text = get_name(node), get_text(node)
+
+        if counted:
+            self.counts["nodes"] += 1
+            kind = node_kind(node)
+            if kind == "Table":
+                self.counts["tables"] += 1
+            elif kind == "TR":
+                self.counts["table_rows"] += 1
+
+        if node_name.startswith("H1"):
+            section = {
+                "h1_text": node_text if is_valid_form_label(node_text, self.rules) else "Unknown Section",
+                "node": node,
+                "forms": [],
+            }
+            self.sections.append(section)
+            sections = sections + [(section, None)]
+
+        if sections:
+            is_form = is_valid_form_name(node_text)
+            if not is_form and node_name.startswith("H2") and is_valid_form_label(node_text, self.rules):
+                label = clean_label_text(node_text, self.rules)
+                sections = [(section, label) for section, _ in sections]
+            if is_form:
+                for section, label in sections:
+                    section["forms"].append({
+                        "Form Label": clean_label_text(label if label else section["h1_text"], self.rules),
+                        "Form Name": node_text,
+                        "H1_Text": section["h1_text"],
                         "Form_Node": node,
-                        "Parent_H1_Node": h1_node
+                        "Parent_H1_Node": section["node"],
                     })
+                if self.collect_tables:
+                    form_tables = form_tables + [self.form_tables.setdefault(id(node), [])]
+
+        raw_name = node.get("name", "")
+        table = None
+        if form_tables and raw_name.startswith("Table"):
+            table = {"node": node, "rows": [], "metadata": False}
+            for tables in form_tables:
+                tables.append(table)
+            open_tables = open_tables + [table]
+        if open_tables and raw_name.startswith("TR"):
+            for enclosing in open_tables:
+                enclosing["rows"].append(node)
+
+        # Same text collection as is_metadata_table's walk
+        parts = []
+        if open_tables and node.get("text"):
+            parts.append(node.get("text").strip())
+        below = 0
+        for child, in_children in iter_child_edges(node):
+            if in_children:
+                child_text, child_features = self._visit(child, sections, form_tables, open_tables, counted)
+                if child_text:
+                    parts.append(child_text)
+                below |= child_features
+            else:
+                self._visit(child, sections, [], [], False)
+        node_table_text = " ".join(parts)
+
+        if not open_tables:
+            return node_table_text, 0
+        if table is not None:
+            table["metadata"] = is_metadata_text(node_table_text, self.rules)
+        features = self.features[id(node)] = below | own_features(node, below)
+        return node_table_text, features
+
+    def forms(self):
+        """Forms in extract_forms_cleaned order: section by section, first (label, name) wins."""
+        results = []
+        seen_forms = set()
+        for section in self.sections:
+            for form in section["forms"]:
+                form_key = (form["Form Label"], form["Form Name"])
+                if form_key not in seen_forms:
+                    results.append(form)
                     seen_forms.add(form_key)
+        return results
+
+    def items(self, form_node):
+        """Items of a scanned form, as extract_items_from_form returns them."""
+        items_data = []
+        # Item Group persists across table breaks
+        current_item_group = ""
+        for table in self.form_tables.get(id(form_node), []):
+            if table["metadata"]:
+                print(f"⚠️  Skipping metadata table: {table['node'].get('name', '')}")
+                continue
+            for tr in table["rows"]:
+                key = id(tr)
+                if key not in self._rows:
+                    self._rows[key] = analyse_item_row(tr, self.features, self.rules)
+                item_group, candidates = self._rows[key]
+                if item_group is not None:
+                    current_item_group = item_group
+                    continue
+                for item_name, option_cell in candidates:
+                    items_data.append({
+                        "Item Group": current_item_group,
+                        "Item Name": item_name,
+                        "Option_TD_Node": option_cell
+                    })
+        return unique_items(items_data)
 
-            for child in iter_children(node):
-                find_forms_in_node(child, current_label)
 
-        find_forms_in_node(h1_node, None)
+def scan_ecrf(data, collect_tables=True, rules=None):
+    """
+    Run the single-pass EcrfScan over a loaded eCRF document (forms only
+    without collect_tables, e.g. when the forms are scanned in workers).
+    """
+    return EcrfScan(rules, collect_tables).scan(data)
 
-    def find_h1_sections(node):
-        if not isinstance(node, dict):
-            return
-        if get_name(node).startswith("H1"):
-            process_h1_section(node)
-        for child in iter_children(node):
-            find_h1_sections(child)
 
-    find_h1_sections(data)
-    return results
+def extract_forms_cleaned(data, rules=None):
+    """Extract forms with improved duplicate handling and validation."""
+    return scan_ecrf(data, rules=rules).forms()
 
 
 def find_nodes_by_name_pattern(node, pattern):
@@ -296,7 +505,7 @@ def find_nodes_by_name_pattern(node, pattern):
 
 # ============== NEW HELPER FUNCTIONS - ADD THESE ==================
 
-def is_metadata_table(table_node):
+def is_metadata_table(table_node, rules=None):
     """
     🔥 FIXED: Detect and skip metadata/header tables containing document information.
     Uses internal recursive text collection to avoid modifying get_text() used elsewhere.
@@ -330,23 +539,16 @@ def is_metadata_table(table_node):
         return " ".join(text_parts)
 
     # Get ALL text from the table using internal function
-    table_text = get_all_table_text(table_node)
-
-    # Define metadata keywords (configurable)
-    metadata_keywords = CONFIG.get('metadata_keywords', [
-        r'Novo\s+Nordisk',
-        r'Trial\s+ID\s*:',
-        r'Sample\s+eCRF',
-        r'Mock-up',
-        r'requirement',
-        r'Version\s*:\s*\d+\.\d+',
-        r'Page\s*:\s*\d+\s+of\s+\d+',
-    ])
-
-    # Count how many metadata patterns are found
+    return is_metadata_text(get_all_table_text(table_node), rules)
+
+
+def is_metadata_text(table_text, rules=None):
+    """Metadata-table rule of is_metadata_table, applied to a table's collected text."""
+    rules = form_rules(rules)
+    # Count how many metadata patterns (configurable) are found
     matches = 0
-    for pattern in metadata_keywords:
-        if re.search(pattern, table_text, re.IGNORECASE):
+    for pattern in rules.metadata_keywords:
+        if pattern.search(table_text):
             matches += 1
 
     # If 3 or more metadata patterns found, it's likely a metadata table
@@ -354,14 +556,8 @@ def is_metadata_table(table_node):
         return True
 
     # Additional check: Look for specific company/organization names
-    company_patterns = CONFIG.get('company_patterns', [
-        r'Novo\s+Nordisk\s+A/S',
-        r'Clinical\s+Trial',
-        r'Protocol',
-    ])
-
-    for pattern in company_patterns:
-        if re.search(pattern, table_text, re.IGNORECASE):
+    for pattern in rules.company_patterns:
+        if pattern.search(table_text):
             # If company name found + at least one other metadata field, skip it
             if matches >= 2:
                 return True
@@ -369,61 +565,9 @@ def is_metadata_table(table_node):
     return False
 
 
-def check_p_extracharspan_extracharspan_pattern(node):
-    """
-    Check if node has pattern: P -> ExtraCharSpan -> ExtraCharSpan[]
-    Returns True if a P node contains ExtraCharSpan, which itself contains ExtraCharSpan(s)
-    """
-    if not isinstance(node, dict):
-        return False
-
-    # Check if current node is P
-    if node.get("name", "") == "P":
-        children = node.get("children", [])
-        for child in children:
-            # Check if child is ExtraCharSpan
-            if child.get("name", "") == "ExtraCharSpan":
-                # Check if this ExtraCharSpan has ExtraCharSpan children
-                grandchildren = child.get("children", [])
-                for grandchild in grandchildren:
-                    if grandchild.get("name", "") == "ExtraCharSpan":
-                        return True
-
-    # Recursively check all children
-    for child in node.get("children", []):
-        if check_p_extracharspan_extracharspan_pattern(child):
-            return True
-
-    return False
-
-
-def check_p_sub_pattern(node):
-    """
-    Check if node has pattern: P -> Sub
-    Returns True if a P node directly contains a Sub child
-    """
-    if not isinstance(node, dict):
-        return False
-
-    # Check if current node is P
-    if node.get("name", "") == "P":
-        children = node.get("children", [])
-        for child in children:
-            # Check if child is Sub
-            if child.get("name", "") == "Sub":
-                return True
-
-    # Recursively check all children
-    for child in node.get("children", []):
-        if check_p_sub_pattern(child):
-            return True
-
-    return False
-
-
 # ================================================================
 
-def is_instruction(text):
+def is_instruction(text, rules=None):
     """
     Check if text is likely an instruction based on keywords and punctuation density,
     including 'collect' and 'integration'.
@@ -438,13 +582,8 @@ def is_instruction(text):
         return False
 
     # Rule 1: Keywords ('collect' and 'integration' are included)
-    kw_list = CONFIG.get('instruction_keywords', [
-        'please','note','ensure','click','enter','complete','select','indicate','check','provide','collect','integration','Study ID'
-    ])
-    keywords = re.compile(r'\b(' + '|'.join(map(re.escape, kw_list)) + r')\b', re.IGNORECASE)
-
     # If the text contains 'integration' or any other keyword, it is an instruction.
-    if keywords.search(text):
+    if form_rules(rules).instruction_keywords.search(text):
         return True
 
     # Rule 2: Punctuation density (a rough heuristic)
@@ -510,193 +649,312 @@ def is_valid_option_content(node):
 
 
 
-def has_option_child(node):
+# Option-cell features of a node's subtree (over "children"), as a bitmask
+OPTION_NODE_NAMES = ("LI", "L", "ExtraCharSpan", "LBody")
+FEATURE_OPTION_NODE = 1         # LI, L, ExtraCharSpan or LBody node
+FEATURE_P_EXTRACHARSPAN = 2     # P -> ExtraCharSpan -> ExtraCharSpan[]
+FEATURE_P_SUB = 4               # P -> Sub
+FEATURE_P_TEXT = 8              # P* node with text
+FEATURE_OPTION_TD = 16          # TD with valid option content and P* text
+OPTION_CELL_FEATURES = FEATURE_OPTION_NODE | FEATURE_P_EXTRACHARSPAN | FEATURE_P_SUB | FEATURE_OPTION_TD
+
+
+def own_features(node, below):
+    """Features contributed by node itself, given the combined features of its children (below)."""
+    name = node.get("name", "")
+    mask = 0
+    if name in OPTION_NODE_NAMES:
+        mask |= FEATURE_OPTION_NODE
+    if name == "P":
+        for child in node.get("children", []):
+            child_name = child.get("name", "")
+            if child_name == "Sub":
+                mask |= FEATURE_P_SUB
+            elif child_name == "ExtraCharSpan":
+                if any(grandchild.get("name", "") == "ExtraCharSpan" for grandchild in child.get("children", [])):
+                    mask |= FEATURE_P_EXTRACHARSPAN
+    if name.startswith("P") and get_text(node).strip():
+        mask |= FEATURE_P_TEXT
+    if name.startswith("TD") and (below & FEATURE_P_TEXT) and is_valid_option_content(node):
+        mask |= FEATURE_OPTION_TD
+    return mask
+
+
+def node_features(node, features=None):
+    """
+    Bottom-up feature bitmask of node's subtree, memoized by node id in
+    features (EcrfScan fills it during its pass, so lookups are O(1)).
+    """
+    if not isinstance(node, dict):
+        return 0
+    if features is None:
+        features = {}
+    key = id(node)
+    if key not in features:
+        below = 0
+        for child in node.get("children", []):
+            below |= node_features(child, features)
+        features[key] = below | own_features(node, below)
+    return features[key]
+
+
+def has_option_child(node, features=None):
     """
-    Recursively check if a node contains an option-indicating child.
-    Checks three patterns in order:
+    Check if a node contains an option-indicating child anywhere in its subtree:
     1. Direct option nodes (LI, L, ExtraCharSpan, LBody)
     2. P/ExtraCharSpan/ExtraCharSpan[] pattern
     3. P/Sub pattern
+    4. A TD with valid option content whose P nodes have text
+       (catches cases like "|A3| RT" and "|N3| RT")
     """
-    if not isinstance(node, dict):
-        return False
+    return bool(node_features(node, features) & OPTION_CELL_FEATURES)
 
-    # LOGIC 1: Original check for direct option-indicating nodes
-    if node.get("name", "") in ["LI", "L", "ExtraCharSpan", "LBody"]:
-        return True
 
-    for child in node.get("children", []):
-        if has_option_child(child):
-            return True
+def analyse_item_row(tr, features=None, rules=None):
+    """
+    Analyse one TR of a form table, handling rows with TH (question) + TD (options).
+    features: node feature bitmasks (see node_features), e.g. from EcrfScan
+    rules: FormRules for the instruction check
+    Returns (item group, []) for an Item Group header row, otherwise
+    (None, [(item name, option cell), ...]).
+    """
+    # 🔥 Get ALL TH and TD cells in a row
+    cells = [child for child in tr.get("children", []) if child.get("name", "").startswith(("TH", "TD"))]
+
+    # 🔥 ITEM GROUP LOGIC: Check for a single-cell row that is likely an Item Group header
+    if len(cells) == 1:
+        potential_group_text = get_text(cells[0])
+        # Only treat it as an Item Group if it is a valid label and NOT an instruction
+        if is_valid_form_label(potential_group_text) and not is_instruction(potential_group_text, rules):
+            return potential_group_text, []
+    # 🔥 END ITEM GROUP LOGIC
+
+    # 🔥 NEW: Handle 3-column structure (TH | TD | TD[2])
+    if len(cells) == 3:
+        th_cell, question_cell, option_cell = cells
+
+        # Check if this is a valid question row (TH has asterisk, question_cell has text)
+        th_text = get_text(th_cell).strip()
+        question_text = ""
+
+        # Extract question from TD (second column)
+        p_nodes = find_nodes_by_name_pattern(question_cell, r'^P')
+        if p_nodes:
+            # Check if ALL P nodes are ParagraphSpan (skip category headers)
+            all_paragraph_spans = all(node.get("name", "").startswith("ParagraphSpan") for node in p_nodes)
+            if all_paragraph_spans:
+                return None, []
+
+            # Extract text from ALL P nodes
+            p_texts = [get_text(p_node) for p_node in p_nodes if get_text(p_node)]
+            question_text = "\n".join(p_texts)
+        else:
+            question_text = get_text(question_cell)
+
+            # 🔥 ADD THIS LINE HERE - RIGHT AFTER EXTRACTING question_text
+        if not question_text or not question_text.strip() or question_text.strip() in ["*", "**", "***"]:
+            return None, []
+
+        # 🔥 CRITICAL FIX 1: Check if the question text is an instruction
+        if is_instruction(question_text, rules):
+            print(f"    ⚠️  Skipping instruction row (3-col): '{question_text}'")
+            return None, []
+
+
+        # 🔥 NEW: Check if option_cell contains valid option content
+        # Skip rows where the option cell has metadata like "C, CO"
+        if not is_valid_option_content(option_cell):
+            print(f"    ⚠️  Skipping false positive: '{get_text(option_cell)}' (metadata/annotation)")
+            return None, []
+
+        # # 🔥 ENHANCED: Combine TH text with question text if TH contains "*" or meaningful prefix
+        # # This handles cases where "*" is in a separate TH column
+        # if th_text and th_text in ["*", "**", "***"]:
+        #     # Prepend the asterisk to the question text
+        #     question_text = f"{th_text} {question_text}"
+        # elif th_text and len(th_text) <= 10:  # Short prefix (like a number or code)
+        #     # Prepend the prefix
+        #     question_text = f"{th_text} {question_text}"
+
+
+
+        # Add this item (third column becomes the option node)
+        return None, [(question_text, option_cell)]
+
+    # 🔥 ORIGINAL LOGIC: Handle 2-column structure (TH/TD | TD with options)
+    candidates = []
+    for i, cell in enumerate(cells):
+        if i > 0 and has_option_child(cell, features):
+            prev_cell = cells[i - 1]
+            item_name_text = ""
+            # 🔥 NEW: Extract from Sub nodes first (for TH cells with Sub children)
+            sub_nodes = find_nodes_by_name_pattern(prev_cell, r'^Sub')
+            if sub_nodes:
+                # Get the first Sub node (the actual label, not [hidden]/[read-only])
+                main_sub_text = get_text(sub_nodes[0]).strip()
+                if main_sub_text and not main_sub_text.startswith('['):
+                    item_name_text = main_sub_text
+
+            # If no Sub nodes or Sub extraction failed, try P nodes
+            if not item_name_text:
+
+                p_nodes = find_nodes_by_name_pattern(prev_cell, r'^P')
 
-    # LOGIC 2: Check for P/ExtraCharSpan/ExtraCharSpan[] pattern
-    if check_p_extracharspan_extracharspan_pattern(node):
-        return True
+                if p_nodes:
+                    all_paragraph_spans = all(node.get("name", "").startswith("ParagraphSpan") for node in p_nodes)
+                    if all_paragraph_spans:
+                        continue
 
-    # LOGIC 3: Check for P/Sub pattern
-    if check_p_sub_pattern(node):
-        return True
+                    p_texts = [get_text(p_node) for p_node in p_nodes if get_text(p_node)]
+                    item_name_text = "\n".join(p_texts)
+                else:
+                    item_name_text = get_text(prev_cell)
 
-    # 🔥 NEW LOGIC 4: If TD contains P nodes with text, treat as option cell
-    # This catches cases like "|A3| RT" and "|N3| RT" that were being missed
-    if node.get("name", "").startswith("TD"):
-        # 🔥 NEW: First check if this TD contains valid option content
-        if not is_valid_option_content(node):
-            return False
-        p_nodes = find_nodes_by_name_pattern(node, r'^P')
-        if p_nodes:
-                # Check if any P node has meaningful text (not just whitespace)
-                for p_node in p_nodes:
-                    p_text = get_text(p_node).strip()
-                    if p_text and len(p_text) > 0:
-                        return True
+                # 🔥 NEW: Skip if item_name_text is ONLY asterisks
+                if not item_name_text or item_name_text.strip() in ["*", "**", "***"]:
+                    continue
+             # 🔥 CRITICAL FIX 2: ADD THIS INSTRUCTION CHECK!
+            if is_instruction(item_name_text, rules):
+                print(f"    ⚠️  Skipping instruction row (2-col): '{item_name_text}'")
+                continue
 
-    return False
+
+            candidates.append((item_name_text, cell))
+    return None, candidates
 
 
-def extract_items_from_form(form_node):
+def unique_items(items_data):
+    """🔥 Enhanced deduplication using Item Group + Item Name"""
+    unique = []
+    seen_names = set()
+    for item in items_data:
+        item_key = (item["Item Name"], item.get("Item Group", ""))  # 🔥 Tuple key for uniqueness
+        if item_key not in seen_names:
+            seen_names.add(item_key)
+            unique.append(item)
+    return unique
+
+
+def extract_items_from_form(form_node, rules=None):
     """
     Extracts item data, handling rows with TH (question) + TD (options),
     and persistently tracking the Item Group across table breaks.
     """
-    items_data = []
-    table_nodes = find_nodes_by_name_pattern(form_node, r'^Table')
-
-    # 🔥 FIX: Initialize Item Group outside the table loop to persist across table breaks.
-    current_item_group = ""
-
-    for table in table_nodes:
-        # 🔥 NEW: Skip metadata tables
-        if is_metadata_table(table):
-            print(f"⚠️  Skipping metadata table: {table.get('name', '')}")
-            continue
-        tr_nodes = find_nodes_by_name_pattern(table, r'^TR')
-
-        for tr in tr_nodes:
-            # 🔥 Get ALL TH and TD cells in a row
-            cells = [child for child in tr.get("children", []) if child.get("name", "").startswith(("TH", "TD"))]
-
-            # 🔥 ITEM GROUP LOGIC: Check for a single-cell row that is likely an Item Group header
-            if len(cells) == 1:
-                potential_group_text = get_text(cells[0])
-                # Only treat it as an Item Group if it is a valid label and NOT an instruction
-                if is_valid_form_label(potential_group_text) and not is_instruction(potential_group_text):
-                    current_item_group = potential_group_text
-                    continue  # Skip processing this row as an item
-            # 🔥 END ITEM GROUP LOGIC
-
-            # 🔥 NEW: Handle 3-column structure (TH | TD | TD[2])
-            if len(cells) == 3:
-                th_cell, question_cell, option_cell = cells
-
-                # Check if this is a valid question row (TH has asterisk, question_cell has text)
-                th_text = get_text(th_cell).strip()
-                question_text = ""
-
-                # Extract question from TD (second column)
-                p_nodes = find_nodes_by_name_pattern(question_cell, r'^P')
-                if p_nodes:
-                    # Check if ALL P nodes are ParagraphSpan (skip category headers)
-                    all_paragraph_spans = all(node.get("name", "").startswith("ParagraphSpan") for node in p_nodes)
-                    if all_paragraph_spans:
-                        continue
+    return EcrfScan(rules).scan_form(form_node).items(form_node)
 
-                    # Extract text from ALL P nodes
-                    p_texts = [get_text(p_node) for p_node in p_nodes if get_text(p_node)]
-                    question_text = "\n".join(p_texts)
-                else:
-                    question_text = get_text(question_cell)
 
-                    # 🔥 ADD THIS LINE HERE - RIGHT AFTER EXTRACTING question_text
-                if not question_text or not question_text.strip() or question_text.strip() in ["*", "**", "***"]:
-                    continue
+# Option symbols that are not option values
+OPTION_PLACEHOLDERS = ["", "\uf0fe", "□", "¡"]
 
-                # 🔥 CRITICAL FIX 1: Check if the question text is an instruction
-                if is_instruction(question_text):
-                    print(f"    ⚠️  Skipping instruction row (3-col): '{question_text}'")
-                    continue
 
+def _unique(values):
+    """Values in first-seen order without duplicates."""
+    seen = set()
+    return [x for x in values if not (x in seen or seen.add(x))]
 
-                # 🔥 NEW: Check if option_cell contains valid option content
-                # Skip rows where the option cell has metadata like "C, CO"
-                if not is_valid_option_content(option_cell):
-                    print(f"    ⚠️  Skipping false positive: '{get_text(option_cell)}' (metadata/annotation)")
-                    continue
 
-                # # 🔥 ENHANCED: Combine TH text with question text if TH contains "*" or meaningful prefix
-                # # This handles cases where "*" is in a separate TH column
-                # if th_text and th_text in ["*", "**", "***"]:
-                #     # Prepend the asterisk to the question text
-                #     question_text = f"{th_text} {question_text}"
-                # elif th_text and len(th_text) <= 10:  # Short prefix (like a number or code)
-                #     # Prepend the prefix
-                #     question_text = f"{th_text} {question_text}"
+class OptionCellProfile:
+    """
+    Everything the item columns need from one option cell, collected in a
+    single walk over it: the texts of its LBody, Sub and P nodes (in
+    document order), whether it contains ExtraCharSpan nodes, and the
+    deduplicated option values. Codelist content, data type, field length,
+    precision and range are derived from the profile (the data type with
+    the date/time pattern of rules). The profile keeps no reference to the
+    cell itself.
+    """
+
+    __slots__ = ("rules", "present", "lbody_texts", "sub_texts", "p_texts", "has_extracharspan",
+                 "values", "codelist_content")
+
+    def __init__(self, option_td_node, rules=None):
+        self.rules = form_rules(rules)
+        self.present = bool(option_td_node)
+        self.lbody_texts = []
+        self.sub_texts = []
+        self.p_texts = []
+        self.has_extracharspan = False
+        if self.present:
+            self._collect(option_td_node)
+        self.values = self._option_values()
+        self.codelist_content = "\n".join(f"• {val}" for val in self.values)
+
+    def _collect(self, node):
+        if not isinstance(node, dict):
+            return
+        name = node.get("name", "")
+        if name.startswith("LBody"):
+            self.lbody_texts.append(get_text(node))
+        elif name.startswith("Sub"):
+            self.sub_texts.append(get_text(node))
+        elif name.startswith("ExtraCharSpan"):
+            self.has_extracharspan = True
+        if name.startswith("P"):
+            self.p_texts.append(get_text(node))
+        for child in node.get("children", []):
+            self._collect(child)
 
+    def _option_values(self):
+        """
+        Option values from LBody nodes (radio button/codelist options), else
+        Sub nodes (subscript-style options), else P nodes (date/text format
+        fields).
+        """
+        if self.lbody_texts:
+            return _unique([text for text in self.lbody_texts if text])
+        # Skip empty text and special characters, clean up leading bullets/symbols
+        values = _unique([
+            cleaned for cleaned in (
+                text.strip().lstrip("¡ ").lstrip("□ ").strip()
+                for text in self.sub_texts if text and text.strip() not in OPTION_PLACEHOLDERS)
+            if cleaned])
+        if values:
+            return values
+        return _unique([text for text in self.p_texts if text and text.strip() not in OPTION_PLACEHOLDERS])
+
+    def data_type(self, codelist_content=None):
+        """
+        Data type from:
+        1. Codelist content patterns (Date/Time, Label)
+        2. Cell structure (Codelist: ExtraCharSpan nodes, inside LBody or not)
+        3. Default to Text
+        codelist_content defaults to the profile's own content.
+        """
+        if not self.present:
+            return "Text"
+        if codelist_content is None:
+            codelist_content = self.codelist_content
+        codelist_content = str(codelist_content).strip()
 
+        # 🔥 LOGIC 1: Check for Date/Time pattern in codelist content
+        # Pattern: Req/Req/Req(YYYY-YYYY) or similar date range patterns
+        if self.rules.date_time_pattern.search(codelist_content):
+            return "Date/Time"
 
-                # Add this item (third column becomes the option node)
-                items_data.append({
-                    "Item Group": current_item_group,  # 🔥 ASSIGN ITEM GROUP
-                    "Item Name": question_text,
-                    "Option_TD_Node": option_cell
-                })
-                continue
+        # 🔥 LOGIC 2: Codelist when the cell has ExtraCharSpan nodes
+        if self.has_extracharspan:
+            return "Codelist"
 
-            # 🔥 ORIGINAL LOGIC: Handle 2-column structure (TH/TD | TD with options)
-            for i, cell in enumerate(cells):
-                if i > 0 and has_option_child(cell):
-                    prev_cell = cells[i - 1]
-                    item_name_text = ""
-                    # 🔥 NEW: Extract from Sub nodes first (for TH cells with Sub children)
-                    sub_nodes = find_nodes_by_name_pattern(prev_cell, r'^Sub')
-                    if sub_nodes:
-                        # Get the first Sub node (the actual label, not [hidden]/[read-only])
-                        main_sub_text = get_text(sub_nodes[0]).strip()
-                        if main_sub_text and not main_sub_text.startswith('['):
-                            item_name_text = main_sub_text
-
-                    # If no Sub nodes or Sub extraction failed, try P nodes
-                    if not item_name_text:
-
-                        p_nodes = find_nodes_by_name_pattern(prev_cell, r'^P')
-
-                        if p_nodes:
-                            all_paragraph_spans = all(node.get("name", "").startswith("ParagraphSpan") for node in p_nodes)
-                            if all_paragraph_spans:
-                                continue
-
-                            p_texts = [get_text(p_node) for p_node in p_nodes if get_text(p_node)]
-                            item_name_text = "\n".join(p_texts)
-                        else:
-                            item_name_text = get_text(prev_cell)
-
-                        # 🔥 NEW: Skip if item_name_text is ONLY asterisks
-                        if not item_name_text or item_name_text.strip() in ["*", "**", "***"]:
-                            continue
-                     # 🔥 CRITICAL FIX 2: ADD THIS INSTRUCTION CHECK!
-                    if is_instruction(item_name_text):
-                        print(f"    ⚠️  Skipping instruction row (2-col): '{item_name_text}'")
-                        continue
+        # 🔥 LOGIC 3: Check for Label pattern
+        # Pattern: Contains |...| but NO multiple bullet points (no multiple •)
+        # This catches: • |N3| Years, • |0 < N3 ≤ 200| ¡ kg
+        if '|' in codelist_content and codelist_content.count('•') <= 1:
+            return "Label"
 
+        # 🔥 LOGIC 4: Default to Text
+        return "Text"
 
-                    items_data.append({
-                        "Item Group": current_item_group,  # 🔥 ASSIGN ITEM GROUP
-                        "Item Name": item_name_text,
-                        "Option_TD_Node": cell
-                    })
+    def field_length(self):
+        return calculate_field_length(self.codelist_content)
 
-    # 🔥 Enhanced deduplication using Item Group + Item Name
-    unique_items = []
-    seen_names = set()
-    for item in items_data:
-        item_key = (item["Item Name"], item.get("Item Group", ""))  # 🔥 Tuple key for uniqueness
-        if item_key not in seen_names:
-            seen_names.add(item_key)
-            unique_items.append(item)
-    return unique_items
+    def precision(self):
+        return calculate_precision(self.codelist_content)
 
+    def number_range(self):
+        return extract_number_range(self.codelist_content)
 
-def determine_data_type(option_td_node, codelist_content):
+
+def determine_data_type(option_td_node, codelist_content, rules=None):
     """
     Determine data type based on:
     1. Codelist content patterns (Date/Time, Label)
@@ -707,47 +965,7 @@ def determine_data_type(option_td_node, codelist_content):
     - option_td_node: The TD node containing options from JSON
     - codelist_content: The text content from "Codelist - Choice Labels" column
     """
-    if not option_td_node:
-        return "Text"
-
-    # Ensure codelist_content is a string
-    if codelist_content is None:
-        codelist_content = ""
-    else:
-        codelist_content = str(codelist_content).strip()
-
-    # 🔥 LOGIC 1: Check for Date/Time pattern in codelist content
-    # Pattern: Req/Req/Req(YYYY-YYYY) or similar date range patterns
-    date_time_pattern = CONFIG.get('date_time_pattern', r'Req.*?\(\d{4}[-–—/]{1,2}\d{4}\)')
-    if re.search(date_time_pattern, codelist_content, re.IGNORECASE):
-        return "Date/Time"
-
-    # 🔥 LOGIC 2: Check for Codelist in JSON structure
-    # Look for LBody nodes that contain ExtraCharSpan children
-    lbody_nodes = find_nodes_by_name_pattern(option_td_node, r'^LBody')
-    if lbody_nodes:
-        for lbody_node in lbody_nodes:
-            # Check if this LBody has ExtraCharSpan children
-            extracharspan_nodes = find_nodes_by_name_pattern(lbody_node, r'^ExtraCharSpan')
-            if extracharspan_nodes:
-                return "Codelist"
-
-    # Also check for direct ExtraCharSpan nodes (original logic)
-    if find_nodes_by_name_pattern(option_td_node, r'^ExtraCharSpan'):
-        return "Codelist"
-
-    # 🔥 LOGIC 3: Check for Label pattern
-    # Pattern: Contains |...| but NO multiple bullet points (no multiple •)
-    # This catches: • |N3| Years, • |0 < N3 ≤ 200| ¡ kg
-    if '|' in codelist_content:
-        # Count bullet points
-        bullet_count = codelist_content.count('•')
-        # If only ONE bullet (or none) and contains pipes, it's a Label
-        if bullet_count <= 1:
-            return "Label"
-
-    # 🔥 LOGIC 4: Default to Text
-    return "Text"
+    return OptionCellProfile(option_td_node, rules).data_type("" if codelist_content is None else codelist_content)
 
 
 def get_all_lbody_values(option_td_node):
@@ -755,51 +973,7 @@ def get_all_lbody_values(option_td_node):
     Get all option values from the specific option cell.
     Extracts from LBody, Sub, or P nodes depending on the structure.
     """
-    if not option_td_node:
-        return ""
-
-    # First try to find LBody nodes (for radio button/codelist options)
-    lbody_nodes = find_nodes_by_name_pattern(option_td_node, r'^LBody')
-    if lbody_nodes:
-        values = [get_text(node) for node in lbody_nodes if get_text(node)]
-        seen = set()
-        unique_values = [x for x in values if not (x in seen or seen.add(x))]
-        return "\n".join(f"• {val}" for val in unique_values)
-
-    # 🔥 NEW: Try to find Sub nodes (for subscript-style options)
-    sub_nodes = find_nodes_by_name_pattern(option_td_node, r'^Sub')
-    if sub_nodes:
-        values = []
-        for node in sub_nodes:
-            text = get_text(node)
-            # Skip empty text and special characters
-            if text and text.strip() not in ["", "\uf0fe", "□", "¡"]:
-                # Clean up the text (remove leading bullets/symbols)
-                cleaned_text = text.strip().lstrip("¡ ").lstrip("□ ").strip()
-                if cleaned_text:
-                    values.append(cleaned_text)
-
-        seen = set()
-        unique_values = [x for x in values if not (x in seen or seen.add(x))]
-        if unique_values:
-            return "\n".join(f"• {val}" for val in unique_values)
-
-    # Last resort: Try P nodes (for date/text format fields)
-    p_nodes = find_nodes_by_name_pattern(option_td_node, r'^P')
-    if p_nodes:
-        values = []
-        for node in p_nodes:
-            text = get_text(node)
-            # Skip empty text and special characters
-            if text and text.strip() not in ["", "\uf0fe", "□", "¡"]:
-                values.append(text)
-
-        seen = set()
-        unique_values = [x for x in values if not (x in seen or seen.add(x))]
-        if unique_values:
-            return "\n".join(f"• {val}" for val in unique_values)
-
-    return ""
+    return OptionCellProfile(option_td_node).codelist_content
 
 
 def calculate_field_length(codelist_content):
@@ -1036,128 +1210,76 @@ def assign_item_order(items):
 # UPDATED MAIN PROCESSING FUNCTION WITH SIMPLE ITEM ORDER
 # ==============================================================================
 
-def process_clinical_forms(json_file_path, template_csv_path=None, output_csv_path="Study_Specific_Form.xlsx", config_path: str = "./config/config_study_specific_forms.json"):
-    """Main function to process JSON and create the item-based Excel with repeating logic and item order."""
-    global CONFIG
-    CONFIG = load_config(config_path)
+def _legacy_form_item_rows(form, items, rules):
+    """process_clinical_forms rows (StudySpecificFormsRow) of one form's items."""
+    print(f"  > Form '{form['Form Name']}': Found {len(items)} unique items.")
+
+    if not items:
+        items.append({"Item Name": "", "Option_TD_Node": None, "Item Group": ""})
+
+    # 🔥 UPDATED: Assign sequential item order (1, 2, 3...) based on Item Label sequence
+    items = assign_item_order(items)
+
+    # Analyze item groups for this form to determine repeating status
+    item_group_counts, repeating_groups = analyze_item_groups_per_form(items)
+
+    print(f"    📊 Item Group Analysis:")
+    print(f"       - Total unique item groups: {len(item_group_counts)}")
+    print(f"       - Repeating item groups: {len(repeating_groups)}")
+    if repeating_groups:
+        print(f"       - Repeating groups: {repeating_groups}")
+    print(f"    📋 Item Order assigned: {items[0].get('Item_Order', 'N/A')} to {items[-1].get('Item_Order', 'N/A')}")
+
+    # Same rows as the streaming writers, plus the codelist control type
+    return [row._replace(codelist_control_type="Radio Button-Vertical") if row.data_type == "Codelist" else row
+            for row in _form_rows(form, items, rules)]
+
+
+def process_clinical_forms(json_file_path, template_csv_path=None, output_csv_path="Study_Specific_Form.xlsx", config_path: str = "./config/config_study_specific_forms.json", format_sheet=None, workers: int = 1):
+    """Main function to process JSON and create the item-based Excel with repeating logic and item order.
+
+    format_sheet, if given, is called with the worksheet right before the workbook is saved.
+    workers > 1 processes the forms on a process pool (see map_forms).
+    """
     # Build template that mirrors the original script (with Unnamed columns)
     template_df = df_template.copy()
     print("✅ Template CSV loaded successfully")
 
+    all_item_rows = prepare_clinical_forms_rows(json_file_path, config_path=config_path, workers=workers)
+    write_clinical_forms_xlsx(all_item_rows, output_csv_path, format_sheet=format_sheet)
+
+
+def prepare_clinical_forms_rows(json_file_path, config_path: str = "./config/config_study_specific_forms.json", workers: int = 1):
+    """
+    The rows process_clinical_forms writes: the Study Specific Forms rows with
+    the Codelist control type filled in. Built once, they feed both the
+    template-mode forms workbook and the tabular export.
+    Returns: StudySpecificFormsRows (with the eCRF scan's counts).
+    """
+    rules = FormRules.from_file(config_path)
+
     with open(json_file_path, "r", encoding="utf-8") as file:
         data = json.load(file)
     print("✅ JSON data loaded successfully")
 
-    extracted_forms = extract_forms_cleaned(data)
+    scan = scan_ecrf(data, collect_tables=workers <= 1, rules=rules)
+    extracted_forms = scan.forms()
     print(f"✅ Found {len(extracted_forms)} forms to process")
 
     all_item_rows = []
     print("\n🔄 Processing forms with item group repeating logic and sequential item order...")
 
-    for form in extracted_forms:
-        items = extract_items_from_form(form['Form_Node'])
-        print(f"  > Form '{form['Form Name']}': Found {len(items)} unique items.")
-
-        if not items:
-            items.append({"Item Name": "", "Option_TD_Node": None, "Item Group": ""})
-
-        # 🔥 UPDATED: Assign sequential item order (1, 2, 3...) based on Item Label sequence
-        items = assign_item_order(items)
-
-        # Analyze item groups for this form to determine repeating status
-        item_group_counts, repeating_groups = analyze_item_groups_per_form(items)
-
-        print(f"    📊 Item Group Analysis:")
-        print(f"       - Total unique item groups: {len(item_group_counts)}")
-        print(f"       - Repeating item groups: {len(repeating_groups)}")
-        if repeating_groups:
-            print(f"       - Repeating groups: {repeating_groups}")
-        print(f"    📋 Item Order assigned: {items[0].get('Item_Order', 'N/A')} to {items[-1].get('Item_Order', 'N/A')}")
-
-        for item in items:
-            item_row = {}
-            option_node = item.get("Option_TD_Node")
-            item_name = item['Item Name']
-
-            # Extract Item Group and set to 'NaN' if empty
-            item_group_value = item.get("Item Group", "")
-            if item_group_value == "":
-                item_group_value = 'NaN'
-
-            # Determine if this item group is repeating
-            item_group_repeating_flag = get_item_group_repeating_flag(
-                item_group_value,
-                repeating_groups
-            )
-
-            # Calculate repeat maximum based on repeating status
-            repeat_maximum = get_repeat_maximum(
-                item_group_value,
-                item_group_repeating_flag,
-                item_group_counts
-            )
-
-            # 🔥 Get sequential item order (1, 2, 3...)
-            item_order = item.get('Item_Order', 1)
-
-            # Fill in the columns
-            item_row['CTDM Optional, if blank CDP to propose'] = form['Form Label']
-            item_row['Input needed from SDTM'] = form['Form Name']
-            item_row['CDAI input needed'] = item_group_value
-
-            # Fill legacy Unnamed columns exactly like the original implementation
-            item_row['Unnamed: 4'] = item_group_repeating_flag
-            item_row['Unnamed: 5'] = repeat_maximum
-            item_row['Unnamed: 8'] = item_order
-            item_row['Unnamed: 9'] = item_name
-            item_row['Unnamed: 10'] = ""
-
-            # Get codelist content first
-            codelist_content = get_all_lbody_values(option_node)
-            item_row['Unnamed: 19'] = codelist_content
-
-            # Determine data type
-            data_type = determine_data_type(option_node, codelist_content)
-            item_row['Unnamed: 16'] = data_type
-            item_row['Unnamed: 22'] = "Radio Button-Vertical" if data_type == "Codelist" else ""
-
-            # Calculate Field Length for Text or Label types
-            if data_type in ["Text", "Label"]:
-                field_length = calculate_field_length(codelist_content)
-                item_row['Unnamed: 17'] = field_length
-            else:
-                item_row['Unnamed: 17'] = ""
-
-            # Calculate Precision for Label type only
-            if data_type == "Label":
-                precision = calculate_precision(codelist_content)
-                item_row['Unnamed: 18'] = precision
-            else:
-                item_row['Unnamed: 18'] = ""
-
-            # Extract number range for Label type
-            if data_type == "Label":
-                number_range = extract_number_range(codelist_content)
-                item_row['Unnamed: 23'] = number_range
-            else:
-                item_row['Unnamed: 23'] = ""
-
-            # Check if future dates should trigger query
-            query_future_date = check_query_future_date(data_type)
-            item_row['Unnamed: 24'] = query_future_date
-
-            # Check if field is required (based on * in item name)
-            is_required = check_required_field(item_name)
-            item_row['Unnamed: 25'] = is_required
+    for form_item_rows in map_forms(_legacy_form_item_rows, extracted_forms, workers, scan):
+        all_item_rows.extend(form_item_rows)
+    return StudySpecificFormsRows(all_item_rows, ecrf_stats=scan.counts)
 
-            # Set "Form,Item" if required, otherwise blank
-            if is_required == "Y":
-                item_row['Unnamed: 26'] = "Form,Item"
-            else:
-                item_row['Unnamed: 26'] = ""
-
-            all_item_rows.append(item_row)
 
+def write_clinical_forms_xlsx(all_item_rows, output_csv_path, format_sheet=None):
+    """
+    Write prepare_clinical_forms_rows' rows as the formatted Study Specific
+    Forms workbook (CTDM header rows, grouped headers, borders, widths).
+    format_sheet, if given, is called with the worksheet right before the workbook is saved.
+    """
     # =========================
     # Build formatted Excel per CTDM 4-row header spec
     # =========================
@@ -1329,58 +1451,10 @@ def process_clinical_forms(json_file_path, template_csv_path=None, output_csv_pa
     # Data rows start at row 4
     start_data_row = 4
 
-    # Helper: safe getter
-    def gv(d, key, default=""):
-        return d.get(key, default)
-
-    # Assemble rows in the exact subheader order
-    ordered_subheaders = []
-    for g in groups:
-        ordered_subheaders.extend(g["subheaders"])
-
-    # Write each item row
-    for r_idx, row_dict in enumerate(all_item_rows, start=start_data_row):
-        # Map existing keys to new layout values
-        values_by_subheader = {
-            # Source
-            "New or Copied from Study": "",
-            # Form
-            "Form Label": gv(row_dict, "CTDM Optional, if blank CDP to propose"),
-            "Form Name (provided by SDTM Programmer, if SDTM linked form)": gv(row_dict, "Input needed from SDTM"),
-            # Item Group
-            "Item Group (if only one on form, recommend same as Form Label)": gv(row_dict, "CDAI input needed"),
-            "Item group Repeating": gv(row_dict, "Unnamed: 4"),
-            "Repeat Maximum, if known, else default =50": gv(row_dict, "Unnamed: 5"),
-            "Display format of repeating item group (Grid, read only, form)": gv(row_dict, "Unnamed: 6"),
-            "Default Data in repeating item group": gv(row_dict, "Unnamed: 7"),
-            # Item
-            "Item Order": gv(row_dict, "Unnamed: 8"),
-            "Item Label": gv(row_dict, "Unnamed: 9"),
-            "Item Name (provided by SDTM Programmer, if SDTM linked item)": gv(row_dict, "Unnamed: 10"),
-            # Progressive Display
-            "Progressively displayed?": gv(row_dict, "Unnamed: 12"),
-            "Controlling item (item triggering it, if yes, describe item below)": gv(row_dict, "Unnamed: 13"),
-            "Controlling item value": gv(row_dict, "Unnamed: 14"),
-            # Data Type
-            "Data type": gv(row_dict, "Unnamed: 16"),
-            "If text or number, Field Length": gv(row_dict, "Unnamed: 17"),
-            "If number, Precision (decimal places)": gv(row_dict, "Unnamed: 18"),
-            # Codelist
-            "Codelist – Choice Labels (if binary, can use Goodlist Table)": gv(row_dict, "Unnamed: 19"),
-            "Codelist Name (provided by SDTM Programmer)": gv(row_dict, "Unnamed: 20"),
-            "Choice Code (provided by SDTM Programmer)": gv(row_dict, "Unnamed: 21"),
-            "Codelist Control Type": gv(row_dict, "Unnamed: 22"),
-            # System Queries
-            "If number, Range: Min Value / Max Value": gv(row_dict, "Unnamed: 23"),
-            "Date: Query Future Date": gv(row_dict, "Unnamed: 24"),
-            "Required": gv(row_dict, "Unnamed: 25"),
-            "If Required, Open Query when intentionally left blank (form/item)": gv(row_dict, "Unnamed: 26"),
-            # Notes
-            "Notes": gv(row_dict, "Unnamed: 27"),
-        }
-
-        for c_idx, header in enumerate(ordered_subheaders, start=1):
-            cell = ws.cell(row=r_idx, column=c_idx, value=values_by_subheader.get(header, ""))
+    # Write each item row (StudySpecificFormsRow, already in subheader order)
+    for r_idx, row in enumerate(all_item_rows, start=start_data_row):
+        for c_idx, value in enumerate(row, start=1):
+            cell = ws.cell(row=r_idx, column=c_idx, value=value)
             cell.alignment = left_top
             cell.border = thin_border
 
@@ -1408,6 +1482,9 @@ def process_clinical_forms(json_file_path, template_csv_path=None, output_csv_pa
                 pass
         ws.column_dimensions[col_letter].width = max(12, min(60, max_len + 2))
 
+    if format_sheet is not None:
+        format_sheet(ws)
+
     # Save
     wb.save(output_csv_path)
     print(f"\n✅ SUCCESS! Created Study Specific Forms Excel: {output_csv_path} with {len(all_item_rows)} item rows.")
@@ -1603,121 +1680,298 @@ def get_groups_spec():
     ]
 
 
-def prepare_study_specific_forms_rows(
+# Cell formats of the Study Specific Forms sheet, as written by
+# write_study_specific_forms_stream; group fills are keyed "group_<color>".
+STUDY_SPECIFIC_FORMS_FORMATS = {
+    'ctdm': {'bg_color': '#F5F5F5', 'bold': True, 'align': 'center', 'valign': 'vcenter', 'text_wrap': True},
+    'left_top': {'align': 'left', 'valign': 'top', 'text_wrap': True, 'border': 1},
+    'center': {'align': 'center', 'valign': 'vcenter', 'text_wrap': True, 'border': 1},
+}
+STUDY_SPECIFIC_FORMS_FORMATS.update({
+    f"group_{group['color']}": {'bg_color': f"#{group['color']}", 'bold': True, 'align': 'center',
+                                'valign': 'vcenter', 'text_wrap': True, 'border': 1}
+    for group in get_groups_spec()
+})
+
+
+def build_study_specific_forms_sheet_rows(items_rows):
+    """
+    Lay out the Study Specific Forms sheet as rows of (value, format_key)
+    cells, with the same headers and formats as write_study_specific_forms_stream.
+    items_rows may be any iterable (e.g. a generator); data rows are yielded as
+    they are read.
+    Returns: dict with 'rows', 'merges' (zero-based ranges), 'freeze_panes',
+    'num_cols', 'formats' and 'column_widths'.
+    """
+    groups = get_groups_spec()
+    num_cols = sum(len(g["subheaders"]) for g in groups)
+    ctdm_titles = [
+        "CTDM to fill in",
+        "CTDM Optional, if blank CDP to propose",
+        "Input needed from SDTM",
+        "CDAI input needed",
+    ]
+
+    merges = []
+    col_start = 0
+    for group in groups:
+        width = len(group["subheaders"])
+        if width > 1:
+            merges.append((1, col_start, 1, col_start + width - 1))
+        col_start += width
+
+    def iter_rows():
+        # Row 1: CTDM meta labels; Row 2: group names; Row 3: subheaders
+        yield [(title, 'ctdm') for title in ctdm_titles]
+        group_row, sub_row = [], []
+        for group in groups:
+            fmt = f"group_{group['color']}"
+            for i, sub in enumerate(group["subheaders"]):
+                group_row.append((group["name"] if i == 0 else None, fmt))
+                sub_row.append((sub, fmt))
+        yield group_row
+        yield sub_row
+        for row_values in items_rows:
+            yield [(val, 'left_top' if c_idx in {1, 2, 3} else 'center') for c_idx, val in enumerate(row_values)]
+
+    return {
+        'rows': iter_rows(),
+        'merges': merges,
+        'freeze_panes': None,
+        'num_cols': num_cols,
+        'formats': STUDY_SPECIFIC_FORMS_FORMATS,
+        'column_widths': False,
+    }
+
+
+def _run_form_job(job, rules, form):
+    """Scan one form's subtree in a worker and run job(form, items, rules) on it."""
+    form_node = form['Form_Node']
+    return job(form, EcrfScan(rules).scan_form(form_node).items(form_node), rules)
+
+
+def map_forms(job, forms, workers=1, scan=None):
+    """
+    Yield job(form, items, rules) for every form, in form order. Forms are
+    independent, so with workers > 1 they are fanned out to a process pool:
+    each form is sent once with its own subtree (not its enclosing H1
+    section) and scanned in the worker. job must be a module-level function
+    whose result holds no tree nodes. scan (a scan_ecrf result) provides
+    the rules and, with one worker, the items.
+    """
+    if workers <= 1:
+        for form in forms:
+            yield job(form, scan.items(form['Form_Node']), scan.rules)
+        return
+    payloads = [{key: form[key] for key in ("Form Label", "Form Name", "H1_Text", "Form_Node")} for form in forms]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(partial(_run_form_job, job, scan.rules), payloads)
+
+
+def _load_ecrf_scan(json_file_path, config_path, collect_tables=True):
+    """Load the rules config and the eCRF document and scan it."""
+    rules = FormRules.from_file(config_path)
+
+    with open(json_file_path, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    return scan_ecrf(data, collect_tables, rules)
+
+
+def _form_item_records(form, items, rules):
+    """
+    Item records of one form: (row, OptionCellProfile), where row is the
+    item's StudySpecificFormsRow with the form, item group and item columns
+    filled in (item order and the form's item group analysis applied). The
+    records hold no tree nodes: the option cell is reduced to its profile
+    and the form to its label and name, so the eCRF tree can be freed while
+    records are still pending.
+    """
+    if not items:
+        items.append({"Item Name": "", "Option_TD_Node": None, "Item Group": ""})
+    items = assign_item_order(items)
+    item_group_counts, repeating_groups = analyze_item_groups_per_form(items)
+
+    for item in items:
+        item_group_value = item.get("Item Group", "") or 'NaN'
+        item_group_repeating_flag = get_item_group_repeating_flag(item_group_value, repeating_groups)
+        repeat_maximum = get_repeat_maximum(item_group_value, item_group_repeating_flag, item_group_counts)
+        row = StudySpecificFormsRow(
+            form_label=form['Form Label'],
+            form_name=form['Form Name'],
+            item_group=item_group_value,
+            item_group_repeating=item_group_repeating_flag,
+            repeat_maximum=repeat_maximum,
+            item_order=item.get('Item_Order', 1),
+            item_label=item['Item Name'],
+        )
+        yield row, OptionCellProfile(item.get("Option_TD_Node"), rules)
+
+
+def iter_study_specific_forms_items(
     json_file_path: str,
     config_path: str = "./config/config_study_specific_forms.json",
+    ecrf_stats: Optional[dict] = None,
 ):
     """
-    Build the Study Specific Forms rows (values only) in the same order as the
-    grouped header layout. This avoids building an in-memory workbook and enables
-    streaming write.
-    Returns: list of lists (each inner list corresponds to ordered subheaders).
+    Yield every item of the eCRF, form by form, as an item record (see
+    _form_item_records). ecrf_stats, if given, receives the scan's node,
+    table and TR counts once the document is scanned.
     """
-    global CONFIG
-    CONFIG = load_config(config_path)
+    scan = _load_ecrf_scan(json_file_path, config_path)
+    if ecrf_stats is not None:
+        ecrf_stats.update(scan.counts)
+    for form in scan.forms():
+        yield from _form_item_records(form, scan.items(form['Form_Node']), scan.rules)
+
+
+def derive_item_attributes(profile, item_name):
+    """(data type, field length, precision, range, required) of one item."""
+    data_type = profile.data_type()
+    return (
+        data_type,
+        profile.field_length() if data_type in ["Text", "Label"] else "",
+        profile.precision() if data_type == "Label" else "",
+        profile.number_range() if data_type == "Label" else "",
+        check_required_field(item_name),
+    )
 
-    with open(json_file_path, "r", encoding="utf-8") as file:
-        data = json.load(file)
 
-    extracted_forms = extract_forms_cleaned(data)
+def derive_item_attributes_batch(profiles, item_names, rules=None):
+    """
+    derive_item_attributes for many items at once: the codelist contents and
+    item names are put into columns and the rules of determine_data_type,
+    calculate_field_length, calculate_precision, extract_number_range and
+    check_required_field are applied with vectorized string methods (same
+    patterns, same results). rules defaults to the first profile's rules.
+    Returns: list of (data type, field length, precision, range, required).
+    """
+    if not profiles:
+        return []
+    rules = form_rules(rules if rules is not None else profiles[0].rules)
+    raw = pd.Series([profile.codelist_content for profile in profiles], dtype=object)
+    content = raw.str.strip()
+    present = pd.Series([profile.present for profile in profiles])
+    has_extracharspan = pd.Series([profile.has_extracharspan for profile in profiles])
+    names = pd.Series(list(item_names), dtype=object)
+    empty = raw.eq("")
+
+    # Data type (determine_data_type)
+    data_type = pd.Series("Text", index=content.index, dtype=object)
+    label = content.str.contains('|', regex=False) & content.str.count('•').le(1)
+    data_type[label] = "Label"
+    data_type[has_extracharspan] = "Codelist"
+    data_type[content.str.contains(rules.date_time_pattern, regex=True)] = "Date/Time"
+    data_type[~present] = "Text"
+
+    # Field length (calculate_field_length): |Nxx|, then |..Nxx..|, then the longest plain line
+    lines = content.str.split('\n').explode().str.strip().str.lstrip('• ').str.strip()
+    lines = lines[lines.ne("") & ~lines.str.startswith('|')]
+    longest = lines.str.len().groupby(level=0).max().reindex(content.index)
+    field_length = (content.str.extract(r'\|N(\d+)\|')[0]
+                    .fillna(content.str.extract(r'\|.*N(\d+).*\|')[0])
+                    .fillna(longest[longest.gt(0)].astype(int).astype(str))
+                    .fillna(""))
+
+    # Precision (calculate_precision): |Nx.yy|, then |..Nx.yy..|, then the most decimals, else 0
+    decimals = content.str.extractall(r'\d+\.(\d+)')
+    most_decimals = (decimals[0].str.len().groupby(level=0).max().reindex(content.index)
+                     if len(decimals) else pd.Series(float("nan"), index=content.index))
+    precision = (content.str.extract(r'\|N\d+\.(\d+)\|')[0]
+                 .fillna(content.str.extract(r'\|.*N\d+\.(\d+).*\|')[0])
+                 .fillna(most_decimals.dropna().astype(int).astype(str))
+                 .fillna("0"))
+    precision[empty] = ""
+
+    # Range (extract_number_range): |min < Nx < max|, then |min < Nx|, then |Nx < max|
+    both = content.str.extract(r'\|(\d+(?:\.\d+)?)\s*[<≤]\s*N\d+(?:\.\d+)?\s*[<≤]\s*(\d+(?:\.\d+)?)\|')
+    min_only = content.str.extract(r'\|(\d+(?:\.\d+)?)\s*[<≤]\s*N\d+(?:\.\d+)?\|')[0]
+    max_only = content.str.extract(r'\|N\d+(?:\.\d+)?\s*[<≤]\s*(\d+(?:\.\d+)?)\|')[0]
+    number_range = ((both[0] + " - " + both[1])
+                    .fillna(min_only + " - ")
+                    .fillna(" - " + max_only)
+                    .fillna(""))
+
+    # Required (check_required_field)
+    required = names.where(names.astype(bool), "").astype(str).str.strip().str.startswith('*').map({True: "Y", False: "N"})
+
+    is_label = data_type.eq("Label")
+    field_length = field_length.where(data_type.isin(["Text", "Label"]), "")
+    precision = precision.where(is_label, "")
+    number_range = number_range.where(is_label, "")
+    return list(zip(data_type, field_length, precision, number_range, required))
+
+
+def _study_specific_forms_row(record, attributes):
+    """The complete StudySpecificFormsRow of an item record and its derived attributes."""
+    row, profile = record
+    data_type, field_length, precision, number_range, is_required = attributes
+    return row._replace(
+        data_type=data_type,
+        field_length=field_length,
+        precision=precision,
+        codelist_choice_labels=profile.codelist_content,
+        range_min_max=number_range,
+        query_future_date=check_query_future_date(data_type),
+        required=is_required,
+        open_query_when_blank="Form,Item" if is_required == "Y" else "",
+    )
 
-    all_item_rows = []
-    for form in extracted_forms:
-        items = extract_items_from_form(form['Form_Node'])
-        if not items:
-            items.append({"Item Name": "", "Option_TD_Node": None, "Item Group": ""})
-        items = assign_item_order(items)
-        item_group_counts, repeating_groups = analyze_item_groups_per_form(items)
-
-        for item in items:
-            option_node = item.get("Option_TD_Node")
-            item_name = item['Item Name']
-            item_group_value = item.get("Item Group", "") or 'NaN'
-            item_group_repeating_flag = get_item_group_repeating_flag(item_group_value, repeating_groups)
-            repeat_maximum = get_repeat_maximum(item_group_value, item_group_repeating_flag, item_group_counts)
-            item_order = item.get('Item_Order', 1)
-
-            codelist_content = get_all_lbody_values(option_node)
-            data_type = determine_data_type(option_node, codelist_content)
-            field_length = calculate_field_length(codelist_content) if data_type in ["Text", "Label"] else ""
-            precision = calculate_precision(codelist_content) if data_type == "Label" else ""
-            number_range = extract_number_range(codelist_content) if data_type == "Label" else ""
-            query_future_date = check_query_future_date(data_type)
-            is_required = check_required_field(item_name)
-
-            row_dict = {
-                'CTDM Optional, if blank CDP to propose': form['Form Label'],
-                'Input needed from SDTM': form['Form Name'],
-                'CDAI input needed': item_group_value,
-                'Unnamed: 4': item_group_repeating_flag,
-                'Unnamed: 5': repeat_maximum,
-                'Unnamed: 8': item_order,
-                'Unnamed: 9': item_name,
-                'Unnamed: 10': "",
-                'Unnamed: 16': data_type,
-                'Unnamed: 17': field_length,
-                'Unnamed: 18': precision,
-                'Unnamed: 19': codelist_content,
-                'Unnamed: 23': number_range,
-                'Unnamed: 24': query_future_date,
-                'Unnamed: 25': is_required,
-                'Unnamed: 26': "Form,Item" if is_required == "Y" else "",
-                'Unnamed: 27': "",
-            }
-            all_item_rows.append(row_dict)
 
-    # Map row_dict to ordered subheaders
-    groups = get_groups_spec()
-    ordered_subheaders = []
-    for g in groups:
-        ordered_subheaders.extend(g["subheaders"])
-
-    def gv(d, key, default=""):
-        return d.get(key, default)
-
-    rows: list = []
-    for row_dict in all_item_rows:
-        values_by_subheader = {
-            # Source
-            "New or Copied from Study": "",
-            # Form
-            "Form Label": gv(row_dict, "CTDM Optional, if blank CDP to propose"),
-            "Form Name (provided by SDTM Programmer, if SDTM linked form)": gv(row_dict, "Input needed from SDTM"),
-            # Item Group
-            "Item Group (if only one on form, recommend same as Form Label)": gv(row_dict, "CDAI input needed"),
-            "Item group Repeating": gv(row_dict, "Unnamed: 4"),
-            "Repeat Maximum, if known, else default =50": gv(row_dict, "Unnamed: 5"),
-            "Display format of repeating item group (Grid, read only, form)": gv(row_dict, "Unnamed: 6"),
-            "Default Data in repeating item group": gv(row_dict, "Unnamed: 7"),
-            # Item
-            "Item Order": gv(row_dict, "Unnamed: 8"),
-            "Item Label": gv(row_dict, "Unnamed: 9"),
-            "Item Name (provided by SDTM Programmer, if SDTM linked item)": gv(row_dict, "Unnamed: 10"),
-            # Progressive Display
-            "Progressively displayed?": gv(row_dict, "Unnamed: 12"),
-            "Controlling item (item triggering it, if yes, describe item below)": gv(row_dict, "Unnamed: 13"),
-            "Controlling item value": gv(row_dict, "Unnamed: 14"),
-            # Data Type
-            "Data type": gv(row_dict, "Unnamed: 16"),
-            "If text or number, Field Length": gv(row_dict, "Unnamed: 17"),
-            "If number, Precision (decimal places)": gv(row_dict, "Unnamed: 18"),
-            # Codelist
-            "Codelist – Choice Labels (if binary, can use Goodlist Table)": gv(row_dict, "Unnamed: 19"),
-            "Codelist Name (provided by SDTM Programmer)": gv(row_dict, "Unnamed: 20"),
-            "Choice Code (provided by SDTM Programmer)": gv(row_dict, "Unnamed: 21"),
-            "Codelist Control Type": gv(row_dict, "Unnamed: 22"),
-            # System Queries
-            "If number, Range: Min Value / Max Value": gv(row_dict, "Unnamed: 23"),
-            "Date: Query Future Date": gv(row_dict, "Unnamed: 24"),
-            "Required": gv(row_dict, "Unnamed: 25"),
-            "If Required, Open Query when intentionally left blank (form/item)": gv(row_dict, "Unnamed: 26"),
-            # Notes
-            "Notes": gv(row_dict, "Unnamed: 27"),
-        }
-        rows.append([values_by_subheader.get(h, "") for h in ordered_subheaders])
+def _form_rows(form, items, rules):
+    """Study Specific Forms rows of one form's items (map_forms job)."""
+    return [_study_specific_forms_row(record, derive_item_attributes(record[1], record[0].item_label))
+            for record in _form_item_records(form, items, rules)]
+
+
+def iter_study_specific_forms_rows(
+    json_file_path: str,
+    config_path: str = "./config/config_study_specific_forms.json",
+    workers: int = 1,
+    ecrf_stats: Optional[dict] = None,
+):
+    """
+    Yield the Study Specific Forms rows form by form, each as a
+    StudySpecificFormsRow (values in the grouped header's subheader order). Streaming writers consume
+    the rows as they are built, so memory does not grow with the item count.
+    workers > 1 builds the forms' rows on a process pool (see map_forms).
+    ecrf_stats: see iter_study_specific_forms_items.
+    """
+    if workers <= 1:
+        for record in iter_study_specific_forms_items(json_file_path, config_path=config_path, ecrf_stats=ecrf_stats):
+            yield _study_specific_forms_row(record, derive_item_attributes(record[1], record[0].item_label))
+        return
+    scan = _load_ecrf_scan(json_file_path, config_path, collect_tables=False)
+    if ecrf_stats is not None:
+        ecrf_stats.update(scan.counts)
+    for form_rows in map_forms(_form_rows, scan.forms(), workers, scan):
+        yield from form_rows
 
-    return rows
 
+def prepare_study_specific_forms_rows(
+    json_file_path: str,
+    config_path: str = "./config/config_study_specific_forms.json",
+    batch: bool = True,
+    workers: int = 1,
+):
+    """
+    Build all Study Specific Forms rows (values only) in the same order as the
+    grouped header layout, for callers that need them more than once (preview,
+    stage cache, tabular export). Streaming writers should iterate
+    iter_study_specific_forms_rows instead.
+    With batch (default) the item attributes of the whole eCRF are derived
+    column-wise (derive_item_attributes_batch) instead of item by item;
+    workers > 1 instead builds the forms' rows on a process pool.
+    Returns: StudySpecificFormsRows (each row in the ordered subheaders, with
+    the eCRF scan's counts).
+    """
+    ecrf_stats = {}
+    if not batch or workers > 1:
+        rows = list(iter_study_specific_forms_rows(json_file_path, config_path=config_path, workers=workers, ecrf_stats=ecrf_stats))
+        return StudySpecificFormsRows(rows, ecrf_stats=ecrf_stats)
+    records = list(iter_study_specific_forms_items(json_file_path, config_path=config_path, ecrf_stats=ecrf_stats))
+    attributes = derive_item_attributes_batch([r[1] for r in records], [r[0].item_label for r in records])
+    rows = (_study_specific_forms_row(record, attrs) for record, attrs in zip(records, attributes))
+    return StudySpecificFormsRows(rows, ecrf_stats=ecrf_stats)
 
 
 if __name__ == "__main__":
@@ -20,15 +20,20 @@ import sys
 import json
 import logging
 import argparse
+import contextlib
+import time
 from typing import Dict, Any, Optional, List
 from pathlib import Path
 import tempfile
+import tracemalloc
 import shutil
+import zipfile
+from copy import copy
 from openpyxl import load_workbook
 from openpyxl.worksheet.worksheet import Worksheet
 from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
 from openpyxl.utils import get_column_letter
-from openpyxl.cell.cell import MergedCell
+from openpyxl.cell.cell import Cell, MergedCell
 
 # Reuse existing modules for schedule grid pipeline
 from modules.form_extractor import extract_forms
@@ -36,8 +41,31 @@ from modules.soa_parser import parse_soa
 from modules.common_matrix import merge_common_matrix
 from modules.event_grouping import group_events
 from modules.schedule_layout import generate_schedule_grid as build_schedule_grid_file
-from modules.schedule_layout import generate_schedule_grid_stream
-from Final_study_specific_form import prepare_study_specific_forms_rows, write_study_specific_forms_stream
+from modules.schedule_layout import generate_schedule_grid_stream, build_schedule_grid_rows, SCHEDULE_GRID_FORMATS
+from modules.stage_graph import Stage, run_stage_graph
+from modules.stage_cache import StageCache, apply_stage_cache, code_version, CACHE_POLICIES
+from modules.stage_profile import StageProfiler, apply_stage_profiling, profiled
+from modules.run_report import RunReport, default_report_path, document_statistics, measured
+from modules.batch import load_manifest, run_batch, write_summary
+from modules.tabular_export import EXPORT_FORMATS, check_export_formats, export_ptd_tables
+from modules.watch import DEFAULT_INTERVAL as WATCH_INTERVAL, watch_files
+from modules.output_mode import choose_output_mode, check_memory_budget, MemoryBudgetExceeded
+from modules.zip_deflate import COMPRESSION_LEVELS, DeflateOptions, open_xlsxwriter_workbook
+from modules.template_cache import PreparsedTemplate, load_template, CONTENT_TYPES_MEMBER, WORKBOOK_RELS_MEMBER
+from modules.xlsx_xml import (
+    StyleTable, SharedStrings, add_shared_strings_part, remove_part, shared_string_items,
+    transplant_sheet_xml, write_sheet_xml, write_new_workbook,
+)
+from Final_study_specific_form import (
+    prepare_clinical_forms_rows,
+    write_clinical_forms_xlsx,
+    prepare_study_specific_forms_rows,
+    iter_study_specific_forms_rows,
+    write_study_specific_forms_stream,
+    get_groups_spec,
+    build_study_specific_forms_sheet_rows,
+    STUDY_SPECIFIC_FORMS_FORMATS,
+)
 
 
 def load_json(file_path: str) -> Dict[str, Any]:
@@ -45,10 +73,22 @@ def load_json(file_path: str) -> Dict[str, Any]:
         return json.load(f)
 
 
+# Parsed configs by path, reused while the file is unchanged (batch/long-lived workers)
+_CONFIG_CACHE: Dict[str, Any] = {}
+
+
 def load_config(config_path: str) -> Dict[str, Any]:
+    """Load a JSON config ({} with a warning if missing or invalid); the result is shared, treat it as read-only."""
     try:
+        st = os.stat(config_path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        cached = _CONFIG_CACHE.get(config_path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
         with open(config_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+            config = json.load(f)
+        _CONFIG_CACHE[config_path] = (stamp, config)
+        return config
     except FileNotFoundError:
         logging.warning(f"Config file not found: {config_path}; using defaults")
         return {}
@@ -66,180 +106,275 @@ def setup_logging(level: str = "INFO") -> None:
             logging.FileHandler("ptd_generation.log")
         ]
     )
-def _col_to_letter(n: int) -> str:
-    """1-based column index to Excel letters."""
-    result = []
-    while n:
-        n, rem = divmod(n - 1, 26)
-        result.append(chr(65 + rem))
-    return ''.join(reversed(result))
-
-
-def _write_minimal_sheet_xml_from_rows(rows_iter, out_path: str) -> None:
-    """
-    Write a minimal worksheet XML with inline strings and numeric values only.
-    Avoids sharedStrings/styles to keep it self-contained and low memory.
-    rows_iter yields lists/tuples of cell values per row (1-based rows assumed sequential).
-    """
-    import html
-
-    ns = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
-    with open(out_path, 'w', encoding='utf-8') as f:
-        f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>')
-        f.write(f'<worksheet xmlns="{ns}">')
-        f.write('<sheetData>')
-        row_idx = 0
-        for row in rows_iter:
-            row_idx += 1
-            if row is None:
-                continue
-            f.write(f'<row r="{row_idx}">')
-            for col_idx, val in enumerate(row, start=1):
-                if val is None or val == '':
-                    continue
-                cell_ref = f'{_col_to_letter(col_idx)}{row_idx}'
-                # Numbers vs strings
-                is_number = isinstance(val, (int, float)) and not (isinstance(val, float) and (val != val or val in (float("inf"), float("-inf"))))
-                if is_number:
-                    f.write(f'<c r="{cell_ref}"><v>{val}</v></c>')
-                else:
-                    text = html.escape(str(val))
-                    f.write(f'<c r="{cell_ref}" t="inlineStr"><is><t>{text}</t></is></c>')
-            f.write('</row>')
-        f.write('</sheetData>')
-        f.write('</worksheet>')
-
-
-def _iter_rows_from_xlsx_sheet(xlsx_path: str):
-    """Yield rows as lists from the first worksheet of an XLSX file in read-only mode."""
-    from openpyxl import load_workbook
-    wb = load_workbook(xlsx_path, read_only=True, data_only=True)
-    try:
-        ws = wb.worksheets[0]
-        for row in ws.iter_rows(values_only=True):
-            yield list(row)
-    finally:
-        try:
-            wb.close()
-        except Exception:
-            pass
-
-
-
 def ensure_output_dir(output_path: str) -> None:
     out_dir = os.path.dirname(output_path)
     if out_dir:
         Path(out_dir).mkdir(parents=True, exist_ok=True)
 
 
-def run_schedule_grid_pipeline(
+SCHEDULE_CONFIG_FILES = {
+    'form_extractor': 'config_form_extractor.json',
+    'soa_parser': 'config_soa_parser.json',
+    'common_matrix': 'config_common_matrix.json',
+    'event_grouping': 'config_event_grouping.json',
+    'schedule_layout': 'config_schedule_layout.json'
+}
+
+
+@contextlib.contextmanager
+def _pipeline_step(profiler: Optional[StageProfiler], report: Optional[RunReport], step_name: str):
+    """Profile (--profile) and measure (run report) a step that runs outside the stage graph."""
+    with profiled(profiler, step_name), measured(report, step_name):
+        yield
+
+
+def build_ptd_stages(
     protocol_json: str,
     ecrf_json: str,
-    final_output_xlsx: str,
     config_dir: str,
-    for_stream: bool = False,
-) -> Any:
-    """
-    Reuse the existing 5-stage pipeline to produce inputs and/or the schedule grid.
-
-    When for_stream=False (default):
-        - Produces the schedule grid Excel at final_output_xlsx and returns its absolute path.
-    When for_stream=True:
-        - Produces intermediates needed for streaming (visits_xlsx, matrix_csv) and returns
-          a dict { 'visits_xlsx', 'matrix_csv', 'temp_dir' }. The final schedule grid file
-          is not built to save time/memory.
-    """
-    config_files = {
-        'form_extractor': 'config_form_extractor.json',
-        'soa_parser': 'config_soa_parser.json',
-        'common_matrix': 'config_common_matrix.json',
-        'event_grouping': 'config_event_grouping.json',
-        'schedule_layout': 'config_schedule_layout.json'
-    }
-
+    work_dir: str,
+    schedule_output_xlsx: Optional[str] = None,
+    forms_output: Optional[str] = None,
+    format_forms: bool = False,
+    forms_workers: int = 1,
+    cache: Optional[StageCache] = None,
+) -> List[Stage]:
+    """
+    Declare the PTD pipeline as a stage graph.
+
+    Intermediates are written under work_dir. The schedule layout stage is only
+    added when schedule_output_xlsx is given. forms_output selects the
+    study-specific-forms stage: "rows" (values for streaming writers), "xlsx"
+    (the rows with the Codelist control type plus the formatted temp workbook
+    written from them for template mode) or None (not built);
+    format_forms applies the final forms-sheet formatting in the xlsx stage;
+    forms_workers > 1 builds the forms on a process pool of that size. cache
+    is the stage cache the forms workbook is kept in (the other stages are
+    wrapped with apply_stage_cache by the caller).
+
+    Artifacts: forms_csv, schedule_csv, matrix_csv, visits_xlsx, and optionally
+    schedule_xlsx, forms_rows and forms_xlsx.
+    """
     configs: Dict[str, Any] = {}
-    for key, filename in config_files.items():
+    for key, filename in SCHEDULE_CONFIG_FILES.items():
         configs[key] = load_config(os.path.join(config_dir, filename))
 
-    temp_dir = tempfile.mkdtemp(prefix="ptd_intermediate_")
-    intermediates: List[str] = []
+    stages = [
+        Stage('extract_forms', extract_forms, provides='forms_csv', output_param='output_csv', kwargs={
+            'ecrf_json': ecrf_json,
+            'output_csv': os.path.join(work_dir, "extracted_forms.csv"),
+            'config': configs.get('form_extractor', {}),
+        }),
+        Stage('parse_soa', parse_soa, provides='schedule_csv', output_param='output_csv', kwargs={
+            'protocol_json': protocol_json,
+            'output_csv': os.path.join(work_dir, "schedule.csv"),
+            'config': configs.get('soa_parser', {}),
+        }),
+        Stage('merge_common_matrix', merge_common_matrix, provides='matrix_csv', output_param='output_csv',
+              requires={'ecrf_csv': 'forms_csv', 'schedule_csv': 'schedule_csv'}, kwargs={
+                  'output_csv': os.path.join(work_dir, "soa_matrix.csv"),
+                  'config': configs.get('common_matrix', {}),
+              }),
+        Stage('group_events', group_events, provides='visits_xlsx', output_param='output_xlsx', kwargs={
+            'protocol_json': protocol_json,
+            'output_xlsx': os.path.join(work_dir, "visits_with_groups.xlsx"),
+            'config': configs.get('event_grouping', {}),
+        }),
+    ]
+    if schedule_output_xlsx:
+        stages.append(Stage('schedule_layout', build_schedule_grid_file, provides='schedule_xlsx', output_param='output_xlsx',
+                            requires={'visits_xlsx': 'visits_xlsx', 'forms_csv': 'matrix_csv'}, kwargs={
+                                'output_xlsx': schedule_output_xlsx,
+                                'config': configs.get('schedule_layout', {}),
+                            }))
+    forms_config = os.path.join(config_dir, 'config_study_specific_forms.json')
+    if forms_output == "rows":
+        stages.append(Stage('study_specific_forms', prepare_study_specific_forms_rows, provides='forms_rows', kwargs={
+            'json_file_path': ecrf_json,
+            'config_path': forms_config,
+            'workers': forms_workers,
+        }))
+    elif forms_output == "xlsx":
+        # Built once: the template's forms workbook and the tabular export both take these rows
+        stages.append(Stage('study_specific_forms', prepare_clinical_forms_rows, provides='forms_rows', kwargs={
+            'json_file_path': ecrf_json,
+            'config_path': forms_config,
+            'workers': forms_workers,
+        }))
+        # Depends on the eCRF only, so protocol-only reruns reuse the cached workbook
+        forms_xlsx_key = cache.key_for('study_specific_forms_xlsx', generate_study_specific_forms_xlsx, {
+            'ecrf_json': ecrf_json,
+            'config': forms_config,
+            'format_sheet': format_forms,
+            'layout_code': code_version(write_clinical_forms_xlsx),
+        }) if cache is not None else None
+        stages.append(Stage('study_specific_forms_xlsx', generate_study_specific_forms_xlsx, provides='forms_xlsx',
+                            requires={'items_rows': 'forms_rows'}, cacheable=False, kwargs={
+                                'output_xlsx': os.path.join(work_dir, "study_specific_forms.xlsx"),
+                                'format_sheet': format_forms,
+                                'cache': cache,
+                                'cache_key': forms_xlsx_key,
+                            }))
+    return stages
+
+
+def build_ptd_preview(protocol_json: str, ecrf_json: str, config_dir: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Run the pipeline up to the layout stage and return both sheets as plain values,
+    without building any output workbook. Used by the backend preview endpoint.
+
+    Returns a dict:
+        'schedule_grid': { 'rows', 'merges', 'freeze_panes', 'num_cols' } where rows are
+                         lists of cell values and merges are zero-based ranges
+        'study_specific_forms': { 'groups', 'columns', 'rows' } where groups are
+                         (name, span) pairs for the grouped header
+    """
+    if config_dir is None:
+        config_dir = os.path.join(os.path.dirname(__file__), "config")
+    cache = StageCache.from_settings()
+
+    work_dir = tempfile.mkdtemp(prefix="ptd_intermediate_")
     try:
-        forms_csv = os.path.join(temp_dir, "extracted_forms.csv")
-        extract_forms(ecrf_json=ecrf_json, output_csv=forms_csv, config=configs.get('form_extractor', {}))
-        intermediates.append(forms_csv)
-
-        schedule_csv = os.path.join(temp_dir, "schedule.csv")
-        parse_soa(protocol_json=protocol_json, output_csv=schedule_csv, config=configs.get('soa_parser', {}))
-        intermediates.append(schedule_csv)
-
-        matrix_csv = os.path.join(temp_dir, "soa_matrix.csv")
-        merge_common_matrix(ecrf_csv=forms_csv, schedule_csv=schedule_csv, output_csv=matrix_csv, config=configs.get('common_matrix', {}))
-        intermediates.append(matrix_csv)
-
-        visits_xlsx = os.path.join(temp_dir, "visits_with_groups.xlsx")
-        group_events(protocol_json=protocol_json, output_xlsx=visits_xlsx, config=configs.get('event_grouping', {}))
-        intermediates.append(visits_xlsx)
-
-        if for_stream:
-            # Return the two inputs required for streaming writer; do NOT build final workbook
-            return {
-                'visits_xlsx': visits_xlsx,
-                'matrix_csv': matrix_csv,
-                'temp_dir': temp_dir,
-                'intermediates': list(intermediates),
-            }
-        else:
-            ensure_output_dir(final_output_xlsx)
-            build_schedule_grid_file(
-                visits_xlsx=visits_xlsx,
-                forms_csv=matrix_csv,
-                output_xlsx=final_output_xlsx,
-                config=configs.get('schedule_layout', {}),
-            )
-            return os.path.abspath(final_output_xlsx)
+        stages = build_ptd_stages(
+            protocol_json=protocol_json,
+            ecrf_json=ecrf_json,
+            config_dir=config_dir,
+            work_dir=work_dir,
+            forms_output="rows",
+        )
+        artifacts, _ = run_stage_graph(apply_stage_cache(stages, cache))
+        grid = build_schedule_grid_rows(
+            visits_xlsx=artifacts['visits_xlsx'],
+            forms_csv=artifacts['matrix_csv'],
+            config=load_config(os.path.join(config_dir, "config_schedule_layout.json")),
+        )
+        grid_rows = [[value for value, _ in row] for row in grid['rows']]
     finally:
-        # Best-effort cleanup; keep intermediates when for_stream
-        if not for_stream:
-            for p in intermediates:
-                try:
-                    if os.path.exists(p):
-                        os.remove(p)
-                except Exception:
-                    pass
-            try:
-                shutil.rmtree(temp_dir)
-            except Exception:
-                pass
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    forms_rows = artifacts['forms_rows']
+    groups = get_groups_spec()
+    return {
+        'schedule_grid': {
+            'rows': grid_rows,
+            'merges': grid['merges'],
+            'freeze_panes': grid['freeze_panes'],
+            'num_cols': grid['num_cols'],
+        },
+        'study_specific_forms': {
+            'groups': [(g['name'], len(g['subheaders'])) for g in groups],
+            'columns': [h for g in groups for h in g['subheaders']],
+            'rows': forms_rows,
+        },
+    }
 
 
-def generate_study_specific_forms_xlsx(ecrf_json: str) -> str:
+def generate_study_specific_forms_xlsx(items_rows, output_xlsx: str, format_sheet: bool = False,
+                                       cache: Optional[StageCache] = None, cache_key: Optional[str] = None) -> str:
     """
-    Reuse logic from Final_study_specific_form.py by invoking its processing function to
-    produce an Excel file. Returns the path to the generated temp Excel.
+    Write the rows of prepare_clinical_forms_rows as the Study Specific Forms
+    workbook of Final_study_specific_form.process_clinical_forms. Returns
+    output_xlsx.
+
+    With format_sheet, format_forms_sheet is applied before the workbook is
+    saved, so the template copy needs no second load/save to format it.
+    With cache, the workbook is taken from or stored under cache_key, which
+    build_ptd_stages derives from the rows' inputs (eCRF, forms config, code)
+    so that a hit does not hash the rows themselves.
     """
-    # Import here to avoid executing module-level code unless needed
-    import importlib.util
-
-    module_path = os.path.join(os.path.dirname(__file__), 'Final_study_specific_form.py')
-    spec = importlib.util.spec_from_file_location("Final_study_specific_form", module_path)
-    if spec is None or spec.loader is None:
-        raise RuntimeError("Unable to load Final_study_specific_form.py")
-    mod = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(mod)
+    if cache is not None and cache_key:
+        hit, _ = cache.lookup(cache_key, output_xlsx)
+        if hit:
+            logging.info(f"Cache hit for stage 'study_specific_forms_xlsx' ({cache_key[:12]})")
+            return output_xlsx
+        logging.info(f"Cache miss for stage 'study_specific_forms_xlsx' ({cache_key[:12]})")
+    write_clinical_forms_xlsx(items_rows, output_xlsx, format_sheet=format_forms_sheet if format_sheet else None)
+    if cache is not None and cache_key:
+        cache.store(cache_key, 'study_specific_forms_xlsx', output_xlsx, output_xlsx)
+    return output_xlsx
 
-    temp_dir = tempfile.mkdtemp(prefix="ptd_forms_")
-    output_xlsx = os.path.join(temp_dir, "study_specific_forms.xlsx")
 
-    # The script's API function writes the Excel; keep its computation logic intact
-    config_rules = os.path.join(os.path.dirname(__file__), 'config', 'config_study_specific_forms.json')
-    # Avoid hardcoded/unnecessary template path; rely on the module's internal template
-    mod.process_clinical_forms(ecrf_json, output_csv_path=output_xlsx, config_path=config_rules)
-    return output_xlsx
+def study_specific_forms_rows_source(artifacts: Dict[str, Any], ecrf_json: str, config_dir: str, workers: int = 1,
+                                     ecrf_stats: Optional[Dict[str, int]] = None):
+    """
+    The forms rows built by the stage graph when it built them (they are
+    reused by the tabular export), otherwise a generator that extracts them
+    form by form (on a process pool with workers > 1) while the sheet writer
+    consumes them; the generator fills ecrf_stats with the eCRF scan's counts.
+    """
+    if artifacts.get('forms_rows') is not None:
+        return artifacts['forms_rows']
+    return iter_study_specific_forms_rows(
+        ecrf_json, config_path=os.path.join(config_dir, 'config_study_specific_forms.json'), workers=workers,
+        ecrf_stats=ecrf_stats)
 
 
 ## Removed: unused header renaming/ordering helper.
 
 
+def _build_cell_style(cell, dcell) -> None:
+    """Rebuild cell's font, alignment, fill, border and number format on dcell."""
+    if cell.font:
+        dcell.font = Font(
+            name=cell.font.name,
+            size=cell.font.size,
+            bold=cell.font.bold,
+            italic=cell.font.italic,
+            vertAlign=cell.font.vertAlign,
+            underline=cell.font.underline,
+            strike=cell.font.strike,
+            color=cell.font.color,
+        )
+    if cell.alignment:
+        dcell.alignment = Alignment(
+            horizontal=cell.alignment.horizontal,
+            vertical=cell.alignment.vertical,
+            text_rotation=cell.alignment.text_rotation,
+            wrap_text=cell.alignment.wrap_text,
+            shrink_to_fit=cell.alignment.shrink_to_fit,
+            indent=cell.alignment.indent,
+        )
+    if cell.fill and cell.fill.fill_type:
+        dcell.fill = PatternFill(
+            fill_type=cell.fill.fill_type,
+            start_color=cell.fill.start_color,
+            end_color=cell.fill.end_color,
+        )
+    if cell.border:
+        left = cell.border.left
+        right = cell.border.right
+        top = cell.border.top
+        bottom = cell.border.bottom
+        dcell.border = Border(
+            left=Side(style=left.style, color=left.color),
+            right=Side(style=right.style, color=right.color),
+            top=Side(style=top.style, color=top.color),
+            bottom=Side(style=bottom.style, color=bottom.color),
+        )
+    if cell.number_format:
+        dcell.number_format = cell.number_format
+
+
+def _copy_cell_style(cell, dcell, style_cache: Dict[tuple, Any]) -> None:
+    """
+    Give dcell the style of cell, building each distinct source style only once.
+
+    style_cache maps a source style (its workbook style-id tuple) to the
+    destination workbook's style array; it must be used for a single
+    source/destination workbook pair.
+    """
+    style_array = getattr(cell, 'style_array', None)  # read-only cells
+    if style_array is None:
+        style_array = cell._style
+    key = tuple(style_array)
+    cached = style_cache.get(key)
+    if cached is None:
+        _build_cell_style(cell, dcell)
+        style_cache[key] = copy(dcell._style)
+    else:
+        dcell._style = copy(cached)
+
+
 def _copy_worksheet_contents(src_ws: Worksheet, dest_ws: Worksheet) -> None:
     """Copy values, styles, merged cells, and dimensions from src_ws to dest_ws."""
     # Copy column widths
@@ -252,57 +387,20 @@ def _copy_worksheet_contents(src_ws: Worksheet, dest_ws: Worksheet) -> None:
         if getattr(dim, 'height', None):
             dest_ws.row_dimensions[idx].height = dim.height
 
-    # Copy merged ranges first (structure)
-    for merged_range in src_ws.merged_cells.ranges:
-        dest_ws.merge_cells(str(merged_range))
-
-    # Copy cell contents and styles
+    # Copy cell contents and styles, one appended row at a time
+    style_cache: Dict[tuple, Any] = {}
     for row in src_ws.iter_rows():
+        out_row = []
         for cell in row:
-            # Skip non-top-left merged cells; the range has already been created
-            if isinstance(cell, MergedCell):
-                continue
-            dcell = dest_ws.cell(row=cell.row, column=cell.column, value=cell.value)
+            dcell = Cell(dest_ws, value=None if isinstance(cell, MergedCell) else cell.value)
             if cell.has_style:
-                if cell.font:
-                    dcell.font = Font(
-                        name=cell.font.name,
-                        size=cell.font.size,
-                        bold=cell.font.bold,
-                        italic=cell.font.italic,
-                        vertAlign=cell.font.vertAlign,
-                        underline=cell.font.underline,
-                        strike=cell.font.strike,
-                        color=cell.font.color,
-                    )
-                if cell.alignment:
-                    dcell.alignment = Alignment(
-                        horizontal=cell.alignment.horizontal,
-                        vertical=cell.alignment.vertical,
-                        text_rotation=cell.alignment.text_rotation,
-                        wrap_text=cell.alignment.wrap_text,
-                        shrink_to_fit=cell.alignment.shrink_to_fit,
-                        indent=cell.alignment.indent,
-                    )
-                if cell.fill and cell.fill.fill_type:
-                    dcell.fill = PatternFill(
-                        fill_type=cell.fill.fill_type,
-                        start_color=cell.fill.start_color,
-                        end_color=cell.fill.end_color,
-                    )
-                if cell.border:
-                    left = cell.border.left
-                    right = cell.border.right
-                    top = cell.border.top
-                    bottom = cell.border.bottom
-                    dcell.border = Border(
-                        left=Side(style=left.style, color=left.color),
-                        right=Side(style=right.style, color=right.color),
-                        top=Side(style=top.style, color=top.color),
-                        bottom=Side(style=bottom.style, color=bottom.color),
-                    )
-                if cell.number_format:
-                    dcell.number_format = cell.number_format
+                _copy_cell_style(cell, dcell, style_cache)
+            out_row.append(dcell)
+        dest_ws.append(out_row)
+
+    # Merged ranges last, so their edge cells pick up the top-left cell's borders
+    for merged_range in src_ws.merged_cells.ranges:
+        dest_ws.merge_cells(str(merged_range))
 
 
 def _copy_worksheet_values_only(src_ws: Worksheet, dest_ws: Worksheet) -> None:
@@ -341,50 +439,12 @@ def _copy_header_styles(src_ws: Worksheet, dest_ws: Worksheet, max_header_rows:
     if max_header_rows <= 0:
         return
     rows_to_copy = min(max_header_rows, src_ws.max_row)
+    style_cache: Dict[tuple, Any] = {}
     for r in range(1, rows_to_copy + 1):
         for cell in src_ws[r]:
             try:
-                dcell = dest_ws.cell(row=cell.row, column=cell.column)
                 if cell.has_style:
-                    if cell.font:
-                        dcell.font = Font(
-                            name=cell.font.name,
-                            size=cell.font.size,
-                            bold=cell.font.bold,
-                            italic=cell.font.italic,
-                            vertAlign=cell.font.vertAlign,
-                            underline=cell.font.underline,
-                            strike=cell.font.strike,
-                            color=cell.font.color,
-                        )
-                    if cell.alignment:
-                        dcell.alignment = Alignment(
-                            horizontal=cell.alignment.horizontal,
-                            vertical=cell.alignment.vertical,
-                            text_rotation=cell.alignment.text_rotation,
-                            wrap_text=cell.alignment.wrap_text,
-                            shrink_to_fit=cell.alignment.shrink_to_fit,
-                            indent=cell.alignment.indent,
-                        )
-                    if cell.fill and cell.fill.fill_type:
-                        dcell.fill = PatternFill(
-                            fill_type=cell.fill.fill_type,
-                            start_color=cell.fill.start_color,
-                            end_color=cell.fill.end_color,
-                        )
-                    if cell.border:
-                        left = cell.border.left
-                        right = cell.border.right
-                        top = cell.border.top
-                        bottom = cell.border.bottom
-                        dcell.border = Border(
-                            left=Side(style=left.style, color=left.color),
-                            right=Side(style=right.style, color=right.color),
-                            top=Side(style=top.style, color=top.color),
-                            bottom=Side(style=bottom.style, color=bottom.color),
-                        )
-                    if cell.number_format:
-                        dcell.number_format = cell.number_format
+                    _copy_cell_style(cell, dest_ws.cell(row=cell.row, column=cell.column), style_cache)
             except Exception:
                 # Best-effort; continue
                 pass
@@ -398,14 +458,44 @@ def replace_sheets_in_template(
     schedule_sheet_name: str = "Schedule Grid",
     forms_sheet_name: str = "Study Specific Forms",
     fast: bool = False,
+    memory_budget: Optional[int] = None,
+    template_cache: Optional[StageCache] = None,
+    compression: Optional[DeflateOptions] = None,
+    part_cache: Optional[StageCache] = None,
 ) -> str:
     """
-    Load the template workbook, remove existing target sheets if present, copy
-    the generated schedule and forms worksheets (including styles, merges, and
-    dimensions) into the template, preserve all other sheets, and save to out_xlsx.
-    Returns the absolute path to the saved workbook.
+    Replace the schedule and forms sheets of the template with the generated
+    worksheets (including styles, merges, and dimensions), preserve all other
+    sheets, and save to out_xlsx. Returns the absolute path to the saved workbook.
+
+    The template is taken pre-parsed from modules.template_cache (keyed by its
+    contents, kept in template_cache when given) and the generated
+    sheets are transplanted as XML, so only they are rewritten (--fast has
+    already taken effect by then: its forms workbook skipped the formatting
+    pass). When that is not possible (a target sheet is missing from
+    the template, or a generated sheet has relationships of its own) the
+    template is loaded with openpyxl, the target sheets are removed and
+    re-created, and the generated contents copied in (values plus header
+    styles only when fast). compression applies to the transplanted parts;
+    with part_cache, the transplanted sheet parts are reused when a generated
+    workbook and the template's style indices are unchanged.
+
+    With memory_budget (bytes), raises MemoryBudgetExceeded before saving if
+    the process grows past it, leaving out_xlsx untouched.
     """
     ensure_output_dir(out_xlsx)
+    try:
+        template = load_template(template_xlsx, template_cache)
+        return transplant_sheets_into_template(
+            template,
+            {schedule_sheet_name: schedule_xlsx, forms_sheet_name: forms_xlsx},
+            out_xlsx,
+            memory_budget=memory_budget,
+            compression=compression,
+            part_cache=part_cache,
+        )
+    except (KeyError, ValueError) as e:
+        logging.info(f"Sheet transplant not possible ({e}); copying sheets through openpyxl")
 
     # Use read_only to reduce memory; for fast path we copy only values+header styles
     wb_template = load_workbook(template_xlsx, read_only=False)
@@ -413,6 +503,7 @@ def replace_sheets_in_template(
     wb_forms = load_workbook(forms_xlsx, read_only=(fast is True), data_only=True)
 
     try:
+        check_memory_budget(memory_budget, "after loading workbooks")
         # Determine insertion indices to preserve original order if sheets existed
         schedule_index = None
         forms_index = None
@@ -447,6 +538,7 @@ def replace_sheets_in_template(
         else:
             _copy_worksheet_contents(src_schedule, dest_schedule)
             _copy_worksheet_contents(src_forms, dest_forms)
+        check_memory_budget(memory_budget, "after copying sheets")
 
         wb_template.save(out_xlsx)
         return os.path.abspath(out_xlsx)
@@ -469,154 +561,504 @@ def auto_format_sheet(sheet: Worksheet, header_rows: int = 1, skip_fill_rows=Non
     """Auto-fit columns, style headers (one or more rows), and apply borders.
 
     Preserves any existing header fills and avoids filling Row 1 beyond column D.
+    Header styling, data-row styling and the column width scan share a single
+    pass over the cells.
     """
     header_font = Font(bold=True)
     center_align = Alignment(horizontal="center", vertical="center", wrap_text=True)
+    data_align = Alignment(wrap_text=True, vertical="center")
     header_fill = PatternFill(start_color="D9E1F2", end_color="D9E1F2", fill_type="solid")
     thin_border = Border(
         left=Side(style="thin"), right=Side(style="thin"),
         top=Side(style="thin"), bottom=Side(style="thin")
     )
 
-    # Style header rows
     header_rows = max(1, min(header_rows, sheet.max_row))
     skip_fill_rows = skip_fill_rows or set()
-    for r in range(1, header_rows + 1):
-        for cell in sheet[r]:
-            cell.font = header_font
-            cell.alignment = center_align
-            # Preserve pre-existing fills (do not override group colors)
-            try:
-                fill_type = getattr(cell.fill, 'fill_type', None)
-            except Exception:
-                fill_type = None
-            # Do not apply header fill to Row 1 columns beyond D
-            col_idx = cell.column if hasattr(cell, 'column') else cell.col_idx
-            beyond_ctdm = (r == 1 and col_idx and col_idx > 4)
-            if not fill_type and r not in skip_fill_rows and not beyond_ctdm:
-                cell.fill = header_fill
+    max_column = sheet.max_column
+    max_lengths = [0] * (max_column + 1)
+    for r, row in enumerate(sheet.iter_rows(min_row=1, max_row=sheet.max_row, max_col=max_column), start=1):
+        header = r <= header_rows
+        for col_idx, cell in enumerate(row, start=1):
+            if header:
+                cell.font = header_font
+                cell.alignment = center_align
+                # Preserve pre-existing fills (do not override group colors);
+                # do not apply header fill to Row 1 columns beyond D
+                try:
+                    fill_type = getattr(cell.fill, 'fill_type', None)
+                except Exception:
+                    fill_type = None
+                beyond_ctdm = (r == 1 and col_idx > 4)
+                if not fill_type and r not in skip_fill_rows and not beyond_ctdm:
+                    cell.fill = header_fill
+            else:
+                cell.alignment = data_align
             cell.border = thin_border
 
-    # Style all data rows
-    for row in sheet.iter_rows(min_row=header_rows + 1, max_row=sheet.max_row, max_col=sheet.max_column):
-        for cell in row:
-            cell.alignment = Alignment(wrap_text=True, vertical="center")
-            cell.border = thin_border
+            if cell.value is not None:
+                try:
+                    val_len = len(str(cell.value))
+                except Exception:
+                    continue
+                if val_len > max_lengths[col_idx]:
+                    max_lengths[col_idx] = val_len
 
     # Auto-adjust column widths
-    for col in sheet.columns:
-        max_length = 0
-        first_cell = next(iter(col))
-        column_letter = get_column_letter(first_cell.column)
-        for cell in col:
-            try:
-                val_len = len(str(cell.value)) if cell.value is not None else 0
-                if val_len > max_length:
-                    max_length = val_len
-            except Exception:
-                pass
-        sheet.column_dimensions[column_letter].width = max(10, min(80, max_length + 3))
+    for col_idx in range(1, max_column + 1):
+        sheet.column_dimensions[get_column_letter(col_idx)].width = max(10, min(80, max_lengths[col_idx] + 3))
 
 
-def finalize_formatting(output_path: str, forms_sheet_name: str = "Study Specific Forms") -> None:
+def format_forms_sheet(sheet: Worksheet) -> None:
     """
-    Apply formatting only to the study-specific forms sheet. The schedule grid
+    Final formatting of the study-specific forms sheet; the schedule grid
     formatting produced by its generator is preserved as-is.
     """
-    wb = load_workbook(output_path)
-    if forms_sheet_name in wb.sheetnames:
-        ws = wb[forms_sheet_name]
-        # Keep the 3 fixed header rows (Row 1 CTDM, Row 2 merged groups, Row 3 subheaders)
-        auto_format_sheet(ws, header_rows=3, skip_fill_rows={})
-    wb.save(output_path)
+    # Keep the 3 fixed header rows (Row 1 CTDM, Row 2 merged groups, Row 3 subheaders)
+    auto_format_sheet(sheet, header_rows=3, skip_fill_rows=set())
+
+
+def _assemble_from_template(
+    template: PreparsedTemplate,
+    out_xlsx: str,
+    sheet_writers: Dict[str, Any],
+    styles: StyleTable,
+    shared_strings: Optional[SharedStrings] = None,
+    compression: Optional[DeflateOptions] = None,
+) -> str:
+    """
+    Write out_xlsx from the pre-parsed template with the named sheets
+    replaced by their writers (callables receiving a text stream), the styles
+    part taken from styles and, when given, the shared strings table written
+    last. A calcChain part is dropped since it may list formula cells of the
+    replaced sheets; Excel rebuilds it. Rewritten parts are compressed per
+    compression (see modules.zip_deflate).
+    """
+    rels_xml = template.text(WORKBOOK_RELS_MEMBER)
+    content_types = template.text(CONTENT_TYPES_MEMBER)
+    omit = []
+    if 'calcChain' in template.parts:
+        omit.append(template.parts['calcChain'])
+        rels_xml, content_types = remove_part(rels_xml, content_types, template.parts['calcChain'])
+
+    parts = {template.sheet_member(name): writer for name, writer in sheet_writers.items()}
+    deferred = []
+    if shared_strings is not None:
+        sst_member = template.parts.get('sharedStrings')
+        if not sst_member:
+            sst_member = 'xl/sharedStrings.xml'
+            rels_xml, content_types = add_shared_strings_part(rels_xml, content_types)
+        # Written last, once the sheets have added their strings
+        parts[sst_member] = lambda f: f.write(shared_strings.to_xml())
+        deferred.append(sst_member)
+
+    # styles.xml is rendered when written, after the sheets registered their formats
+    parts[template.parts['styles']] = lambda f: f.write(styles.to_xml())
+    if rels_xml != template.text(WORKBOOK_RELS_MEMBER):
+        parts[WORKBOOK_RELS_MEMBER] = lambda f: f.write(rels_xml)
+    if content_types != template.text(CONTENT_TYPES_MEMBER):
+        parts[CONTENT_TYPES_MEMBER] = lambda f: f.write(content_types)
+    return template.write(out_xlsx, parts, deferred=deferred, omit=omit, compression=compression)
 
 
 def surgery_replace_sheets_inplace(
     template_xlsx: str,
-    schedule_sheet_name: str,
-    forms_sheet_name: str,
-    schedule_rows_path: str,
-    forms_rows_iter,
+    sheets: Dict[str, Dict[str, Any]],
+    shared_strings: bool = False,
+    out_xlsx: Optional[str] = None,
+    template_cache: Optional[StageCache] = None,
+    compression: Optional[DeflateOptions] = None,
+    part_cache: Optional[StageCache] = None,
+    part_inputs: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> str:
+    """
+    Perform a low-memory zip-level transplant: replace only the target sheet XMLs
+    in the template, leave all other parts intact.
+
+    sheets maps a sheet name to its row model (build_schedule_grid_rows /
+    build_study_specific_forms_sheet_rows). The model's formats are appended to
+    the template's styles.xml and each sheet is streamed with s= style indices,
+    column widths, frozen panes and merged ranges, so the result looks like
+    --stream output inside the template. With shared_strings, repeated labels
+    go to the shared strings table instead of inline strings.
+
+    The new archive is written straight from the pre-parsed template (see
+    modules.template_cache): untouched members are copied as raw compressed
+    bytes and the sheets are streamed into their members from the row
+    iterators, so nothing is extracted to disk and only the rewritten parts are
+    compressed. Writes to out_xlsx (default: the template, in place) and
+    returns its absolute path.
+
+    With part_cache, sheets listed in part_inputs (see sheet_part_inputs) are
+    spliced in from the cache when their fingerprint matches a previous run
+    and stored after rendering otherwise. Parts that use the shared strings
+    table are always rendered.
+    """
+    template = load_template(template_xlsx, template_cache)
+    missing = [name for name in sheets if name not in template.sheet_parts]
+    if missing:
+        raise RuntimeError(f'Target sheet names not found in template workbook: {missing}')
+    if 'styles' not in template.parts:
+        raise RuntimeError('Template workbook has no styles part.')
+
+    # Styles: register every format used by the sheets
+    styles = StyleTable(template.text(template.parts['styles']))
+    style_ids = {name: styles.add_formats(model.get('formats', {})) for name, model in sheets.items()}
+
+    # Shared strings: extend the template's table, or add one
+    sst = None
+    if shared_strings:
+        sst_member = template.parts.get('sharedStrings')
+        sst = SharedStrings(template.text(sst_member) if sst_member else None)
+
+    part_dir = tempfile.mkdtemp(prefix="ptd_parts_")
+
+    def sheet_writer(name: str):
+        def render(f) -> None:
+            _write_sheet_model(f, sheets[name], style_ids[name], shared_strings=sst)
+
+        if part_cache is None or sst is not None or name not in (part_inputs or {}):
+            return render
+
+        def spliced(f) -> None:
+            key = _sheet_part_key(part_cache, name, part_inputs[name], style_ids[name])
+            part = _render_sheet_part_cached(part_cache, key, name, os.path.join(part_dir, f"{key}.xml"), render)
+            with open(part, 'r', encoding='utf-8') as src:
+                shutil.copyfileobj(src, f, 1 << 20)
+        return spliced
+
+    try:
+        return _assemble_from_template(template, out_xlsx or template_xlsx,
+                                       {name: sheet_writer(name) for name in sheets}, styles, sst, compression)
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+
+def transplant_sheets_into_template(
+    template: PreparsedTemplate,
+    sheets: Dict[str, str],
+    out_xlsx: str,
+    memory_budget: Optional[int] = None,
+    compression: Optional[DeflateOptions] = None,
+    part_cache: Optional[StageCache] = None,
 ) -> str:
     """
-    Perform a low-memory zip-level transplant: replace only the two target sheet XMLs
-    in the template, leave all other parts intact. The replacement sheet XMLs are
-    minimal (values only, inline strings, no external styles/sharedStrings).
-    Returns the absolute path to the modified template (in-place).
-    """
-    import zipfile
-    import tempfile
-    import shutil
-    import xml.etree.ElementTree as ET
-    from pathlib import Path
-
-    tmp_dir = tempfile.mkdtemp(prefix='ptd_surgery_')
-    extract_dir = os.path.join(tmp_dir, 'extract')
-    os.makedirs(extract_dir, exist_ok=True)
-
-    # Extract template
-    with zipfile.ZipFile(template_xlsx, 'r') as zin:
-        zin.extractall(extract_dir)
-
-    # Parse workbook and rels to find sheet targets
-    wb_xml = os.path.join(extract_dir, 'xl', 'workbook.xml')
-    rels_xml = os.path.join(extract_dir, 'xl', '_rels', 'workbook.xml.rels')
-    ns = {'ns': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main', 'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'}
-    tree = ET.parse(wb_xml)
-    root = tree.getroot()
-    name_to_rid = {}
-    for sheet in root.findall('ns:sheets/ns:sheet', ns):
-        name = sheet.attrib.get('name')
-        rid = sheet.attrib.get('{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id')
-        if name and rid:
-            name_to_rid[name] = rid
-    if schedule_sheet_name not in name_to_rid or forms_sheet_name not in name_to_rid:
-        raise RuntimeError('Target sheet names not found in template workbook.')
-
-    rels_tree = ET.parse(rels_xml)
-    rels_root = rels_tree.getroot()
-    rid_to_target = {}
-    for rel in rels_root.findall('{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'):
-        rid_to_target[rel.attrib.get('Id')] = rel.attrib.get('Target')
-
-    def target_to_path(target: str) -> str:
-        # Normalize odd targets like '/xl/worksheets/sheet1.xml' or '/worksheets/sheet1.xml'
-        t = (target or '').replace('\\', '/').lstrip('/')
-        if t.startswith('xl/'):
-            t = t[3:]
-        # Usually ends as 'worksheets/sheet1.xml'
-        full = os.path.join(extract_dir, 'xl', t)
-        os.makedirs(os.path.dirname(full), exist_ok=True)
-        return full
-
-    sched_target = rid_to_target[name_to_rid[schedule_sheet_name]]
-    forms_target = rid_to_target[name_to_rid[forms_sheet_name]]
-    sched_path = target_to_path(sched_target)
-    forms_path = target_to_path(forms_target)
-
-    # Build replacement xmls
-    # 1) Schedule: source is an XLSX on disk; stream rows and write xml
-    _write_minimal_sheet_xml_from_rows(_iter_rows_from_xlsx_sheet(schedule_rows_path), sched_path)
-
-    # 2) Forms: rows iterator provided
-    _write_minimal_sheet_xml_from_rows(forms_rows_iter, forms_path)
-
-    # Repack zip (overwrite original)
-    new_zip = os.path.join(tmp_dir, 'out.xlsx')
-    with zipfile.ZipFile(new_zip, 'w', compression=zipfile.ZIP_DEFLATED) as zout:
-        for folder, _, files in os.walk(extract_dir):
-            for filename in files:
-                full_path = os.path.join(folder, filename)
-                arcname = os.path.relpath(full_path, extract_dir)
-                zout.write(full_path, arcname)
-
-    # Replace original
-    shutil.copyfile(new_zip, template_xlsx)
-    shutil.rmtree(tmp_dir, ignore_errors=True)
-    return os.path.abspath(template_xlsx)
-
-
-def main() -> int:
+    Replace template sheets with the first worksheet of generated workbooks
+    without loading the template into openpyxl.
+
+    sheets maps a template sheet name to a generated xlsx. Each generated
+    sheet's XML is copied as-is apart from its style indices, which point at
+    the generated workbook's cellXfs records after they are imported into the
+    template's styles.xml, and shared-string cells, which become inline
+    strings. Raises ValueError when a generated sheet cannot be transplanted
+    (it has its own relationships, e.g. hyperlinks or drawings) and KeyError
+    when the template lacks a target sheet; replace_sheets_in_template then
+    falls back to copying through openpyxl.
+
+    With part_cache, each transplanted part is stored keyed by the generated
+    workbook's contents and the style indices it was mapped to, so a rerun
+    with an unchanged sheet (e.g. the forms after a protocol-only change)
+    splices the stored part in.
+    """
+    if 'styles' not in template.parts:
+        raise ValueError('Template workbook has no styles part')
+    styles = StyleTable(template.text(template.parts['styles']))
+    part_dir = tempfile.mkdtemp(prefix="ptd_parts_")
+    try:
+        part_files = {}
+        for name, source_xlsx in sheets.items():
+            template.sheet_member(name)
+            source = PreparsedTemplate.parse(source_xlsx)
+            if not source.sheet_parts:
+                raise ValueError(f'{source_xlsx} has no worksheets')
+            member = next(iter(source.sheet_parts.values()))
+            member_dir, member_file = member.rsplit('/', 1)
+            with zipfile.ZipFile(source_xlsx, 'r') as zsrc:
+                if f'{member_dir}/_rels/{member_file}.rels' in zsrc.namelist():
+                    raise ValueError(f"Generated sheet for '{name}' has relationships")
+            style_map = styles.import_styles(source.text(source.parts['styles'])) if 'styles' in source.parts else {}
+
+            def render(f, source=source, source_xlsx=source_xlsx, member=member, style_map=style_map) -> None:
+                with zipfile.ZipFile(source_xlsx, 'r') as zsrc:
+                    xml = zsrc.read(member).decode('utf-8')
+                sst_member = source.parts.get('sharedStrings')
+                shared_items = shared_string_items(source.text(sst_member)) if sst_member else None
+                f.write(transplant_sheet_xml(xml, style_map, shared_items))
+
+            # The part's s= indices are only valid against the same imported styles
+            key = part_cache.key_for(f"sheet_part:{name}", transplant_sheet_xml,
+                                     {'source_xlsx': source_xlsx, 'style_ids': style_map}) if part_cache is not None else None
+            part_files[name] = _render_sheet_part_cached(part_cache, key, name,
+                                                         os.path.join(part_dir, f"{len(part_files)}.xml"), render)
+            check_memory_budget(memory_budget, f"after transplanting '{name}'")
+
+        def splice(path: str):
+            def write(f) -> None:
+                with open(path, 'r', encoding='utf-8') as src:
+                    shutil.copyfileobj(src, f, 1 << 20)
+            return write
+
+        writers = {name: splice(path) for name, path in part_files.items()}
+        return _assemble_from_template(template, out_xlsx, writers, styles, compression=compression)
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+
+def _surgery_output(
+    template_xlsx: Optional[str],
+    output_path: str,
+    schedule_inputs: Dict[str, Any],
+    forms_rows,
+    config_dir: str,
+    shared_strings: bool = False,
+    template_cache: Optional[StageCache] = None,
+    compression: Optional[DeflateOptions] = None,
+    ecrf_json: Optional[str] = None,
+    part_cache: Optional[StageCache] = None,
+) -> str:
+    """Run the surgery transplant from the template (or output_path itself when none is given) into output_path."""
+    schedule_sheet = build_schedule_grid_rows(
+        visits_xlsx=schedule_inputs['visits_xlsx'],
+        forms_csv=schedule_inputs['matrix_csv'],
+        config=load_config(os.path.join(config_dir, SCHEDULE_CONFIG_FILES['schedule_layout'])),
+    )
+    return surgery_replace_sheets_inplace(
+        template_xlsx=template_xlsx or output_path,
+        sheets={
+            "Schedule Grid": schedule_sheet,
+            "Study Specific Forms": build_study_specific_forms_sheet_rows(forms_rows),
+        },
+        shared_strings=shared_strings,
+        out_xlsx=output_path,
+        template_cache=template_cache,
+        compression=compression,
+        part_cache=part_cache,
+        part_inputs=sheet_part_inputs(schedule_inputs, ecrf_json, config_dir) if ecrf_json else None,
+    )
+
+
+def _write_sheet_model(f, model: Dict[str, Any], style_ids: Dict[str, int],
+                       shared_strings: Optional[SharedStrings] = None) -> None:
+    write_sheet_xml(
+        f, model['rows'], style_ids,
+        merges=model.get('merges', ()),
+        freeze_panes=model.get('freeze_panes'),
+        column_widths=model.get('column_widths', True),
+        shared_strings=shared_strings,
+    )
+
+
+def sheet_part_inputs(schedule_inputs: Dict[str, Any], ecrf_json: str, config_dir: str) -> Dict[str, Dict[str, Any]]:
+    """
+    What each generated sheet part depends on, for the sheet-part cache:
+    input files (hashed by content), layout config and the source of the
+    module laying the sheet out. The Study Specific Forms sheet depends on
+    the eCRF only, so protocol-only changes reuse it.
+    """
+    return {
+        "Schedule Grid": {
+            'visits_xlsx': schedule_inputs['visits_xlsx'],
+            'matrix_csv': schedule_inputs['matrix_csv'],
+            'config': os.path.join(config_dir, SCHEDULE_CONFIG_FILES['schedule_layout']),
+            'layout_code': code_version(build_schedule_grid_rows),
+        },
+        "Study Specific Forms": {
+            'ecrf_json': ecrf_json,
+            'config': os.path.join(config_dir, 'config_study_specific_forms.json'),
+            'layout_code': code_version(build_study_specific_forms_sheet_rows),
+        },
+    }
+
+
+def _sheet_part_key(cache: StageCache, sheet_name: str, inputs: Dict[str, Any], style_ids: Dict[str, int]) -> str:
+    # The part's s= indices are only valid against the same style table
+    return cache.key_for(f"sheet_part:{sheet_name}", write_sheet_xml, dict(inputs, style_ids=style_ids))
+
+
+def _render_sheet_part_cached(cache: Optional[StageCache], key: Optional[str], sheet_name: str,
+                              output_xml: str, render) -> str:
+    """Write a sheet part to output_xml from the cache, or render it (render(f)) and store it."""
+    if cache is not None and key:
+        hit, _ = cache.lookup(key, output_xml)
+        if hit:
+            logging.info(f"Sheet part cache hit for '{sheet_name}' ({key[:12]}); reusing it")
+            return output_xml
+    with open(output_xml, 'w', encoding='utf-8') as f:
+        render(f)
+    if cache is not None and key:
+        logging.info(f"Sheet part cache miss for '{sheet_name}' ({key[:12]}); stored")
+        cache.store(key, f"sheet_part:{sheet_name}", output_xml, output_xml)
+    return output_xml
+
+
+def render_schedule_grid_part(visits_xlsx: str, forms_csv: str, config: Dict[str, Any],
+                              style_ids: Dict[str, int], output_xml: str,
+                              part_cache: Optional[StageCache] = None, part_key: Optional[str] = None) -> str:
+    """Stage: render the Schedule Grid row model to a worksheet XML file (or take it from part_cache)."""
+    def render(f) -> None:
+        model = build_schedule_grid_rows(visits_xlsx=visits_xlsx, forms_csv=forms_csv, config=config)
+        _write_sheet_model(f, model, style_ids)
+    return _render_sheet_part_cached(part_cache, part_key, "Schedule Grid", output_xml, render)
+
+
+def render_study_specific_forms_part(forms_rows, style_ids: Dict[str, int], output_xml: str,
+                                     part_cache: Optional[StageCache] = None, part_key: Optional[str] = None,
+                                     ecrf_json: Optional[str] = None, config_dir: Optional[str] = None,
+                                     forms_workers: int = 1) -> str:
+    """
+    Stage: render the Study Specific Forms row model to a worksheet XML file (or
+    take it from part_cache). Without forms_rows the rows are extracted from
+    ecrf_json in the worker while the part is written.
+    """
+    def render(f) -> None:
+        rows = (forms_rows if forms_rows is not None
+                else study_specific_forms_rows_source({}, ecrf_json, config_dir, workers=forms_workers))
+        _write_sheet_model(f, build_study_specific_forms_sheet_rows(rows), style_ids)
+    return _render_sheet_part_cached(part_cache, part_key, "Study Specific Forms", output_xml, render)
+
+
+def write_stream_workbook_parallel(
+    output_path: str,
+    schedule_inputs: Dict[str, Any],
+    forms_rows,
+    config_dir: str,
+    max_workers: int = 2,
+    executor: str = "process",
+    compression: Optional[DeflateOptions] = None,
+    ecrf_json: Optional[str] = None,
+    part_cache: Optional[StageCache] = None,
+    profiler: Optional[StageProfiler] = None,
+    report: Optional[RunReport] = None,
+    forms_workers: int = 1,
+) -> str:
+    """
+    --stream --parallel-sheets: render each sheet's row model to its own
+    worksheet XML part in a separate worker, then zip the parts into a new
+    workbook.
+
+    The style table is built up front from SCHEDULE_GRID_FORMATS and
+    STUDY_SPECIFIC_FORMS_FORMATS, so the workers only need the agreed
+    format_key -> cellXfs index maps and styles.xml is written once by the
+    assembler. Strings are written inline (a shared strings table would have
+    to be shared between the workers). forms_rows may be None: the forms
+    worker then extracts them from ecrf_json as it writes (with forms_workers
+    it fans the forms out to its own process pool). With part_cache
+    (and ecrf_json for the fingerprint) unchanged sheets are taken from the
+    sheet-part cache.
+    With a profiler and/or report, each render stage and the assembly are
+    profiled and measured.
+    Returns the absolute output path.
+    """
+    styles = StyleTable()
+    schedule_ids = styles.add_formats(SCHEDULE_GRID_FORMATS)
+    forms_ids = styles.add_formats(STUDY_SPECIFIC_FORMS_FORMATS)
+    part_keys: Dict[str, Optional[str]] = {"Schedule Grid": None, "Study Specific Forms": None}
+    if part_cache is not None and ecrf_json:
+        inputs = sheet_part_inputs(schedule_inputs, ecrf_json, config_dir)
+        part_keys["Schedule Grid"] = _sheet_part_key(part_cache, "Schedule Grid", inputs["Schedule Grid"], schedule_ids)
+        part_keys["Study Specific Forms"] = _sheet_part_key(
+            part_cache, "Study Specific Forms", inputs["Study Specific Forms"], forms_ids)
+
+    part_dir = tempfile.mkdtemp(prefix="ptd_parts_")
+    try:
+        stages = [
+            Stage('render_schedule_grid', render_schedule_grid_part, provides='schedule_part', kwargs={
+                'visits_xlsx': schedule_inputs['visits_xlsx'],
+                'forms_csv': schedule_inputs['matrix_csv'],
+                'config': load_config(os.path.join(config_dir, SCHEDULE_CONFIG_FILES['schedule_layout'])),
+                'style_ids': schedule_ids,
+                'output_xml': os.path.join(part_dir, "schedule_grid.xml"),
+                'part_cache': part_cache,
+                'part_key': part_keys["Schedule Grid"],
+            }),
+            Stage('render_study_specific_forms', render_study_specific_forms_part, provides='forms_part', kwargs={
+                'forms_rows': forms_rows,
+                'ecrf_json': ecrf_json,
+                'config_dir': config_dir,
+                'forms_workers': forms_workers,
+                'style_ids': forms_ids,
+                'output_xml': os.path.join(part_dir, "study_specific_forms.xml"),
+                'part_cache': part_cache,
+                'part_key': part_keys["Study Specific Forms"],
+            }),
+        ]
+        parts, _ = run_stage_graph(apply_stage_profiling(stages, profiler), max_workers=max_workers, executor=executor,
+                                   stage_metrics=report.stages if report is not None else None,
+                                   trace_memory=report is not None and report.trace_memory)
+        with _pipeline_step(profiler, report, 'workbook_assembly'):
+            write_new_workbook(output_path, [
+                ("Schedule Grid", parts['schedule_part']),
+                ("Study Specific Forms", parts['forms_part']),
+            ], styles.to_xml(), compression=compression)
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+    return os.path.abspath(output_path)
+
+
+BATCH_MODE_FLAGS = {"default": [], "fast": ["--fast"], "stream": ["--stream"], "surgery": ["--surgery"], "auto": ["--auto"]}
+
+
+def _batch_worker_init() -> None:
+    """Pool initializer: set up logging and import the lazily loaded writers once per worker."""
+    setup_logging("INFO")
+    import xlsxwriter  # noqa: F401
+
+
+def _run_batch_study(study: Dict[str, Any]) -> int:
+    """Batch job: one regular PTD run in this (warm) worker process."""
+    logging.info(f"Batch: starting '{study['study']}'")
+    return main(study['argv'])
+
+
+def batch_main(argv: List[str]) -> int:
+    """
+    `generate_ptd.py batch MANIFEST`: generate every study in the manifest (see
+    modules.batch) on a process pool. Options not recognised here are passed
+    to every study run (e.g. --cache-dir, --compression). Returns 1 if any
+    study failed.
+    """
+    parser = argparse.ArgumentParser(
+        prog="generate_ptd.py batch",
+        description="Generate PTDs for every study in a CSV/JSON manifest on a warm process pool",
+    )
+    parser.add_argument("manifest", help="CSV or JSON manifest with study, protocol, ecrf, template, out, mode")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="Studies generated concurrently (default: min(4, CPU count))")
+    parser.add_argument("--summary", help="Per-study status/timing file, .json or .csv (default: <manifest>_summary.csv)")
+    args, passthrough = parser.parse_known_args(argv)
+
+    setup_logging("INFO")
+    try:
+        studies = load_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    for study in studies:
+        study['report'] = default_report_path(study['out'])
+        argv_study = ["--protocol", study['protocol'], "--ecrf", study['ecrf'], "--out", study['out'],
+                      "--report", study['report'], "--jobs", "1"]
+        if study['template']:
+            argv_study += ["--template", study['template']]
+        # Passed-through options come last so they can override the defaults above (e.g. --jobs)
+        study['argv'] = argv_study + BATCH_MODE_FLAGS[study['mode']] + passthrough
+
+    start = time.perf_counter()
+    logging.info(f"Batch: {len(studies)} studies from {args.manifest} on {max(1, args.workers)} workers")
+    results = run_batch(studies, _run_batch_study, workers=min(args.workers, len(studies)),
+                        initializer=_batch_worker_init)
+    summary_path = write_summary(results, args.summary or os.path.splitext(args.manifest)[0] + "_summary.csv")
+    failed = [r['study'] for r in results if r['status'] != "ok"]
+    logging.info(f"Batch finished in {time.perf_counter() - start:.1f}s: {len(results) - len(failed)} ok, "
+                 f"{len(failed)} failed; summary written to {summary_path}")
+    if failed:
+        logging.warning(f"Batch: failed studies: {', '.join(failed)}")
+    return 1 if failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["batch"]:
+        return batch_main(argv[1:])
+
     parser = argparse.ArgumentParser(
         description="Generate PTD Excel with Schedule Grid and Study Specific Forms"
     )
@@ -625,12 +1067,119 @@ def main() -> int:
     parser.add_argument("--template", required=False, help="Path to template Excel (will be updated)")
     parser.add_argument("--out", required=False, help="Output Excel file path (e.g., ptd.xlsx). Omit when using --inplace")
     parser.add_argument("--inplace", action="store_true", help="Modify the template file in place (save over --template)")
-    parser.add_argument("--fast", action="store_true", help="Fast mode: values-only copy, skip extra formatting")
+    parser.add_argument("--fast", action="store_true", help="Fast mode: skip the Study Specific Forms formatting pass (and copy values plus header styles only when the template cannot take the XML transplant)")
     parser.add_argument("--stream", action="store_true", help="Stream directly to a new workbook using XlsxWriter (preserves formatting and minimizes memory)")
     parser.add_argument("--surgery", action="store_true", help="Low-RAM in-place surgery: replace only target sheet XMLs in the template")
-    args = parser.parse_args()
+    parser.add_argument("--parallel-sheets", action="store_true", help="Stream mode: render each sheet to XML in its own worker (up to --jobs, using --executor) and zip the parts")
+    parser.add_argument("--compression", choices=list(COMPRESSION_LEVELS), help="Compression of the parts PTD writes: stored, fast (zlib level 1) or default")
+    parser.add_argument("--deflate-threads", type=int, default=1, help="Compress large output parts in chunks on up to N threads (default: 1)")
+    parser.add_argument("--shared-strings", action="store_true", help="Surgery mode: store repeated labels in the shared strings table instead of inline")
+    parser.add_argument("--auto", action="store_true", help="Pick the output mode from input size and available memory (logs the reason)")
+    parser.add_argument("--memory-budget-mb", type=float, help="Memory budget for --auto (default: half of available memory); template modes over budget fall back to surgery")
+    parser.add_argument("--workers", type=int, default=1, help="Build the Study Specific Forms on a process pool of N workers, one form per task (1 = in-process)")
+    parser.add_argument("--jobs", type=int, default=min(4, os.cpu_count() or 1), help="Run independent pipeline stages concurrently with up to N workers (1 = serial)")
+    parser.add_argument("--executor", choices=["thread", "process"], default="process", help="Worker pool used for concurrent stages (default: process)")
+    parser.add_argument("--cache-dir", help="Stage result and pre-parsed template cache directory (env: PTD_CACHE_DIR; caching is off when neither is set)")
+    parser.add_argument("--cache-size-mb", type=float, help="Stage cache size limit in MB, 0 = unlimited (env: PTD_CACHE_SIZE_MB; default 512)")
+    parser.add_argument("--cache-policy", choices=list(CACHE_POLICIES), help="Stage cache eviction policy (env: PTD_CACHE_POLICY; default lru)")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the stage and template caches even if configured")
+    parser.add_argument("--report", metavar="PATH", help="Run report JSON path (default: <output>.run_report.json)")
+    parser.add_argument("--trace-memory", action="store_true", help="Record the tracemalloc peak of every stage and the JSON documents' node counts in the run report (slower)")
+    parser.add_argument("--profile", metavar="DIR", help="Profile every stage with cProfile; writes <stage>.pstats, <stage>.collapsed (flamegraph) and summary.txt to DIR")
+    parser.add_argument("--export-format", action="append", choices=list(EXPORT_FORMATS), help="Also export the schedule grid, visits and Study Specific Forms tables as csv, parquet or arrow (repeatable; parquet/arrow need pyarrow)")
+    parser.add_argument("--export-dir", help="Directory for --export-format files (default: next to the output)")
+    parser.add_argument("--no-xlsx", action="store_true", help="Only write the --export-format tables, no workbook (--out still names the files)")
+    parser.add_argument("--watch", action="store_true", help="Stay running and rebuild when the input JSONs, config/ or the template change (only changed stages rerun)")
+    parser.add_argument("--watch-interval", type=float, default=WATCH_INTERVAL, help=f"Seconds between --watch polls (default: {WATCH_INTERVAL})")
+    args = parser.parse_args(argv)
 
     setup_logging("INFO")
+    if args.watch:
+        return watch_ptd(args)
+    return generate_ptd_output(args)
+
+
+def watch_ptd(args: argparse.Namespace) -> int:
+    """
+    --watch: build once, then rebuild whenever the protocol/eCRF JSON, a file
+    in config/ or the template changes, until interrupted. The process stays
+    warm (imports, parsed configs, pre-parsed template) and every build goes
+    through the stage cache, so only stages whose inputs changed rerun. When
+    no cache directory is configured a temporary one is used for the session.
+    """
+    if args.inplace:
+        print("Error: --watch cannot be combined with --inplace (the output would trigger rebuilds)", file=sys.stderr)
+        return 2
+    session_cache_dir = None
+    if not args.no_cache and not (args.cache_dir or os.environ.get("PTD_CACHE_DIR")):
+        session_cache_dir = tempfile.mkdtemp(prefix="ptd_watch_cache_")
+        args.cache_dir = session_cache_dir
+    config_dir = os.path.join(os.path.dirname(__file__), "config")
+
+    def watched_paths() -> List[str]:
+        paths = [args.protocol, args.ecrf] + ([args.template] if args.template else [])
+        return paths + sorted(os.path.join(config_dir, name) for name in os.listdir(config_dir) if name.endswith(".json"))
+
+    def rebuild(changed: List[str]) -> None:
+        if changed:
+            logging.info(f"Watch: {', '.join(os.path.basename(p) for p in changed)} changed; rebuilding")
+        start = time.perf_counter()
+        try:
+            # Fresh copy: a run may rewrite its args (e.g. --auto picks the mode)
+            code = generate_ptd_output(argparse.Namespace(**vars(args)))
+        except Exception as e:
+            logging.exception(f"Watch: build failed ({e}); waiting for the next change")
+            return
+        if code == 0:
+            logging.info(f"Watch: PTD rebuilt in {time.perf_counter() - start:.2f}s; watching for changes")
+        else:
+            logging.warning(f"Watch: build exited with code {code}; waiting for the next change")
+
+    try:
+        rebuild([])
+        watch_files(watched_paths, rebuild, interval=args.watch_interval)
+    except KeyboardInterrupt:
+        logging.info("Watch: stopped")
+    finally:
+        if session_cache_dir:
+            shutil.rmtree(session_cache_dir, ignore_errors=True)
+    return 0
+
+
+def generate_ptd_output(args: argparse.Namespace) -> int:
+    """Generate one PTD from the parsed command line; returns the process exit code."""
+    report = RunReport(trace_memory=args.trace_memory)
+
+    # Auto mode: measure the inputs and pick the richest mode that fits in memory
+    memory_budget = int(args.memory_budget_mb * 1024 * 1024) if args.memory_budget_mb else None
+    plan = None
+    if args.auto:
+        if args.fast or args.stream or args.surgery:
+            print("Error: --auto cannot be combined with --fast, --stream or --surgery", file=sys.stderr)
+            return 2
+        plan = choose_output_mode(args.protocol, args.ecrf, template_xlsx=args.template,
+                                  memory_budget_mb=args.memory_budget_mb)
+        memory_budget = plan['budget_bytes']
+        args.stream = plan['mode'] == "stream"
+        args.fast = plan['mode'] == "fast"
+        args.surgery = plan['mode'] == "surgery"
+
+    # Tabular export: check the format dependencies before any work is done
+    export_only = args.no_xlsx
+    if export_only and not args.export_format:
+        print("Error: --no-xlsx needs at least one --export-format", file=sys.stderr)
+        return 2
+    if args.export_format:
+        try:
+            check_export_formats(args.export_format)
+        except (RuntimeError, ValueError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 2
+
+    # Output compression: zipfile/XlsxWriter defaults unless a level or threads are requested
+    compression = None
+    if args.compression or args.deflate_threads > 1:
+        compression = DeflateOptions(args.compression or "default", threads=args.deflate_threads)
 
     # Determine output path (in-place or new file)
     if args.stream:
@@ -657,101 +1206,179 @@ def main() -> int:
         output_path = os.path.splitext(output_path)[0] + ".xlsx"
     ensure_output_dir(output_path)
 
-    # 1) Build schedule grid into a temp workbook
-    schedule_tmp_dir = tempfile.mkdtemp(prefix="ptd_schedule_")
-    schedule_tmp_xlsx = os.path.join(schedule_tmp_dir, "schedule_grid.xlsx")
-    schedule_inputs = run_schedule_grid_pipeline(
-        protocol_json=args.protocol,
-        ecrf_json=args.ecrf,
-        final_output_xlsx=schedule_tmp_xlsx,
-        config_dir=os.path.join(os.path.dirname(__file__), "config"),
-        for_stream=(args.stream or args.surgery),
+    config_dir = os.path.join(os.path.dirname(__file__), "config")
+    # Export-only runs need the same in-memory rows as the streaming writers
+    streaming = args.stream or args.surgery or export_only
+    profiler = StageProfiler(args.profile) if args.profile else None
+    report.run.update(
+        mode="export" if export_only else "stream" if args.stream else "surgery" if args.surgery else "fast" if args.fast else "default",
+        auto=args.auto,
+        parallel_sheets=bool(args.stream and args.parallel_sheets),
+        jobs=args.jobs,
+        executor=args.executor,
+        workers=args.workers,
+        protocol=os.path.abspath(args.protocol),
+        ecrf=os.path.abspath(args.ecrf),
+        template=os.path.abspath(args.template) if args.template else None,
     )
 
-    # 2) Generate study specific forms to a temp file (only in non-stream mode)
-    if not args.stream:
-        forms_tmp_xlsx = generate_study_specific_forms_xlsx(args.ecrf)
-
-    if args.stream:
-        # Stream both sheets into a single workbook using XlsxWriter
-        import xlsxwriter
-        ensure_output_dir(output_path)
-        workbook = xlsxwriter.Workbook(output_path, {
-            'constant_memory': True,
-            'strings_to_urls': False,
-        })
-        try:
-            # Schedule Grid
-            generate_schedule_grid_stream(
-                visits_xlsx=schedule_inputs['visits_xlsx'],
-                forms_csv=schedule_inputs['matrix_csv'],
-                workbook=workbook,
-                sheet_name="Schedule Grid",
-                config=load_config(os.path.join(os.path.dirname(__file__), "config", "config_schedule_layout.json")),
-            )
-
-            # Study Specific Forms
-            rows = prepare_study_specific_forms_rows(
-                json_file_path=args.ecrf,
-                config_path=os.path.join(os.path.dirname(__file__), 'config', 'config_study_specific_forms.json'),
-            )
-            write_study_specific_forms_stream(rows, workbook, sheet_name="Study Specific Forms")
-        finally:
-            workbook.close()
-        final_path = output_path
-        # Cleanup streaming intermediates created by run_schedule_grid_pipeline
-        try:
-            shutil.rmtree(schedule_inputs['temp_dir'])
-        except Exception:
-            pass
-    elif args.surgery:
-        # Build forms rows iterator without creating a big workbook
-        rows = prepare_study_specific_forms_rows(
-            json_file_path=args.ecrf,
-            config_path=os.path.join(os.path.dirname(__file__), 'config', 'config_study_specific_forms.json'),
-        )
-        # Perform zip-level sheet transplant in-place
-        final_path = surgery_replace_sheets_inplace(
-            template_xlsx=output_path,
-            schedule_sheet_name="Schedule Grid",
-            forms_sheet_name="Study Specific Forms",
-            schedule_rows_path=schedule_inputs['visits_xlsx'],
-            forms_rows_iter=iter(rows),
-        )
-        # Clean intermediates
-        try:
-            shutil.rmtree(schedule_inputs['temp_dir'])
-        except Exception:
-            pass
-    else:
-        # 3) Replace sheets in the provided template and save to output
-        if not args.template:
-            print("Error: --template is required when not using --stream", file=sys.stderr)
-            return 2
-        final_path = replace_sheets_in_template(
-            template_xlsx=args.template,
-            schedule_xlsx=schedule_inputs,
-            forms_xlsx=forms_tmp_xlsx,
-            out_xlsx=output_path,
-            fast=args.fast,
+    # 1) Run the stage graph: schedule grid inputs (+ layout in template mode) and
+    #    the study specific forms builder, with independent stages in parallel
+    stage_dir = tempfile.mkdtemp(prefix="ptd_intermediate_")
+    schedule_tmp_dir = tempfile.mkdtemp(prefix="ptd_schedule_")
+    schedule_tmp_xlsx = os.path.join(schedule_tmp_dir, "schedule_grid.xlsx")
+    # One tracer for the whole run, shared by stages running on threads; stopped
+    # again below so warm batch/watch processes do not keep tracing later jobs
+    started_tracing = args.trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    # eCRF node/table/TR counts taken by the forms scan when the rows are streamed
+    ecrf_stats: Dict[str, int] = {}
+    try:
+        cache = None if args.no_cache else StageCache.from_settings(args.cache_dir, args.cache_size_mb, args.cache_policy)
+        report.run['cache'] = cache.cache_dir if cache is not None else None
+        stages = build_ptd_stages(
+            protocol_json=args.protocol,
+            ecrf_json=args.ecrf,
+            config_dir=config_dir,
+            work_dir=stage_dir,
+            schedule_output_xlsx=None if streaming else schedule_tmp_xlsx,
+            # Streaming writers pull the forms rows from a generator unless the export also needs them
+            forms_output=("rows" if args.export_format else None) if streaming else "xlsx",
+            # Forms-sheet formatting happens before the forms workbook is saved (skipped in fast mode)
+            format_forms=not args.fast,
+            forms_workers=args.workers,
+            cache=cache,
         )
+        artifacts, _ = run_stage_graph(apply_stage_profiling(apply_stage_cache(stages, cache), profiler),
+                                       max_workers=args.jobs, executor=args.executor,
+                                       stage_metrics=report.stages, trace_memory=args.trace_memory)
+        schedule_inputs = {
+            'visits_xlsx': artifacts['visits_xlsx'],
+            'matrix_csv': artifacts['matrix_csv'],
+            'temp_dir': stage_dir,
+        }
+        if not streaming:
+            forms_tmp_xlsx = artifacts['forms_xlsx']
+
+        if args.parallel_sheets and not args.stream:
+            logging.warning("--parallel-sheets only applies to --stream output; ignoring it")
+
+        if export_only:
+            final_path = None
+        elif args.stream and args.parallel_sheets:
+            final_path = write_stream_workbook_parallel(
+                output_path, schedule_inputs, artifacts.get('forms_rows'), config_dir,
+                max_workers=min(2, args.jobs), executor=args.executor, compression=compression,
+                ecrf_json=args.ecrf, part_cache=cache, profiler=profiler, report=report, forms_workers=args.workers,
+            )
+        elif args.stream:
+            # Stream both sheets into a single workbook using XlsxWriter
+            ensure_output_dir(output_path)
+            workbook = open_xlsxwriter_workbook(output_path, {
+                'constant_memory': True,
+                'strings_to_urls': False,
+            }, deflate_options=compression)
+            try:
+                # Schedule Grid
+                with _pipeline_step(profiler, report, 'schedule_grid_write'):
+                    generate_schedule_grid_stream(
+                        visits_xlsx=schedule_inputs['visits_xlsx'],
+                        forms_csv=schedule_inputs['matrix_csv'],
+                        workbook=workbook,
+                        sheet_name="Schedule Grid",
+                        config=load_config(os.path.join(os.path.dirname(__file__), "config", "config_schedule_layout.json")),
+                    )
 
-        # 4) Finalize formatting on forms sheet (skip in fast mode)
-        if not args.fast:
-            finalize_formatting(final_path)
-
-    # Cleanup temp dirs
-    try:
-        shutil.rmtree(schedule_tmp_dir)
-    except Exception:
-        pass
-    if not args.stream:
+                # Study Specific Forms
+                with _pipeline_step(profiler, report, 'study_specific_forms_write'):
+                    forms_source = study_specific_forms_rows_source(artifacts, args.ecrf, config_dir,
+                                                                    workers=args.workers, ecrf_stats=ecrf_stats)
+                    write_study_specific_forms_stream(forms_source, workbook, sheet_name="Study Specific Forms")
+            finally:
+                with _pipeline_step(profiler, report, 'workbook_assembly'):
+                    workbook.close()
+            final_path = output_path
+        elif args.surgery:
+            # Perform zip-level sheet transplant in-place
+            with _pipeline_step(profiler, report, 'template_assembly'):
+                final_path = _surgery_output(args.template, output_path, schedule_inputs,
+                                             study_specific_forms_rows_source(artifacts, args.ecrf, config_dir, workers=args.workers,
+                                                                              ecrf_stats=ecrf_stats),
+                                             config_dir, shared_strings=args.shared_strings, template_cache=cache,
+                                             compression=compression, ecrf_json=args.ecrf, part_cache=cache)
+        else:
+            # 3) Replace sheets in the provided template and save to output
+            if not args.template:
+                print("Error: --template is required when not using --stream", file=sys.stderr)
+                return 2
+            try:
+                with _pipeline_step(profiler, report, 'template_assembly'):
+                    final_path = replace_sheets_in_template(
+                        template_xlsx=args.template,
+                        schedule_xlsx=artifacts['schedule_xlsx'],
+                        forms_xlsx=forms_tmp_xlsx,
+                        out_xlsx=output_path,
+                        fast=args.fast,
+                        memory_budget=memory_budget,
+                        template_cache=cache,
+                        compression=compression,
+                        part_cache=cache,
+                    )
+            except MemoryBudgetExceeded as e:
+                logging.warning(f"{e}; falling back to surgery (streamed sheets)")
+                report.run['fallback'] = "surgery"
+                with _pipeline_step(profiler, report, 'template_assembly_surgery'):
+                    final_path = _surgery_output(args.template, output_path, schedule_inputs,
+                                                 study_specific_forms_rows_source(artifacts, args.ecrf, config_dir, workers=args.workers,
+                                                                                  ecrf_stats=ecrf_stats),
+                                                 config_dir, shared_strings=args.shared_strings, template_cache=cache,
+                                                 compression=compression, ecrf_json=args.ecrf, part_cache=cache)
+
+        # Tabular export from the forms rows the stage graph built (the same rows as the forms sheet)
+        export_paths: List[str] = []
+        if args.export_format:
+            with _pipeline_step(profiler, report, 'tabular_export'):
+                export_paths = export_ptd_tables(
+                    args.export_dir or os.path.dirname(os.path.abspath(output_path)),
+                    os.path.splitext(os.path.basename(output_path))[0],
+                    args.export_format,
+                    visits_xlsx=schedule_inputs['visits_xlsx'],
+                    forms_csv=schedule_inputs['matrix_csv'],
+                    items_rows=artifacts['forms_rows'],
+                    schedule_config=load_config(os.path.join(config_dir, SCHEDULE_CONFIG_FILES['schedule_layout'])),
+                )
+
+        # Run report: document statistics come from the stage artifacts, so gather them before cleanup
         try:
-            shutil.rmtree(os.path.dirname(forms_tmp_xlsx))
-        except Exception:
-            pass
-
-    print(f"✅ Combined PTD file written successfully to: {final_path}")
+            report.documents = document_statistics(
+                args.protocol, args.ecrf, artifacts,
+                measured_documents={'protocol': plan['protocol'], 'ecrf': plan['ecrf']} if plan else None,
+                walk_documents=args.trace_memory,
+                ecrf_stats=ecrf_stats,
+            )
+            if final_path:
+                report.add_output(final_path)
+            if export_paths:
+                report.outputs['exports'] = [os.path.abspath(p) for p in export_paths]
+            report.write(args.report or default_report_path(final_path or output_path))
+        except Exception as e:
+            logging.warning(f"Could not write the run report: {e}")
+    finally:
+        # Cleanup temp dirs (the forms workbook is written under stage_dir), also
+        # when a stage or the assembly failed, e.g. in a --watch rebuild
+        for tmp in (stage_dir, schedule_tmp_dir):
+            shutil.rmtree(tmp, ignore_errors=True)
+        if started_tracing:
+            tracemalloc.stop()
+
+    if profiler is not None:
+        profiler.write_summary()
+
+    if final_path:
+        print(f"✅ Combined PTD file written successfully to: {final_path}")
+    for path in export_paths:
+        print(f"✅ Exported table written to: {path}")
     return 0
 
 
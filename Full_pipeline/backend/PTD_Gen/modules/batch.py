@@ -0,0 +1,153 @@
+"""
+Batch Module
+
+Manifest handling and the worker pool behind `generate_ptd.py batch`.
+
+A manifest lists one study per row, as CSV (header row) or JSON (a list of
+objects, or {"studies": [...]}), with the columns:
+
+    study      Label used in logs and the summary (default: output file name)
+    protocol   Protocol structured-data JSON (required)
+    ecrf       eCRF structured-data JSON (required)
+    template   Template workbook (optional)
+    out        Output workbook (required)
+    mode       default, fast, stream, surgery or auto (default: default with a
+               template, stream without)
+
+Relative paths are resolved against the manifest's directory. Studies run on
+a bounded process pool whose workers import the pipeline once and keep it
+(and its parsed configs) warm for every study they pick up; a failing study
+is recorded and the batch carries on.
+"""
+
+import csv
+import json
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional
+
+MANIFEST_FIELDS = ("study", "protocol", "ecrf", "template", "out", "mode")
+BATCH_MODES = ("default", "fast", "stream", "surgery", "auto")
+SUMMARY_FIELDS = ("study", "status", "exit_code", "seconds", "out", "report", "error")
+
+
+class ManifestError(ValueError):
+    """Raised for an unreadable manifest or an invalid study entry."""
+
+
+def load_manifest(manifest_path: str) -> List[Dict[str, Any]]:
+    """
+    Read and validate a batch manifest (see module docstring).
+
+    Returns:
+        Study entries with absolute paths and a resolved mode
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, "r", encoding="utf-8-sig", newline="") as f:
+        if manifest_path.lower().endswith(".json"):
+            data = json.load(f)
+            rows = data.get("studies") if isinstance(data, dict) else data
+            if not isinstance(rows, list):
+                raise ManifestError(f"{manifest_path}: expected a list of studies")
+        else:
+            rows = list(csv.DictReader(f))
+
+    studies = []
+    for index, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            raise ManifestError(f"{manifest_path}: entry {index} is not an object")
+        row = {k.strip().lower(): (v.strip() if isinstance(v, str) else v) for k, v in row.items() if k}
+        missing = [field for field in ("protocol", "ecrf", "out") if not row.get(field)]
+        if missing:
+            raise ManifestError(f"{manifest_path}: entry {index} is missing {', '.join(missing)}")
+        entry = {field: row.get(field) or None for field in MANIFEST_FIELDS}
+        for field in ("protocol", "ecrf", "template", "out"):
+            if entry[field]:
+                entry[field] = os.path.normpath(os.path.join(base_dir, entry[field]))
+        entry["mode"] = (entry["mode"] or ("default" if entry["template"] else "stream")).lower()
+        if entry["mode"] not in BATCH_MODES:
+            raise ManifestError(f"{manifest_path}: entry {index} has unknown mode '{entry['mode']}'")
+        entry["study"] = entry["study"] or os.path.splitext(os.path.basename(entry["out"]))[0]
+        studies.append(entry)
+    return studies
+
+
+def _run_job(run_study: Callable[[Dict[str, Any]], int], study: Dict[str, Any]) -> Dict[str, Any]:
+    """Run one study in the worker; never raises, so one failure cannot stop the batch."""
+    start = time.perf_counter()
+    result: Dict[str, Any] = {"study": study["study"], "out": study["out"], "report": study.get("report"), "error": ""}
+    try:
+        code = run_study(study)
+    except SystemExit as e:  # argparse errors
+        code = e.code if isinstance(e.code, int) else 2
+    except Exception as e:
+        code = 1
+        result["error"] = f"{type(e).__name__}: {e}"
+        logging.error(f"Study '{study['study']}' failed:\n{traceback.format_exc()}")
+    result["exit_code"] = code
+    result["status"] = "ok" if code == 0 else "failed"
+    if code and not result["error"]:
+        result["error"] = f"exit code {code}"
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def run_batch(
+    studies: List[Dict[str, Any]],
+    run_study: Callable[[Dict[str, Any]], int],
+    workers: int = 1,
+    initializer: Optional[Callable[[], None]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Run every study through run_study(study) -> exit code.
+
+    Args:
+        studies: Entries from load_manifest
+        run_study: Module-level function (it is sent to the worker processes)
+        workers: Pool size; 1 runs the studies in this process
+        initializer: Called once per worker before its first study
+
+    Returns:
+        One result per study, in manifest order: study, status, exit_code,
+        seconds, out, report and error
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(studies)
+    if workers <= 1:
+        if initializer is not None:
+            initializer()
+        for i, study in enumerate(studies):
+            results[i] = _run_job(run_study, study)
+            logging.info(f"Batch: '{study['study']}' {results[i]['status']} in {results[i]['seconds']:.1f}s")
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer) as pool:
+        futures = {pool.submit(_run_job, run_study, study): i for i, study in enumerate(studies)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:  # the worker process itself died
+                results[i] = {"study": studies[i]["study"], "out": studies[i]["out"], "report": studies[i].get("report"),
+                              "status": "failed", "exit_code": None, "seconds": None, "error": f"{type(e).__name__}: {e}"}
+            logging.info(f"Batch: '{studies[i]['study']}' {results[i]['status']}"
+                         f" ({len([r for r in results if r])}/{len(studies)} done)")
+    return results
+
+
+def write_summary(results: List[Dict[str, Any]], summary_path: str) -> str:
+    """Write per-study results as JSON (.json) or CSV (anything else)."""
+    tmp_path = summary_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        if summary_path.lower().endswith(".json"):
+            ok = sum(1 for r in results if r["status"] == "ok")
+            json.dump({"studies": len(results), "ok": ok, "failed": len(results) - ok, "results": results},
+                      f, indent=2)
+        else:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(results)
+    os.replace(tmp_path, summary_path)
+    return summary_path
@@ -0,0 +1,58 @@
+"""
+Forms Rows Module
+
+The row type of the Study Specific Forms sheet, shared by the builder
+(Final_study_specific_form), the sheet writers and the tabular export, so
+the export schema is derived from the same field list as the rows.
+"""
+
+from typing import Any, Dict, Iterable, NamedTuple, Optional
+
+
+class StudySpecificFormsRow(NamedTuple):
+    """
+    One Study Specific Forms data row, one field per subheader in sheet order
+    (Final_study_specific_form.get_groups_spec). The field names are the
+    column names of the tabular export's study_specific_forms table. It is a
+    plain tuple of values, so every writer, the stage cache and the preview
+    take it as is, and it holds no eCRF tree nodes.
+    """
+    source_study: Any = ""
+    form_label: Any = ""
+    form_name: Any = ""
+    item_group: Any = ""
+    item_group_repeating: Any = ""
+    repeat_maximum: Any = ""
+    repeating_display_format: Any = ""
+    repeating_default_data: Any = ""
+    item_order: Any = ""
+    item_label: Any = ""
+    item_name: Any = ""
+    progressively_displayed: Any = ""
+    controlling_item: Any = ""
+    controlling_item_value: Any = ""
+    data_type: Any = ""
+    field_length: Any = ""
+    precision: Any = ""
+    codelist_choice_labels: Any = ""
+    codelist_name: Any = ""
+    choice_code: Any = ""
+    codelist_control_type: Any = ""
+    range_min_max: Any = ""
+    query_future_date: Any = ""
+    required: Any = ""
+    open_query_when_blank: Any = ""
+    notes: Any = ""
+
+
+class StudySpecificFormsRows(list):
+    """
+    The rows of one eCRF as a list, plus ecrf_stats: the node, table and TR
+    counts EcrfScan took while building them (empty when unknown). The
+    counts travel with the rows through the stage cache and process pools,
+    so the run report records them without walking the eCRF again.
+    """
+
+    def __init__(self, rows: Iterable[StudySpecificFormsRow] = (), ecrf_stats: Optional[Dict[str, int]] = None):
+        super().__init__(rows)
+        self.ecrf_stats = dict(ecrf_stats or {})
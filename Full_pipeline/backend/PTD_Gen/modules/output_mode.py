@@ -0,0 +1,271 @@
+"""
+Output Mode Module
+
+Chooses the PTD output mode (default, fast, surgery or stream) for --auto runs
+from the size of the input documents, the template and the memory available.
+
+Default and fast build the generated sheets as openpyxl workbooks and then
+transplant their XML into the pre-parsed template (modules.template_cache), so
+they hold every generated cell once as an openpyxl cell and later as XML text;
+the template itself is never loaded into openpyxl, only its text parts
+(styles, shared strings, workbook) are read. Stream and surgery write rows as
+they are produced. The planner estimates the peak of each mode and
+picks the richest one that fits the memory budget; check_memory_budget lets the
+template assembly bail out at runtime (counting live child processes too) so the
+caller can fall back to streaming.
+"""
+
+import json
+import logging
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+# Rough cost model (bytes); deliberately conservative
+BASE_PROCESS_BYTES = 100 * 1024 * 1024   # interpreter, pandas, openpyxl
+JSON_EXPANSION = 10                      # parsed JSON vs. file size
+TEMPLATE_EXPANSION = 10                  # template text parts + member table vs. zipped file size
+# default/fast: openpyxl cell of the generated sheet (~470 B traced, plus
+# allocator overhead), then ~200 B of transplanted XML once that workbook is gone;
+# fast skips the forms-sheet formatting pass
+BYTES_PER_CELL = {"default": 700, "fast": 650, "surgery": 120, "stream": 120}
+FORMS_SHEET_COLUMNS = 26
+GRID_FIXED_COLUMNS = 6
+GRID_HEADER_ROWS = 5
+
+# Share of available memory used as the budget when none is given
+AUTO_MEMORY_FRACTION = 0.5
+
+# Richest first; --auto takes the first one that fits
+TEMPLATE_MODES = ("default", "fast", "surgery")
+
+_FORM_NAME_RE = re.compile(r"\[[A-Z0-9_\-]{3,}\]|\b(?:Non-)?[Rr]epeating\b")
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """Raised by check_memory_budget when the process outgrows its budget."""
+
+
+def node_kind(node: Dict[str, Any]) -> str:
+    """Last path element of a node name without its index, e.g. '//Document/Table[2]' -> 'Table'."""
+    name = node.get("name") or ""
+    return re.sub(r"\[\d+\]$", "", name.rsplit("/", 1)[-1])
+
+
+def measure_document(json_path: str) -> Dict[str, int]:
+    """
+    Walk a structured-data JSON document and count what drives output size.
+
+    Returns:
+        Dict with file_bytes, nodes, tables, table_rows, max_row_cells and
+        form_headings (headings that look like eCRF form names)
+    """
+    with open(json_path, "r", encoding="utf-8") as f:
+        root = json.load(f)
+
+    stats = {
+        "file_bytes": os.path.getsize(json_path),
+        "nodes": 0,
+        "tables": 0,
+        "table_rows": 0,
+        "max_row_cells": 0,
+        "form_headings": 0,
+    }
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, dict):
+            continue
+        stats["nodes"] += 1
+        kind = node_kind(node)
+        children = node.get("children") or []
+        if kind == "Table":
+            stats["tables"] += 1
+        elif kind == "TR":
+            stats["table_rows"] += 1
+            cells = sum(1 for c in children if isinstance(c, dict) and node_kind(c) in ("TD", "TH"))
+            stats["max_row_cells"] = max(stats["max_row_cells"], cells)
+        elif kind in ("H1", "H2", "H3") and _FORM_NAME_RE.search(node.get("text") or ""):
+            stats["form_headings"] += 1
+        stack.extend(children)
+    return stats
+
+
+def available_memory_bytes() -> Optional[int]:
+    """Memory available to new allocations (MemAvailable on Linux, psutil elsewhere)."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return int(psutil.virtual_memory().available)
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def current_rss_bytes() -> Optional[int]:
+    """Resident set size of this process, or None when it cannot be read."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+        return int(psutil.Process().memory_info().rss)
+    except ImportError:
+        return None
+
+
+def _child_pids(pid: int) -> List[int]:
+    """Live descendants of pid (Linux /proc, psutil elsewhere)."""
+    try:
+        children = []
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children", "r") as f:
+                children.extend(int(c) for c in f.read().split())
+        return children + [d for c in children for d in _child_pids(c)]
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+        return [c.pid for c in psutil.Process(pid).children(recursive=True)]
+    except Exception:
+        return []
+
+
+def children_rss_bytes() -> int:
+    """Summed RSS of this process's live child processes (stage and --workers pools)."""
+    total = 0
+    for pid in _child_pids(os.getpid()):
+        try:
+            with open(f"/proc/{pid}/statm", "r") as f:
+                total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            continue
+        except (OSError, ValueError, IndexError, AttributeError):
+            pass
+        try:
+            import psutil
+            total += int(psutil.Process(pid).memory_info().rss)
+        except Exception:
+            pass  # exited meanwhile, or no way to read it
+    return total
+
+
+def check_memory_budget(budget_bytes: Optional[int], where: str) -> None:
+    """
+    Raise MemoryBudgetExceeded if the RSS of this process and its live child
+    processes is above budget_bytes (None = no limit). The check runs at the
+    template assembly checkpoints, so worker pools that already finished
+    (stage graph, --workers) are not counted: the budget guards the assembly
+    step, the --auto estimate covers the rest of the run.
+    """
+    if not budget_bytes:
+        return
+    rss = current_rss_bytes()
+    if rss is None:
+        return
+    children = children_rss_bytes()
+    if rss + children > budget_bytes:
+        detail = f" (children {children / 1048576:.0f} MB)" if children else ""
+        raise MemoryBudgetExceeded(
+            f"RSS {(rss + children) / 1048576:.0f} MB{detail} exceeds memory budget "
+            f"{budget_bytes / 1048576:.0f} MB {where}"
+        )
+
+
+def estimate_peak_bytes(mode: str, protocol: Dict[str, int], ecrf: Dict[str, int], template_bytes: int) -> int:
+    """Estimated peak memory of one output mode for the measured inputs."""
+    forms = max(ecrf["form_headings"], ecrf["tables"], 1)
+    grid_cells = (forms + GRID_HEADER_ROWS) * (protocol["max_row_cells"] + GRID_FIXED_COLUMNS)
+    # Every eCRF table row can become an item row on the forms sheet
+    forms_cells = (ecrf["table_rows"] + 3) * FORMS_SHEET_COLUMNS
+    peak = BASE_PROCESS_BYTES + JSON_EXPANSION * max(protocol["file_bytes"], ecrf["file_bytes"])
+    peak += (grid_cells + forms_cells) * BYTES_PER_CELL[mode]
+    if mode in TEMPLATE_MODES:
+        peak += TEMPLATE_EXPANSION * template_bytes
+    return peak
+
+
+def choose_output_mode(
+    protocol_json: str,
+    ecrf_json: str,
+    template_xlsx: Optional[str] = None,
+    memory_budget_mb: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    Pick an output mode for --auto.
+
+    Without a template only --stream can produce a workbook. With one, the
+    template's other sheets must survive, so the choice is among default
+    (full formatting), fast (no forms-sheet formatting pass) and surgery
+    (streamed sheets, constant memory): the first whose estimated peak fits
+    the budget wins, with surgery as the streaming fallback. The estimates
+    assume the XML transplant; a template that lacks a target sheet makes
+    default/fast copy through openpyxl, which the runtime budget check guards.
+
+    Args:
+        protocol_json: Protocol structured-data JSON
+        ecrf_json: eCRF structured-data JSON
+        template_xlsx: Template workbook, if any
+        memory_budget_mb: Budget in MB; defaults to AUTO_MEMORY_FRACTION of
+                          the memory currently available (no limit if unknown)
+
+    Returns:
+        Dict with mode, reason, budget_bytes, estimates (mode -> bytes) and the
+        measured protocol/ecrf stats
+    """
+    protocol = measure_document(protocol_json)
+    ecrf = measure_document(ecrf_json)
+    template_bytes = os.path.getsize(template_xlsx) if template_xlsx else 0
+
+    if memory_budget_mb is not None:
+        budget = int(memory_budget_mb * 1024 * 1024)
+        budget_source = "--memory-budget-mb"
+    else:
+        available = available_memory_bytes()
+        budget = int(available * AUTO_MEMORY_FRACTION) if available else None
+        budget_source = f"{AUTO_MEMORY_FRACTION:.0%} of available memory" if available else "unknown memory"
+
+    modes = TEMPLATE_MODES if template_xlsx else ("stream",)
+    estimates = {m: estimate_peak_bytes(m, protocol, ecrf, template_bytes) for m in modes}
+
+    def mb(n: Optional[int]) -> str:
+        return "unlimited" if n is None else f"{n / 1048576:.0f} MB"
+
+    if not template_xlsx:
+        mode = "stream"
+        reason = "no template given; streaming a new workbook"
+    else:
+        mode = next((m for m in TEMPLATE_MODES if budget is None or estimates[m] <= budget), "surgery")
+        if budget is not None and estimates[mode] > budget:
+            reason = f"no mode fits the budget; falling back to streaming surgery (estimated {mb(estimates[mode])})"
+        else:
+            reason = f"estimated peak {mb(estimates[mode])} fits the budget"
+            skipped = TEMPLATE_MODES[:TEMPLATE_MODES.index(mode)]
+            if skipped:
+                reason += "; " + ", ".join(f"{m} needs ~{mb(estimates[m])}" for m in skipped)
+
+    logging.info(
+        f"Auto mode inputs: protocol {protocol['nodes']} nodes/{protocol['tables']} tables "
+        f"(widest row {protocol['max_row_cells']} cells), eCRF {ecrf['nodes']} nodes/{ecrf['tables']} tables/"
+        f"{ecrf['form_headings']} form headings/{ecrf['table_rows']} table rows, "
+        f"template {template_bytes} bytes"
+    )
+    logging.info(f"Auto mode selected '{mode}': {reason} (budget {mb(budget)}, {budget_source})")
+    return {
+        "mode": mode,
+        "reason": reason,
+        "budget_bytes": budget,
+        "estimates": estimates,
+        "protocol": protocol,
+        "ecrf": ecrf,
+    }
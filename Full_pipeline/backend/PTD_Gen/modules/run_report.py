@@ -0,0 +1,236 @@
+"""
+Run Report Module
+
+Machine-readable summary of a PTD run (<output>.run_report.json): wall and
+CPU time, RSS before/after and optionally the tracemalloc peak of every
+stage, input document statistics and the size of every output sheet.
+
+The default measurements (perf_counter, thread CPU time, /proc RSS) cost a
+few microseconds per stage and the document statistics are taken from what
+the run already produced (the eCRF's node counts come from the forms
+scan), so the report is always written. Memory tracing slows Python
+allocations down noticeably and is only enabled on request; walking both
+JSON documents for their full measurements comes with it.
+"""
+
+import contextlib
+import csv
+import json
+import logging
+import os
+import re
+import sys
+import time
+import tracemalloc
+import zipfile
+from typing import Any, Dict, Iterator, Optional
+
+from .output_mode import current_rss_bytes, measure_document
+
+REPORT_FILE = "run_report.json"
+REPORT_VERSION = 1
+# Study Specific Forms header rows (CTDM row, group headers, subheaders)
+FORMS_HEADER_ROWS = 3
+
+_DIMENSION_RE = re.compile(r'<dimension ref="([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?"')
+
+
+@contextlib.contextmanager
+def measure(trace_memory: bool = False) -> Iterator[Dict[str, Any]]:
+    """
+    Measure the enclosed block into the yielded dict (filled in on exit):
+    wall_s, cpu_s (CPU time of the calling thread), rss_before_bytes,
+    rss_after_bytes, pid and, with trace_memory, traced_peak_bytes (peak
+    Python allocations above what was already traced). Tracing that is
+    started here is stopped again; callers running stages on threads should
+    start tracemalloc themselves so concurrent stages share one tracer.
+    """
+    metrics: Dict[str, Any] = {}
+    started_tracing = False
+    traced_before = 0
+    if trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        traced_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    rss_before = current_rss_bytes()
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        yield metrics
+    finally:
+        metrics["wall_s"] = round(time.perf_counter() - wall_start, 6)
+        metrics["cpu_s"] = round(time.thread_time() - cpu_start, 6)
+        metrics["rss_before_bytes"] = rss_before
+        metrics["rss_after_bytes"] = current_rss_bytes()
+        metrics["pid"] = os.getpid()
+        if trace_memory:
+            metrics["traced_peak_bytes"] = max(0, tracemalloc.get_traced_memory()[1] - traced_before)
+            if started_tracing:
+                tracemalloc.stop()
+
+
+def _peak_rss_bytes() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return int(peak) if sys.platform == "darwin" else int(peak) * 1024
+
+
+def _column_number(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + (ord(ch) - 64)
+    return n
+
+
+def sheet_dimensions(xlsx_path: str) -> Dict[str, Dict[str, int]]:
+    """
+    Rows and columns of every sheet of a workbook, read from each sheet's
+    <dimension> element (the sheet XML itself is not parsed).
+    """
+    from .template_cache import PreparsedTemplate
+
+    template = PreparsedTemplate.parse(xlsx_path, digest="-")
+    dims: Dict[str, Dict[str, int]] = {}
+    with zipfile.ZipFile(xlsx_path, "r") as zin:
+        for name, member in template.sheet_parts.items():
+            with zin.open(member) as f:
+                head = f.read(64 * 1024).decode("utf-8", errors="ignore")
+            m = _DIMENSION_RE.search(head)
+            if not m:
+                continue
+            first_col, first_row, last_col, last_row = m.groups()
+            last_col, last_row = last_col or first_col, last_row or first_row
+            dims[name] = {
+                "rows": int(last_row) - int(first_row) + 1,
+                "columns": _column_number(last_col) - _column_number(first_col) + 1,
+            }
+    return dims
+
+
+def _csv_rows(path: str) -> int:
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        return max(0, sum(1 for _ in csv.reader(f)) - 1)
+
+
+def _xlsx_rows(path: str) -> int:
+    # First sheet's <dimension>, without loading the workbook
+    dims = sheet_dimensions(path)
+    return max(0, next(iter(dims.values()))["rows"] - 1) if dims else 0
+
+
+def default_report_path(output_path: str) -> str:
+    """<output>.run_report.json, so runs writing to the same directory keep their own report."""
+    return os.path.splitext(os.path.abspath(output_path))[0] + "." + REPORT_FILE
+
+
+def document_statistics(protocol_json: str, ecrf_json: str, artifacts: Dict[str, Any],
+                        measured_documents: Optional[Dict[str, Dict[str, int]]] = None,
+                        walk_documents: bool = False,
+                        ecrf_stats: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """
+    Input statistics: the number of extracted forms, SoA procedures, visits
+    and Study Specific Forms items taken from the stage artifacts that are
+    present, plus the size of both documents.
+
+    Node/table/TR counts of the documents come from measured_documents
+    ("protocol"/"ecrf", e.g. the --auto plan's measurements) or, with
+    walk_documents, from loading and walking both files again. Otherwise
+    their file size is recorded, with the eCRF's counts from the forms scan
+    (the forms_rows artifact's ecrf_stats, or ecrf_stats when the rows were
+    streamed).
+    """
+    rows = artifacts.get("forms_rows")
+    scanned = {"ecrf": getattr(rows, "ecrf_stats", None) or ecrf_stats or {}}
+    stats: Dict[str, Any] = {}
+    for key, path in (("protocol", protocol_json), ("ecrf", ecrf_json)):
+        if measured_documents and key in measured_documents:
+            stats[key] = measured_documents[key]
+        elif walk_documents:
+            stats[key] = measure_document(path)
+        else:
+            stats[key] = dict(scanned.get(key, {}), file_bytes=os.path.getsize(path))
+    counters = (("forms", "forms_csv", _csv_rows), ("procedures", "schedule_csv", _csv_rows),
+                ("matrix_forms", "matrix_csv", _csv_rows), ("visits", "visits_xlsx", _xlsx_rows))
+    for key, artifact, count in counters:
+        path = artifacts.get(artifact)
+        if path and os.path.isfile(path):
+            try:
+                stats[key] = count(path)
+            except Exception as e:
+                logging.debug(f"Run report: could not count {artifact}: {e}")
+    if rows is not None:
+        stats["items"] = len(rows)
+    return stats
+
+
+class RunReport:
+    """
+    Collects the measurements of one run and writes them as JSON.
+
+    Args:
+        trace_memory: Also record the tracemalloc peak of every stage
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.started_at = time.time()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self.run: Dict[str, Any] = {}
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.documents: Dict[str, Any] = {}
+        self.outputs: Dict[str, Any] = {}
+
+    @contextlib.contextmanager
+    def stage(self, stage_name: str) -> Iterator[None]:
+        """Measure an in-process step that is not part of a stage graph."""
+        with measure(self.trace_memory) as metrics:
+            yield
+        self.stages[stage_name] = metrics
+
+    def add_output(self, path: str) -> None:
+        """Record an output workbook and the dimensions of its sheets."""
+        entry: Dict[str, Any] = {"path": os.path.abspath(path), "bytes": os.path.getsize(path)}
+        try:
+            entry["sheets"] = sheet_dimensions(path)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            logging.warning(f"Run report: could not read sheet dimensions of {path}: {e}")
+        forms = entry.get("sheets", {}).get("Study Specific Forms")
+        if forms and "items" not in self.documents:
+            self.documents["items"] = max(0, forms["rows"] - FORMS_HEADER_ROWS)
+        self.outputs = entry
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": REPORT_VERSION,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "run": dict(
+                self.run,
+                wall_s=round(time.perf_counter() - self._wall_start, 6),
+                cpu_s=round(time.process_time() - self._cpu_start, 6),
+                peak_rss_bytes=_peak_rss_bytes(),
+                trace_memory=self.trace_memory,
+            ),
+            "stages": self.stages,
+            "documents": self.documents,
+            "output": self.outputs,
+        }
+
+    def write(self, path: str) -> str:
+        """Write the report (atomically) and return its path."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        os.replace(tmp_path, path)
+        logging.info(f"Run report written to {path}")
+        return path
+
+
+def measured(report: Optional[RunReport], stage_name: str):
+    """report.stage(stage_name), or a no-op context when there is no report."""
+    return report.stage(stage_name) if report is not None else contextlib.nullcontext()
@@ -378,56 +378,76 @@ def generate_schedule_grid(visits_xlsx: str, forms_csv: str, output_xlsx: str,
         raise
 
 
-def generate_schedule_grid_stream(
+# Cell formats shared by the row model and the streaming writers, keyed by role.
+SCHEDULE_GRID_FORMATS: Dict[str, Dict[str, Any]] = {
+    'header': {'bold': True, 'align': 'center', 'valign': 'vcenter', 'text_wrap': True, 'bg_color': '#D9E1F2', 'border': 1},
+    'group': {'bold': True, 'align': 'center', 'valign': 'vcenter', 'text_wrap': True, 'bg_color': '#D9E1F2', 'border': 1},
+    'grey': {'bold': True, 'align': 'left', 'valign': 'vcenter', 'text_wrap': True, 'bg_color': '#E7E6E6', 'border': 1},
+    'bold_center': {'bold': True, 'align': 'center', 'valign': 'vcenter', 'text_wrap': True, 'border': 1},
+    'center': {'align': 'center', 'valign': 'vcenter', 'text_wrap': True, 'border': 1},
+    'left': {'align': 'left', 'valign': 'vcenter', 'text_wrap': True, 'border': 1},
+}
+
+
+def _sanitize_cell_value(value: Any) -> Any:
+    """Convert NaN/Inf/None to safe Excel-friendly values."""
+    try:
+        if pd.isna(value):
+            return ""
+    except Exception:
+        pass
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return ""
+        if value.is_integer():
+            return int(value)
+    return value
+
+
+def build_schedule_grid_rows(
     visits_xlsx: str,
     forms_csv: str,
-    workbook,
-    sheet_name: str = "Schedule Grid",
     config: Dict[str, Any] = None,
-) -> None:
+) -> Dict[str, Any]:
     """
-    Stream-write the schedule grid directly into an existing XlsxWriter workbook.
-    Preserves the same formatting semantics as build_schedule_layout, but writes
-    row-by-row with constant memory.
+    Compute the schedule grid as rows of cells without building a workbook.
+
+    The XlsxWriter stream writer (generate_schedule_grid_stream) and the
+    worksheet part renderers all write this model. Each row is a list of
+    (value, format_key) tuples where format_key indexes SCHEDULE_GRID_FORMATS
+    (None for an unformatted blank cell). Rows are yielded in sheet order so
+    callers can stream them.
 
     Args:
         visits_xlsx: Path to visits-with-groups Excel (first sheet used)
         forms_csv: Path to forms matrix CSV file
-        workbook: An xlsxwriter.Workbook instance (opened with constant_memory)
-        sheet_name: Name of the sheet to create
         config: Optional configuration dictionary
-    """
-    import pandas as pd  # Local import to avoid imposing dependency at import time
-    import math
 
+    Returns:
+        Dict with 'rows' (generator of rows), 'merges' (zero-based
+        (first_row, first_col, last_row, last_col) tuples), 'freeze_panes'
+        (zero-based (row, col)), 'num_cols' and 'formats'
+        (SCHEDULE_GRID_FORMATS).
+    """
     if config is None:
         config = {}
 
-    # Load inputs
     df_visits = pd.read_excel(visits_xlsx, sheet_name=0)
-    # We'll stream forms CSV in chunks to avoid loading it fully into memory
-    # when writing the large forms table.
-
-    # Normalize columns
     df_visits.columns = [str(c).strip() for c in df_visits.columns]
 
     visit_groups = df_visits["Event Group"].astype(str).tolist()
     visit_labels = df_visits["Visit Name"].astype(str).tolist()
     num_visits = len(visit_labels)
-
     event_names = [
         make_event_name(visit_groups[i], visit_labels[i], i, config)
         for i in range(num_visits)
     ]
 
-    # Locate first Randomisation index
-    rand_idx = None
+    rand_idx = 0
     for i, g in enumerate(visit_groups):
         if "random" in str(g).lower():
             rand_idx = i
             break
-    if rand_idx is None:
-        rand_idx = 0
 
     left_columns = config.get('left_columns', ['Form Label', 'Form Name', 'Source'])
     extra_headers = config.get('extra_headers', [
@@ -435,138 +455,12 @@ def generate_schedule_grid_stream(
         'Additional Programming Instructions'
     ])
 
-    # Create worksheet
-    ws = workbook.add_worksheet(sheet_name)
-
-    # Define formats
-    fmt_header = workbook.add_format({'bold': True, 'align': 'center', 'valign': 'vcenter', 'text_wrap': True, 'bg_color': '#D9E1F2', 'border': 1})
-    fmt_group = workbook.add_format({'bold': True, 'align': 'center', 'valign': 'vcenter', 'text_wrap': True, 'bg_color': '#D9E1F2', 'border': 1})
-    fmt_grey = workbook.add_format({'bold': True, 'align': 'left', 'valign': 'vcenter', 'text_wrap': True, 'bg_color': '#E7E6E6', 'border': 1})
-    fmt_bold_center = workbook.add_format({'bold': True, 'align': 'center', 'valign': 'vcenter', 'text_wrap': True, 'border': 1})
-    fmt_center = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'text_wrap': True, 'border': 1})
-    fmt_left = workbook.add_format({'align': 'left', 'valign': 'vcenter', 'text_wrap': True, 'border': 1})
-
-    # Track column widths
-    max_width_by_col = {}
-    def update_width(col_idx: int, value: Any):
-        if value is None:
-            return
-        try:
-            text = str(value)
-        except Exception:
-            text = ""
-        width = max(1, len(text))
-        prev = max_width_by_col.get(col_idx, 0)
-        if width > prev:
-            max_width_by_col[col_idx] = width
-
-    def sanitize(value: Any):
-        """Convert NaN/Inf/None to safe Excel-friendly values."""
-        # Pandas NA
-        try:
-            if pd.isna(value):
-                return ""
-        except Exception:
-            pass
-        # Numeric infinities
-        try:
-            if isinstance(value, (int,)):
-                return value
-            if isinstance(value, float):
-                if not math.isfinite(value):
-                    return ""
-                # Prefer ints for integral floats
-                if value.is_integer():
-                    return int(value)
-                return value
-        except Exception:
-            pass
-        # Default passthrough
-        return value
-
-    # Header rows 1-3
-    # Left columns (3 columns)
-    for i, lbl in enumerate(left_columns):
-        col = i
-        for row in (0, 1, 2):
-            v = lbl if row == 1 else None
-            ws.write(row, col, v, fmt_header)
-            update_width(col, v if v is not None else "")
-
-    # After Source column index
     col_after_source = len(left_columns)
-
-    # Event group/label/name columns (three header rows)
-    ws.write(0, col_after_source, "Event Group:", fmt_header)
-    ws.write(1, col_after_source, "Event Label:", fmt_header)
-    ws.write(2, col_after_source, "Event Name:", fmt_header)
-    update_width(col_after_source, "Event Group:")
-    update_width(col_after_source, "Event Label:")
-    update_width(col_after_source, "Event Name:")
-
-    # RTSM column
     col_rtsm = col_after_source + 1
-    for row in (0, 1, 2):
-        ws.write(row, col_rtsm, "RTSM", fmt_header)
-        update_width(col_rtsm, "RTSM")
-
     col_start_visits = col_rtsm + 1
+    col_start_extra = col_start_visits + num_visits
+    num_cols = col_start_extra + len(extra_headers)
 
-    # Row 2: Event Label
-    for j, vlabel in enumerate(visit_labels):
-        c = col_start_visits + j
-        if event_names[j] == "SCRN":
-            event_label = "Screening"
-        elif event_names[j] == "RAND":
-            event_label = "Randomisation"
-        elif "V" in event_names[j]:
-            event_label = f"Visit {event_names[j][1:]}"
-        elif "P" in event_names[j]:
-            event_label = f"Phone Visit {event_names[j][1:]}"
-        else:
-            event_label = vlabel
-        ws.write(1, c, event_label, fmt_bold_center)
-        update_width(c, event_label)
-
-    # Row 3: Event Name
-    for j, ename in enumerate(event_names):
-        c = col_start_visits + j
-        ws.write(2, c, ename, fmt_bold_center)
-        update_width(c, ename)
-
-    # Row 1: Event Group merged ranges
-    cur_group, group_start_col = None, None
-    for j, g in enumerate(visit_groups):
-        c = col_start_visits + j
-        if cur_group is None:
-            cur_group, group_start_col = g, c
-        if g != cur_group:
-            if c - 1 > group_start_col:
-                ws.merge_range(0, group_start_col, 0, c - 1, cur_group, fmt_group)
-            else:
-                ws.write(0, group_start_col, cur_group, fmt_group)
-            for cc in range(group_start_col, c):
-                update_width(cc, cur_group)
-            cur_group, group_start_col = g, c
-    if group_start_col is not None:
-        end_col = col_start_visits + num_visits - 1
-        if end_col > group_start_col:
-            ws.merge_range(0, group_start_col, 0, end_col, cur_group, fmt_group)
-        else:
-            ws.write(0, group_start_col, cur_group, fmt_group)
-        for cc in range(group_start_col, col_start_visits + num_visits):
-            update_width(cc, cur_group)
-
-    # Extra headers after visits
-    for idx, h in enumerate(extra_headers):
-        c = col_start_visits + num_visits + idx
-        ws.write(0, c, "", fmt_header)
-        ws.write(1, c, h, fmt_bold_center)
-        ws.write(2, c, "", fmt_header)
-        update_width(c, h)
-
-    # Blocks: Visit Dynamics + Event Window
-    cur_row = 3
     dynamic_rows = [
         "Visit Dynamics (If Y, then Event should appear based on triggering criteria)",
         "Triggering: Event",
@@ -582,128 +476,204 @@ def generate_schedule_grid_stream(
     ]
     sections = [("Visit Dynamic Properties", dynamic_rows), ("Event Window Configuration", event_window_rows)]
 
-    for section_title, attrs in sections:
-        # Section header merged over left columns (avoid single-cell merge)
-        end_col_left = len(left_columns) - 1
-        if end_col_left > 0:
-            ws.merge_range(cur_row, 0, cur_row, end_col_left, section_title, fmt_grey)
+    # Merged ranges: event groups on row 1, then each section/attribute label
+    merges: List[tuple] = []
+    group_spans: List[tuple] = []
+    cur_group, group_start_col = None, None
+    for j, g in enumerate(visit_groups):
+        c = col_start_visits + j
+        if cur_group is None:
+            cur_group, group_start_col = g, c
+        if g != cur_group:
+            group_spans.append((cur_group, group_start_col, c - 1))
+            cur_group, group_start_col = g, c
+    if group_start_col is not None:
+        group_spans.append((cur_group, group_start_col, col_start_visits + num_visits - 1))
+    for _, start_col, end_col in group_spans:
+        if end_col > start_col:
+            merges.append((0, start_col, 0, end_col))
+
+    end_col_left = len(left_columns) - 1
+    label_rows = 3 + sum(1 + len(attrs) for _, attrs in sections)
+    if end_col_left > 0:
+        for r in range(3, label_rows):
+            merges.append((r, 0, r, end_col_left))
+    forms_start_row = label_rows
+
+    def event_label_for(j: int) -> str:
+        ename = event_names[j]
+        if ename == "SCRN":
+            return "Screening"
+        if ename == "RAND":
+            return "Randomisation"
+        if "V" in ename:
+            return f"Visit {ename[1:]}"
+        if "P" in ename:
+            return f"Phone Visit {ename[1:]}"
+        return visit_labels[j]
+
+    def attr_value(attr: str, j: int) -> Any:
+        mapped_value: Any = ""
+        if attr.startswith("Visit Dynamics"):
+            eg = str(visit_groups[j]).lower()
+            if j >= rand_idx and ("end of treatment" not in eg and "end of study" not in eg):
+                mapped_value = "Y"
+        elif attr.startswith("Triggering: Event"):
+            if event_names[j] == "RAND":
+                mapped_value = "SCRN"
+            elif event_names[j].startswith("V") and j > 0:
+                mapped_value = event_names[j - 1]
+            elif event_names[j].lower() == "follow-up":
+                mapped_value = "EOT"
+        elif attr.startswith("Triggering: Form"):
+            if event_names[j] == "RAND":
+                mapped_value = "ELIGIBILITY_CRITERIA"
+            elif j > rand_idx and "V" in visit_labels[j]:
+                mapped_value = "RANDOMISATION"
+        elif attr.startswith("Assign Visit Window"):
+            mapped_value = "Y"
         else:
-            ws.write(cur_row, 0, section_title, fmt_grey)
-        for cc in range(0, len(left_columns)):
-            update_width(cc, section_title)
-        cur_row += 1
-
-        for attr in attrs:
-            # Label cell merged over left columns (avoid single-cell merge)
-            end_col_left = len(left_columns) - 1
-            if end_col_left > 0:
-                ws.merge_range(cur_row, 0, cur_row, end_col_left, attr, fmt_grey)
-            else:
-                ws.write(cur_row, 0, attr, fmt_grey)
-            update_width(0, attr)
-
-            for j in range(num_visits):
-                c = col_start_visits + j
-                mapped_value = ""
-
-                if attr.startswith("Visit Dynamics"):
-                    eg = str(visit_groups[j]).lower()
-                    if j >= rand_idx and ("end of treatment" not in eg and "end of study" not in eg):
-                        mapped_value = "Y"
-                elif attr.startswith("Triggering: Event"):
-                    if event_names[j] == "RAND":
-                        mapped_value = "SCRN"
-                    elif event_names[j].startswith("V") and j > 0:
-                        mapped_value = event_names[j - 1]
-                    elif event_names[j].lower() == "follow-up":
-                        mapped_value = "EOT"
-                elif attr.startswith("Triggering: Form"):
-                    mapped_value = ""
-                    if event_names[j] == "RAND":
-                        mapped_value = "ELIGIBILITY_CRITERIA"
-                    elif j > rand_idx:
-                        if "V" in visit_labels[j]:
-                            if mapped_value == "":
-                                mapped_value = "RANDOMISATION"
-                elif attr.startswith("Assign Visit Window"):
-                    mapped_value = "Y"
-                elif attr.startswith("Offset Type") and "Offset Type" in df_visits.columns:
-                    mapped_value = df_visits.iloc[j].get("Offset Type", "")
-                elif attr.startswith("Offset Days") and "Offset Days" in df_visits.columns:
-                    mapped_value = df_visits.iloc[j].get("Offset Days", "")
-                elif attr.startswith("Day Range - Early") and "Day Range - Early" in df_visits.columns:
-                    mapped_value = df_visits.iloc[j].get("Day Range - Early", "")
-                elif attr.startswith("Day Range - Late") and "Day Range - Late" in df_visits.columns:
-                    mapped_value = df_visits.iloc[j].get("Day Range - Late", "")
-
-                if pd.isna(mapped_value):
-                    mapped_value = ""
-                v = sanitize(mapped_value)
-                ws.write(cur_row, c, v, fmt_center)
-                update_width(c, v)
-
-            # RTSM column for this row
-            ws.write(cur_row, col_rtsm, "", fmt_center)
-            cur_row += 1
-
-    # Forms table
-    forms_start_row = cur_row
-
-    # RTSM row
-    ws.write(forms_start_row, 0, "RTSM", fmt_left)
-    ws.write(forms_start_row, 1, "RTSM", fmt_left)
-    ws.write(forms_start_row, 2, "Library", fmt_left)
-    ws.write(forms_start_row, col_rtsm, "X", fmt_center)
-    update_width(0, "RTSM"); update_width(1, "RTSM"); update_width(2, "Library"); update_width(col_rtsm, "X")
-    for idx in range(len(extra_headers)):
-        c = col_start_visits + num_visits + idx
-        ws.write(forms_start_row, c, "", fmt_center)
-    cur_row = forms_start_row + 1
-
-    # Data rows from forms CSV, streamed in chunks
-    chunksize = int(config.get('forms_csv_chunksize', 1000))
-    for df_chunk in pd.read_csv(forms_csv, chunksize=chunksize):
-        # normalize chunk column names
-        df_chunk.columns = [str(c).strip() for c in df_chunk.columns]
-        for _, r in df_chunk.iterrows():
-            v0 = sanitize(r.get('Form Label', ''))
-            v1 = sanitize(r.get('Form Name', ''))
-            v2 = sanitize(r.get('Source', ''))
-            ws.write(cur_row, 0, v0, fmt_left); update_width(0, v0)
-            ws.write(cur_row, 1, v1, fmt_left); update_width(1, v1)
-            ws.write(cur_row, 2, v2, fmt_left); update_width(2, v2)
-            ws.write(cur_row, col_rtsm, "", fmt_center)
-
-            for j, vlabel in enumerate(visit_labels):
-                c = col_start_visits + j
-                val = ""
-                if vlabel in r.index:
-                    val = r[vlabel]
-                else:
-                    en = event_names[j]
-                    if en in r.index:
-                        val = r[en]
-                if pd.isna(val):
+            for column in ("Offset Type", "Offset Days", "Day Range - Early", "Day Range - Late"):
+                if attr.startswith(column) and column in df_visits.columns:
+                    mapped_value = df_visits.iloc[j].get(column, "")
+                    break
+        return _sanitize_cell_value(mapped_value)
+
+    def blank_row() -> List[tuple]:
+        return [(None, None)] * num_cols
+
+    def iter_rows():
+        # Header rows 1-3
+        header_rows = [blank_row(), blank_row(), blank_row()]
+        for i, lbl in enumerate(left_columns):
+            header_rows[0][i] = (None, 'header')
+            header_rows[1][i] = (lbl, 'header')
+            header_rows[2][i] = (None, 'header')
+        for r, text in enumerate(("Event Group:", "Event Label:", "Event Name:")):
+            header_rows[r][col_after_source] = (text, 'header')
+            header_rows[r][col_rtsm] = ("RTSM", 'header')
+        for name, start_col, end_col in group_spans:
+            header_rows[0][start_col] = (name, 'group')
+            for c in range(start_col + 1, end_col + 1):
+                header_rows[0][c] = (None, 'group')
+        for j in range(num_visits):
+            header_rows[1][col_start_visits + j] = (event_label_for(j), 'bold_center')
+            header_rows[2][col_start_visits + j] = (event_names[j], 'bold_center')
+        for idx, h in enumerate(extra_headers):
+            c = col_start_extra + idx
+            header_rows[0][c] = ("", 'header')
+            header_rows[1][c] = (h, 'bold_center')
+            header_rows[2][c] = ("", 'header')
+        yield from header_rows
+
+        # Blocks: Visit Dynamics + Event Window
+        for section_title, attrs in sections:
+            row = blank_row()
+            row[0] = (section_title, 'grey')
+            for c in range(1, len(left_columns)):
+                row[c] = (None, 'grey')
+            yield row
+            for attr in attrs:
+                row = blank_row()
+                row[0] = (attr, 'grey')
+                for c in range(1, len(left_columns)):
+                    row[c] = (None, 'grey')
+                row[col_rtsm] = ("", 'center')
+                for j in range(num_visits):
+                    row[col_start_visits + j] = (attr_value(attr, j), 'center')
+                yield row
+
+        # Forms table: RTSM row first
+        row = blank_row()
+        row[0] = ("RTSM", 'left')
+        row[1] = ("RTSM", 'left')
+        row[2] = ("Library", 'left')
+        row[col_rtsm] = ("X", 'center')
+        for idx in range(len(extra_headers)):
+            row[col_start_extra + idx] = ("", 'center')
+        yield row
+
+        chunksize = int(config.get('forms_csv_chunksize', 1000))
+        for df_chunk in pd.read_csv(forms_csv, chunksize=chunksize):
+            df_chunk.columns = [str(c).strip() for c in df_chunk.columns]
+            for _, r in df_chunk.iterrows():
+                row = blank_row()
+                row[0] = (_sanitize_cell_value(r.get('Form Label', '')), 'left')
+                row[1] = (_sanitize_cell_value(r.get('Form Name', '')), 'left')
+                row[2] = (_sanitize_cell_value(r.get('Source', '')), 'left')
+                row[col_rtsm] = ("", 'center')
+                for j, vlabel in enumerate(visit_labels):
                     val = ""
-                v = sanitize(val)
-                ws.write(cur_row, c, v, fmt_center); update_width(c, v)
-
-            # Extra columns
-            extra_vals = {
-                "Is Form Dynamic?": r.get("Is Form Dynamic?", "") or r.get("Is Form Dynamic", "") or r.get("IsDynamic", ""),
-                "Form Dynamic Criteria": r.get("Form Dynamic Criteria", "") or r.get("Form Dynamic Criteria ", "")
-            }
-            for idx, colname in enumerate(extra_headers):
-                c = col_start_visits + num_visits + idx
-                val = sanitize(extra_vals.get(colname, ""))
-                ws.write(cur_row, c, val, fmt_center); update_width(c, val)
+                    if vlabel in r.index:
+                        val = r[vlabel]
+                    elif event_names[j] in r.index:
+                        val = r[event_names[j]]
+                    row[col_start_visits + j] = (_sanitize_cell_value(val), 'center')
+                extra_vals = {
+                    "Is Form Dynamic?": r.get("Is Form Dynamic?", "") or r.get("Is Form Dynamic", "") or r.get("IsDynamic", ""),
+                    "Form Dynamic Criteria": r.get("Form Dynamic Criteria", "") or r.get("Form Dynamic Criteria ", "")
+                }
+                for idx, colname in enumerate(extra_headers):
+                    row[col_start_extra + idx] = (_sanitize_cell_value(extra_vals.get(colname, "")), 'center')
+                yield row
+
+    return {
+        'rows': iter_rows(),
+        'merges': merges,
+        'freeze_panes': (forms_start_row, col_rtsm),
+        'num_cols': num_cols,
+        'formats': SCHEDULE_GRID_FORMATS,
+    }
 
-            cur_row += 1
 
-    # Freeze panes at forms_start_row and RTSM column
-    ws.freeze_panes(forms_start_row, col_rtsm)
+def generate_schedule_grid_stream(
+    visits_xlsx: str,
+    forms_csv: str,
+    workbook,
+    sheet_name: str = "Schedule Grid",
+    config: Dict[str, Any] = None,
+) -> None:
+    """
+    Stream-write the schedule grid directly into an existing XlsxWriter workbook.
+    Writes the row model of build_schedule_grid_rows row by row (constant
+    memory), with the same formats, merged ranges, frozen pane and column
+    widths as the worksheet parts rendered from that model.
+
+    Args:
+        visits_xlsx: Path to visits-with-groups Excel (first sheet used)
+        forms_csv: Path to forms matrix CSV file
+        workbook: An xlsxwriter.Workbook instance (opened with constant_memory)
+        sheet_name: Name of the sheet to create
+        config: Optional configuration dictionary
+    """
+    model = build_schedule_grid_rows(visits_xlsx, forms_csv, config)
+    ws = workbook.add_worksheet(sheet_name)
+    formats = {key: workbook.add_format(props) for key, props in model['formats'].items()}
+
+    # Merged ranges by their first cell; constant_memory writes rows in order,
+    # so each range is written when its first row is reached
+    merge_at = {(r1, c1): (r2, c2) for r1, c1, r2, c2 in model['merges']}
+    covered = {(r, c) for r1, c1, r2, c2 in model['merges']
+               for r in range(r1, r2 + 1) for c in range(c1, c2 + 1)}
+
+    # Track column widths (longest value per column, as write_sheet_xml does)
+    max_width_by_col: Dict[int, int] = {}
+    for r, row in enumerate(model['rows']):
+        for c, (value, fmt_key) in enumerate(row):
+            if value is None and fmt_key is None:
+                continue
+            width = max(1, len(str(value))) if value is not None else 1
+            if width > max_width_by_col.get(c, 0):
+                max_width_by_col[c] = width
+            fmt = formats.get(fmt_key) if fmt_key else None
+            if (r, c) in merge_at:
+                r2, c2 = merge_at[(r, c)]
+                ws.merge_range(r, c, r2, c2, "" if value is None else value, fmt)
+            elif (r, c) not in covered:
+                ws.write(r, c, value, fmt)
+
+    ws.freeze_panes(*model['freeze_panes'])
 
     # Set column widths (cap between 10 and 80, +3 padding)
     for col_idx, width in max_width_by_col.items():
         ws.set_column(col_idx, col_idx, max(10, min(80, width + 3)))
-
@@ -0,0 +1,256 @@
+"""
+Stage Cache Module
+
+Content-addressed on-disk cache for pipeline stage results. A stage's key is a
+hash of its input documents (file contents, not paths), its configuration,
+the function and the source of the module implementing it, so unchanged
+stages become a lookup and any code or config edit invalidates only the
+affected stages.
+
+Entries live in <cache_dir>/<key>/ and hold either the stage's output file or
+a pickled return value, plus meta.json. The cache is bounded by size and
+evicts least-recently-used (lru) or oldest (fifo) entries first. Pre-parsed
+templates (modules.template_cache) live in <cache_dir>/templates/<digest>/
+with a meta.json of their own and count towards the same limit.
+
+Settings come from CLI flags or the environment:
+    PTD_CACHE_DIR      cache directory (caching is off when unset)
+    PTD_CACHE_SIZE_MB  size limit in MB (0 = unlimited, default 512)
+    PTD_CACHE_POLICY   eviction policy: lru (default) or fifo
+"""
+
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from functools import lru_cache, partial
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .stage_graph import Stage
+
+# Bump when the entry layout or key derivation changes
+CACHE_FORMAT_VERSION = "2"
+DEFAULT_CACHE_SIZE_MB = 512
+CACHE_POLICIES = ("lru", "fifo")
+
+_META_FILE = "meta.json"
+# Subdirectories holding entries of other stores under the same size limit
+_NESTED_STORES = ("templates",)
+_VALUE_FILE = "value.pkl"
+_OUTPUT_FILE = "output"
+
+
+# Long-lived processes (the Flask app) hash a new temp file on every request
+_FILE_DIGEST_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=_FILE_DIGEST_CACHE_SIZE)
+def _file_digest(path: str, mtime_ns: int, size: int) -> str:
+    """sha256 of a file's contents, memoized per (path, mtime, size)."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_digest(path: str) -> str:
+    st = os.stat(path)
+    return _file_digest(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+def code_version(func: Callable[..., Any]) -> str:
+    """Hash of the source file that implements func (unwrapping partials)."""
+    while isinstance(func, partial):
+        func = func.func
+    try:
+        source = inspect.getsourcefile(func)
+    except TypeError:
+        source = None
+    if not source or not os.path.isfile(source):
+        return getattr(func, "__qualname__", repr(func))
+    return file_digest(source)
+
+
+class StageCache:
+    """Bounded content-addressed store for stage results (see module docstring)."""
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_CACHE_SIZE_MB * 1024 * 1024, policy: str = "lru"):
+        if policy not in CACHE_POLICIES:
+            raise ValueError(f"Unknown cache policy '{policy}' (expected one of {CACHE_POLICIES})")
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max(0, int(max_bytes))
+        self.policy = policy
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_settings(
+        cls,
+        cache_dir: Optional[str] = None,
+        size_mb: Optional[float] = None,
+        policy: Optional[str] = None,
+    ) -> Optional["StageCache"]:
+        """Build a cache from explicit settings, falling back to PTD_CACHE_* env vars."""
+        cache_dir = cache_dir or os.environ.get("PTD_CACHE_DIR")
+        if not cache_dir:
+            return None
+        if size_mb is None:
+            size_mb = float(os.environ.get("PTD_CACHE_SIZE_MB", DEFAULT_CACHE_SIZE_MB))
+        policy = policy or os.environ.get("PTD_CACHE_POLICY", "lru")
+        return cls(cache_dir, max_bytes=int(size_mb * 1024 * 1024), policy=policy)
+
+    # ---------------------------------------------------------------- keys
+    def key_for(self, stage_name: str, func: Callable[..., Any], kwargs: Dict[str, Any],
+                output_param: Optional[str] = None) -> str:
+        """Derive the content key; file-path arguments contribute their contents."""
+
+        def describe(value: Any) -> Any:
+            if isinstance(value, str) and os.path.isfile(value):
+                return {"file": file_digest(value)}
+            if isinstance(value, dict):
+                return {str(k): describe(v) for k, v in value.items()}
+            if isinstance(value, (list, tuple)):
+                return [describe(v) for v in value]
+            return value
+
+        impl = func
+        while isinstance(impl, partial):
+            impl = impl.func
+        payload = {
+            "format": CACHE_FORMAT_VERSION,
+            "stage": stage_name,
+            "code": code_version(func),
+            # Functions of one module share its code version
+            "func": getattr(impl, "__qualname__", repr(impl)),
+            "inputs": {k: describe(v) for k, v in sorted(kwargs.items()) if k != output_param},
+        }
+        blob = json.dumps(payload, sort_keys=True, default=str).encode("utf-8")
+        return hashlib.sha256(blob).hexdigest()
+
+    # ------------------------------------------------------------- lookups
+    def lookup(self, key: str, output_path: Optional[str] = None) -> Tuple[bool, Any]:
+        """Return (hit, value). File entries are copied to output_path on a hit."""
+        entry = os.path.join(self.cache_dir, key)
+        meta_path = os.path.join(entry, _META_FILE)
+        if not os.path.isfile(meta_path):
+            return False, None
+        try:
+            if output_path is not None:
+                shutil.copyfile(os.path.join(entry, _OUTPUT_FILE), output_path)
+                value = output_path
+            else:
+                with open(os.path.join(entry, _VALUE_FILE), "rb") as f:
+                    value = pickle.load(f)
+            os.utime(meta_path)  # recency for lru
+            return True, value
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logging.warning(f"Discarding unreadable cache entry {key}: {e}")
+            shutil.rmtree(entry, ignore_errors=True)
+            return False, None
+
+    def store(self, key: str, stage_name: str, value: Any, output_path: Optional[str] = None) -> None:
+        """Write an entry atomically (temp dir + rename), then enforce the size limit."""
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            return
+        tmp_entry = tempfile.mkdtemp(prefix=".tmp_", dir=self.cache_dir)
+        try:
+            if output_path is not None:
+                shutil.copyfile(output_path, os.path.join(tmp_entry, _OUTPUT_FILE))
+            else:
+                with open(os.path.join(tmp_entry, _VALUE_FILE), "wb") as f:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = sum(os.path.getsize(os.path.join(tmp_entry, n)) for n in os.listdir(tmp_entry))
+            with open(os.path.join(tmp_entry, _META_FILE), "w", encoding="utf-8") as f:
+                json.dump({"stage": stage_name, "created": time.time(), "size": size}, f)
+            os.replace(tmp_entry, entry)
+        except OSError as e:
+            # Another worker may have stored the same key first; either way the run continues
+            logging.debug(f"Cache store skipped for {stage_name} ({key}): {e}")
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+        self.evict()
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """List entries (including template entries) with their size, creation and last-use times."""
+        names = os.listdir(self.cache_dir)
+        for store in _NESTED_STORES:
+            store_dir = os.path.join(self.cache_dir, store)
+            if os.path.isdir(store_dir):
+                names += [f"{store}/{name}" for name in os.listdir(store_dir)]
+        out = []
+        for name in names:
+            meta_path = os.path.join(self.cache_dir, name, _META_FILE)
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                meta["key"] = name
+                meta["last_used"] = os.path.getmtime(meta_path)
+                out.append(meta)
+            except (OSError, ValueError):
+                continue
+        return out
+
+    def evict(self, keep: Iterable[str] = ()) -> None:
+        """
+        Drop entries by policy until the cache fits in max_bytes (0 = unlimited).
+        Entries whose key is in keep (e.g. the template being assembled from)
+        are left alone.
+        """
+        if not self.max_bytes:
+            return
+        keep = set(keep)
+        entries = self.entries()
+        total = sum(e.get("size", 0) for e in entries)
+        if total <= self.max_bytes:
+            return
+        order_key = "last_used" if self.policy == "lru" else "created"
+        for e in sorted(entries, key=lambda e: e.get(order_key, 0)):
+            if e["key"] in keep:
+                continue
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.cache_dir, e["key"]), ignore_errors=True)
+            total -= e.get("size", 0)
+            logging.info(f"Evicted cache entry {os.path.basename(e['key'])[:12]} ({e.get('stage')}, {e.get('size', 0)} bytes)")
+
+
+def _cached_stage_call(cache: StageCache, stage_name: str, func: Callable[..., Any],
+                       output_param: Optional[str], **kwargs: Any) -> Any:
+    """Stage wrapper: serve from cache or run func and store its result."""
+    key = cache.key_for(stage_name, func, kwargs, output_param)
+    output_path = kwargs.get(output_param) if output_param else None
+    hit, value = cache.lookup(key, output_path)
+    if hit:
+        logging.info(f"Cache hit for stage '{stage_name}' ({key[:12]})")
+        return value
+    logging.info(f"Cache miss for stage '{stage_name}' ({key[:12]})")
+    value = func(**kwargs)
+    cache.store(key, stage_name, value, output_path)
+    return value
+
+
+def apply_stage_cache(stages: List[Stage], cache: Optional[StageCache]) -> List[Stage]:
+    """Return stages whose cacheable members read/write through cache (no-op if None)."""
+    if cache is None:
+        return stages
+    wrapped = []
+    for stage in stages:
+        if not stage.cacheable:
+            wrapped.append(stage)
+            continue
+        wrapped.append(Stage(
+            stage.name,
+            partial(_cached_stage_call, cache, stage.name, stage.func, stage.output_param),
+            provides=stage.provides,
+            requires=stage.requires,
+            kwargs=stage.kwargs,
+            output_param=stage.output_param,
+            cacheable=stage.cacheable,
+        ))
+    return wrapped
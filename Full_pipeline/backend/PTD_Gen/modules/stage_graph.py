@@ -0,0 +1,191 @@
+"""
+Stage Graph Module
+
+Small dependency-graph executor for the PTD pipeline. Each stage declares the
+artifacts it consumes and the single artifact it produces; stages whose inputs
+are ready are submitted together to a thread or process pool, so total wall
+time approaches the critical path instead of the sum of all stages.
+"""
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .run_report import measure
+
+
+class Stage:
+    """
+    One node of the stage graph.
+
+    Args:
+        name: Unique stage name (used in logs and timing reports)
+        func: Callable invoked as func(**kwargs, **resolved_requires). Must be a
+              module-level function (or functools.partial of one) for the
+              process executor.
+        provides: Artifact name under which the return value is published
+        requires: Mapping of func parameter name -> artifact name it consumes
+        kwargs: Constant keyword arguments passed to func
+        output_param: Name of the kwarg holding the output file path when the
+                      stage writes a file (and returns that path); None when
+                      the return value itself is the artifact
+        cacheable: Whether the result may be served from modules.stage_cache
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[..., Any],
+        provides: str,
+        requires: Optional[Dict[str, str]] = None,
+        kwargs: Optional[Dict[str, Any]] = None,
+        output_param: Optional[str] = None,
+        cacheable: bool = True,
+    ):
+        self.name = name
+        self.func = func
+        self.provides = provides
+        self.requires = dict(requires or {})
+        self.kwargs = dict(kwargs or {})
+        self.output_param = output_param
+        self.cacheable = cacheable
+
+    def __repr__(self) -> str:
+        return f"Stage({self.name!r}, provides={self.provides!r}, requires={sorted(self.requires.values())})"
+
+
+def _timed_call(func: Callable[..., Any], kwargs: Dict[str, Any],
+                trace_memory: bool = False) -> Tuple[Any, Dict[str, Any]]:
+    """Run func in the worker and measure it there (excludes queueing); see run_report.measure."""
+    with measure(trace_memory) as metrics:
+        result = func(**kwargs)
+    return result, metrics
+
+
+def order_stages(stages: List[Stage]) -> List[Stage]:
+    """
+    Validate the graph and return the stages in a dependency-respecting order.
+    Raises ValueError on duplicate names/artifacts, unknown inputs, or cycles.
+    """
+    producers: Dict[str, Stage] = {}
+    names = set()
+    for stage in stages:
+        if stage.name in names:
+            raise ValueError(f"Duplicate stage name: {stage.name}")
+        names.add(stage.name)
+        if stage.provides in producers:
+            raise ValueError(f"Artifact '{stage.provides}' is produced by both "
+                             f"'{producers[stage.provides].name}' and '{stage.name}'")
+        producers[stage.provides] = stage
+
+    for stage in stages:
+        for artifact in stage.requires.values():
+            if artifact not in producers:
+                raise ValueError(f"Stage '{stage.name}' requires unknown artifact '{artifact}'")
+
+    ordered: List[Stage] = []
+    available = set()
+    pending = list(stages)
+    while pending:
+        ready = [s for s in pending if all(a in available for a in s.requires.values())]
+        if not ready:
+            raise ValueError(f"Cycle detected among stages: {[s.name for s in pending]}")
+        for stage in ready:
+            ordered.append(stage)
+            available.add(stage.provides)
+            pending.remove(stage)
+    return ordered
+
+
+def critical_path_seconds(stages: List[Stage], timings: Dict[str, float]) -> float:
+    """Longest dependency chain through the graph, weighted by measured stage time."""
+    by_artifact = {s.provides: s for s in stages}
+    finish: Dict[str, float] = {}
+    for stage in order_stages(stages):
+        start = max((finish[by_artifact[a].name] for a in stage.requires.values()), default=0.0)
+        finish[stage.name] = start + timings.get(stage.name, 0.0)
+    return max(finish.values(), default=0.0)
+
+
+def run_stage_graph(
+    stages: List[Stage],
+    max_workers: int = 1,
+    executor: str = "thread",
+    stage_metrics: Optional[Dict[str, Dict[str, Any]]] = None,
+    trace_memory: bool = False,
+) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """
+    Execute the stage graph, running every stage as soon as its inputs exist.
+
+    Args:
+        stages: Stages to run
+        max_workers: Pool size; 1 runs the stages serially in-process
+        executor: "thread" or "process"
+        stage_metrics: Optional dict receiving stage name -> measurements
+                       (wall/CPU time, RSS; see modules.run_report)
+        trace_memory: Include the tracemalloc peak in the measurements
+
+    Returns:
+        (artifacts, timings): artifact name -> stage return value, and
+        stage name -> wall seconds spent inside the stage
+    """
+    ordered = order_stages(stages)
+    artifacts: Dict[str, Any] = {}
+    timings: Dict[str, float] = {}
+    graph_start = time.perf_counter()
+
+    def call_kwargs(stage: Stage) -> Dict[str, Any]:
+        kwargs = dict(stage.kwargs)
+        for param, artifact in stage.requires.items():
+            kwargs[param] = artifacts[artifact]
+        return kwargs
+
+    def record(stage: Stage, metrics: Dict[str, Any]) -> None:
+        timings[stage.name] = metrics["wall_s"]
+        if stage_metrics is not None:
+            stage_metrics[stage.name] = metrics
+        logging.info(f"Stage '{stage.name}' finished in {metrics['wall_s']:.3f}s (cpu {metrics['cpu_s']:.3f}s)")
+
+    if max_workers <= 1:
+        for stage in ordered:
+            logging.info(f"Stage '{stage.name}' started")
+            result, metrics = _timed_call(stage.func, call_kwargs(stage), trace_memory)
+            artifacts[stage.provides] = result
+            record(stage, metrics)
+    else:
+        if executor == "process":
+            pool = ProcessPoolExecutor(max_workers=max_workers)
+        elif executor == "thread":
+            pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ptd_stage")
+        else:
+            raise ValueError(f"Unknown executor '{executor}' (expected 'thread' or 'process')")
+
+        pending = list(ordered)
+        running = {}
+        try:
+            while pending or running:
+                for stage in [s for s in pending if all(a in artifacts for a in s.requires.values())]:
+                    logging.info(f"Stage '{stage.name}' started")
+                    running[pool.submit(_timed_call, stage.func, call_kwargs(stage), trace_memory)] = stage
+                    pending.remove(stage)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    result, metrics = future.result()
+                    artifacts[stage.provides] = result
+                    record(stage, metrics)
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+        finally:
+            pool.shutdown(wait=True)
+
+    wall = time.perf_counter() - graph_start
+    logging.info(
+        f"Stage graph finished in {wall:.3f}s "
+        f"(critical path {critical_path_seconds(ordered, timings):.3f}s, "
+        f"sum of stages {sum(timings.values()):.3f}s, workers={max(1, max_workers)}, executor={executor})"
+    )
+    return artifacts, timings
@@ -0,0 +1,178 @@
+"""
+Stage Profile Module
+
+cProfile support for generate_ptd --profile. Every pipeline stage runs in its
+own profiling session (inside the worker that executes it, so the thread and
+process executors both work) and leaves two files in the profile directory:
+
+    <stage>.pstats      standard pstats dump (snakeviz, pstats, gprof2dot)
+    <stage>.collapsed   "root;caller;callee <microseconds>" lines for
+                        flamegraph.pl / speedscope / inferno
+
+cProfile records caller -> callee edges rather than full stacks, so the
+collapsed stacks are reconstructed by walking each function's callers and
+splitting its own time in proportion to the time spent under each caller.
+write_summary() adds summary.txt with the top functions of every stage.
+"""
+
+import contextlib
+import cProfile
+import glob
+import io
+import logging
+import os
+import pstats
+from collections import defaultdict
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .stage_graph import Stage
+
+DEFAULT_TOP_FUNCTIONS = 20
+# Stack reconstruction limits: deeper paths and smaller shares are folded into their caller
+MAX_STACK_DEPTH = 64
+MIN_STACK_SECONDS = 1e-5
+
+SUMMARY_FILE = "summary.txt"
+
+FuncKey = Tuple[str, int, str]
+
+
+def _frame_label(func: FuncKey) -> str:
+    filename, line, name = func
+    if filename == "~":
+        label = name  # built-ins: "<built-in method ...>"
+    else:
+        label = f"{name} ({os.path.basename(filename)}:{line})"
+    return label.replace(";", ",")
+
+
+def collapsed_stacks(stats: pstats.Stats) -> Dict[str, float]:
+    """Reconstruct "root;...;leaf" -> self seconds from a profile's caller edges."""
+    raw = stats.stats
+    stacks: Dict[str, float] = defaultdict(float)
+
+    def emit(path: List[FuncKey], seconds: float) -> None:
+        stacks[";".join(_frame_label(f) for f in reversed(path))] += seconds
+
+    def walk(path: List[FuncKey], seconds: float) -> None:
+        callers = raw.get(path[-1], (0, 0, 0.0, 0.0, {}))[4]
+        if not callers or len(path) >= MAX_STACK_DEPTH:
+            emit(path, seconds)
+            return
+        # Edge weights: cumulative time under each caller, call counts when all are ~0
+        weights = {caller: edge[3] for caller, edge in callers.items()}
+        total = sum(weights.values())
+        if total <= 0:
+            weights = {caller: edge[1] for caller, edge in callers.items()}
+            total = sum(weights.values()) or 1
+        folded = 0.0
+        for caller, weight in weights.items():
+            share = seconds * weight / total
+            if caller in path or share < MIN_STACK_SECONDS:
+                folded += share
+            else:
+                walk(path + [caller], share)
+        if folded:
+            emit(path, folded)
+
+    for func, (_, _, tottime, _, _) in raw.items():
+        if tottime > 0:
+            walk([func], tottime)
+    return stacks
+
+
+def write_profile(profile: cProfile.Profile, out_dir: str, stage_name: str) -> None:
+    """Dump <stage>.pstats and <stage>.collapsed for one finished profiling session."""
+    os.makedirs(out_dir, exist_ok=True)
+    base = os.path.join(out_dir, stage_name)
+    profile.dump_stats(base + ".pstats")
+    stacks = collapsed_stacks(pstats.Stats(profile))
+    with open(base + ".collapsed", "w", encoding="utf-8") as f:
+        for stack, seconds in sorted(stacks.items()):
+            micros = int(round(seconds * 1e6))
+            if micros:
+                f.write(f"{stack} {micros}\n")
+
+
+def _profiled_stage_call(out_dir: str, stage_name: str, func: Callable[..., Any], **kwargs: Any) -> Any:
+    """Stage wrapper: run func under its own cProfile session and write the results."""
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        return func(**kwargs)
+    finally:
+        profile.disable()
+        write_profile(profile, out_dir, stage_name)
+
+
+class StageProfiler:
+    """
+    Per-stage profiling into out_dir (see module docstring).
+
+    Args:
+        out_dir: Directory receiving the .pstats/.collapsed files and summary
+        top: Functions listed per stage in the summary
+    """
+
+    def __init__(self, out_dir: str, top: int = DEFAULT_TOP_FUNCTIONS):
+        self.out_dir = os.path.abspath(out_dir)
+        self.top = max(1, int(top))
+        os.makedirs(self.out_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def stage(self, stage_name: str) -> Iterator[None]:
+        """Profile an in-process step that is not part of a stage graph."""
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            write_profile(profile, self.out_dir, stage_name)
+
+    def summary(self) -> str:
+        """Top functions (by own time) of every profiled stage, in the order they finished."""
+        paths = sorted(glob.glob(os.path.join(self.out_dir, "*.pstats")), key=os.path.getmtime)
+        out = io.StringIO()
+        for path in paths:
+            stage_name = os.path.splitext(os.path.basename(path))[0]
+            stats = pstats.Stats(path)
+            out.write(f"== {stage_name}: {stats.total_tt:.3f}s, {stats.total_calls} calls ==\n")
+            out.write(f"{'ncalls':>10} {'tottime':>9} {'cumtime':>9}  function\n")
+            rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+            for func, (_, ncalls, tottime, cumtime, _) in rows[:self.top]:
+                out.write(f"{ncalls:>10} {tottime:>9.3f} {cumtime:>9.3f}  {_frame_label(func)}\n")
+            out.write("\n")
+        return out.getvalue()
+
+    def write_summary(self) -> str:
+        """Write summary.txt next to the stage profiles and return its path."""
+        path = os.path.join(self.out_dir, SUMMARY_FILE)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.summary())
+        logging.info(f"Stage profiles and summary written to {self.out_dir}")
+        return path
+
+
+def apply_stage_profiling(stages: List[Stage], profiler: Optional[StageProfiler]) -> List[Stage]:
+    """Return stages that each run under their own cProfile session (no-op if None)."""
+    if profiler is None:
+        return stages
+    return [
+        Stage(
+            stage.name,
+            partial(_profiled_stage_call, profiler.out_dir, stage.name, stage.func),
+            provides=stage.provides,
+            requires=stage.requires,
+            kwargs=stage.kwargs,
+            output_param=stage.output_param,
+            cacheable=stage.cacheable,
+        )
+        for stage in stages
+    ]
+
+
+def profiled(profiler: Optional[StageProfiler], stage_name: str):
+    """profiler.stage(stage_name), or a no-op context when profiling is off."""
+    return profiler.stage(stage_name) if profiler is not None else contextlib.nullcontext()
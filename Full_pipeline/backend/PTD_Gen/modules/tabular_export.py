@@ -0,0 +1,233 @@
+"""
+Tabular Export Module
+
+Machine-readable export of the PTD tables for downstream tooling that should
+not have to parse the workbook. Three tables with a fixed schema are written
+as CSV, Parquet or Arrow IPC (the latter two need the optional pyarrow):
+
+    schedule_grid          one row per form x visit cell of the schedule grid
+                           (long format, so the schema does not depend on the
+                           study's visits)
+    visits                 one row per visit with its group, names and window
+    study_specific_forms   one row per item, in sheet order, with the 26
+                           Study Specific Forms columns under stable names
+
+Every column is a string (empty cells are null) except the *_order columns,
+which are 1-based integers. Parquet/Arrow files carry the export version and
+table name in their schema metadata.
+"""
+
+import csv
+import logging
+import math
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+from .forms_rows import StudySpecificFormsRow
+from .schedule_layout import make_event_name
+
+EXPORT_VERSION = "1"
+EXPORT_FORMATS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+
+SCHEDULE_GRID_COLUMNS = [
+    ("form_order", "int"), ("form_label", "str"), ("form_name", "str"), ("source", "str"),
+    ("is_form_dynamic", "str"), ("form_dynamic_criteria", "str"),
+    ("visit_order", "int"), ("event_group", "str"), ("visit_name", "str"), ("event_name", "str"),
+    ("value", "str"),
+]
+VISITS_COLUMNS = [
+    ("visit_order", "int"), ("event_group", "str"), ("visit_name", "str"), ("event_name", "str"),
+    ("study_week", "str"), ("offset_type", "str"), ("offset_days", "str"),
+    ("day_range_early", "str"), ("day_range_late", "str"),
+]
+# The row fields, in the sheet's subheader order
+STUDY_SPECIFIC_FORMS_COLUMNS = [
+    (name, "int" if name.endswith("_order") else "str") for name in StudySpecificFormsRow._fields
+]
+TABLE_SCHEMAS = {
+    "schedule_grid": SCHEDULE_GRID_COLUMNS,
+    "visits": VISITS_COLUMNS,
+    "study_specific_forms": STUDY_SPECIFIC_FORMS_COLUMNS,
+}
+
+_VISIT_SOURCE_COLUMNS = {
+    "study_week": "Study Week", "offset_type": "Offset Type", "offset_days": "Offset Days",
+    "day_range_early": "Day Range - Early", "day_range_late": "Day Range - Late",
+}
+
+
+def _text(value: Any) -> Optional[str]:
+    """Cell value as schema text: None/NaN/'' -> None, integral floats without '.0'."""
+    if value is None:
+        return None
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return None
+        if value.is_integer():
+            value = int(value)
+    text = str(value)
+    return text if text.strip() else None
+
+
+def _int(value: Any) -> Optional[int]:
+    """Cell value as a schema integer: blank -> None, integral numbers and digit strings -> int."""
+    text = _text(value)
+    if text is None:
+        return None
+    try:
+        number = float(text)
+    except ValueError:
+        raise ValueError(f"Expected an integer, got {text!r}")
+    if not number.is_integer():
+        raise ValueError(f"Expected an integer, got {text!r}")
+    return int(number)
+
+
+_CONVERTERS = {"int": _int, "str": _text}
+
+
+def check_export_formats(formats: Iterable[str]) -> None:
+    """Fail early (before the pipeline runs) when a format needs a missing dependency."""
+    for fmt in formats:
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format '{fmt}' (expected one of {tuple(EXPORT_FORMATS)})")
+        if fmt in ("parquet", "arrow"):
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise RuntimeError(f"--export-format {fmt} requires pyarrow (pip install pyarrow); csv needs nothing")
+
+
+def schedule_grid_tables(visits_xlsx: str, forms_csv: str, config: Optional[Dict[str, Any]] = None
+                         ) -> Tuple[List[tuple], List[tuple]]:
+    """
+    The schedule grid as (visits rows, schedule_grid rows) in the column order
+    of VISITS_COLUMNS / SCHEDULE_GRID_COLUMNS. Visits, event names and cell
+    values are resolved exactly as schedule_layout lays out the sheet.
+    """
+    config = config or {}
+    df_visits = pd.read_excel(visits_xlsx, sheet_name=0)
+    df_visits.columns = [str(c).strip() for c in df_visits.columns]
+    groups = df_visits["Event Group"].astype(str).tolist()
+    labels = df_visits["Visit Name"].astype(str).tolist()
+    event_names = [make_event_name(groups[j], labels[j], j, config) for j in range(len(labels))]
+
+    visits = []
+    for j, record in enumerate(df_visits.to_dict("records")):
+        extra = [_text(record.get(column)) for column in _VISIT_SOURCE_COLUMNS.values()]
+        visits.append((j + 1, _text(groups[j]), _text(labels[j]), event_names[j], *extra))
+
+    cells = []
+    chunksize = int(config.get('forms_csv_chunksize', 1000))
+    form_order = 0
+    for df_chunk in pd.read_csv(forms_csv, chunksize=chunksize):
+        df_chunk.columns = [str(c).strip() for c in df_chunk.columns]
+        for record in df_chunk.to_dict("records"):
+            form_order += 1
+            form = (
+                form_order,
+                _text(record.get("Form Label")),
+                _text(record.get("Form Name")),
+                _text(record.get("Source")),
+                _text(record.get("Is Form Dynamic?") or record.get("Is Form Dynamic") or record.get("IsDynamic")),
+                _text(record.get("Form Dynamic Criteria")),
+            )
+            for j, label in enumerate(labels):
+                value = record[label] if label in record else record.get(event_names[j])
+                cells.append(form + (j + 1, _text(groups[j]), _text(label), event_names[j], _text(value)))
+    return visits, cells
+
+
+def study_specific_forms_table(items_rows: Iterable[List[Any]]) -> List[tuple]:
+    """Study Specific Forms item rows (26 values each) as STUDY_SPECIFIC_FORMS_COLUMNS rows."""
+    width = len(STUDY_SPECIFIC_FORMS_COLUMNS)
+    converters = [_CONVERTERS[kind] for _, kind in STUDY_SPECIFIC_FORMS_COLUMNS]
+    table = []
+    for row in items_rows:
+        values = [convert(v) for convert, v in zip(converters, list(row)[:width])]
+        table.append(tuple(values + [None] * (width - len(values))))
+    return table
+
+
+def _write_csv(path: str, columns: List[Tuple[str, str]], rows: List[tuple]) -> None:
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([name for name, _ in columns])
+        writer.writerows(["" if v is None else v for v in row] for row in rows)
+
+
+def _arrow_table(table_name: str, columns: List[Tuple[str, str]], rows: List[tuple]):
+    import pyarrow as pa
+
+    schema = pa.schema(
+        [(name, pa.int64() if kind == "int" else pa.string()) for name, kind in columns],
+        metadata={"ptd_export_version": EXPORT_VERSION, "ptd_table": table_name},
+    )
+    data = {name: [row[i] for row in rows] for i, (name, _) in enumerate(columns)}
+    return pa.Table.from_pydict(data, schema=schema)
+
+
+def write_table(path: str, fmt: str, table_name: str, rows: List[tuple]) -> str:
+    """Write one table (see TABLE_SCHEMAS) as csv, parquet or arrow; returns the path."""
+    columns = TABLE_SCHEMAS[table_name]
+    tmp_path = path + ".tmp"
+    if fmt == "csv":
+        _write_csv(tmp_path, columns, rows)
+    elif fmt == "parquet":
+        import pyarrow.parquet as pq
+        pq.write_table(_arrow_table(table_name, columns, rows), tmp_path)
+    elif fmt == "arrow":
+        import pyarrow as pa
+        table = _arrow_table(table_name, columns, rows)
+        with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f"Unknown export format '{fmt}'")
+    os.replace(tmp_path, path)
+    return path
+
+
+def export_ptd_tables(
+    out_dir: str,
+    prefix: str,
+    formats: Iterable[str],
+    visits_xlsx: str,
+    forms_csv: str,
+    items_rows: Iterable[List[Any]],
+    schedule_config: Optional[Dict[str, Any]] = None,
+) -> List[str]:
+    """
+    Write the schedule_grid, visits and study_specific_forms tables in every
+    requested format as <out_dir>/<prefix>_<table>.<ext>.
+
+    Args:
+        out_dir: Export directory (created if needed)
+        prefix: File name prefix, normally the output workbook's stem
+        formats: Any of "csv", "parquet", "arrow"
+        visits_xlsx: Visits-with-groups artifact of the stage graph
+        forms_csv: Forms matrix artifact (matrix_csv) of the stage graph
+        items_rows: Study Specific Forms rows the pipeline already built
+        schedule_config: Schedule layout config (event name mapping)
+
+    Returns:
+        Paths of the written files
+    """
+    formats = list(dict.fromkeys(formats))
+    check_export_formats(formats)
+    os.makedirs(out_dir, exist_ok=True)
+    visits, cells = schedule_grid_tables(visits_xlsx, forms_csv, schedule_config)
+    tables = {
+        "schedule_grid": cells,
+        "visits": visits,
+        "study_specific_forms": study_specific_forms_table(items_rows),
+    }
+    written = []
+    for fmt in formats:
+        for table_name, rows in tables.items():
+            path = os.path.join(out_dir, f"{prefix}_{table_name}{EXPORT_FORMATS[fmt]}")
+            written.append(write_table(path, fmt, table_name, rows))
+    logging.info(f"Exported {', '.join(f'{k} ({len(v)} rows)' for k, v in tables.items())} "
+                 f"as {'/'.join(formats)} to {out_dir}")
+    return written
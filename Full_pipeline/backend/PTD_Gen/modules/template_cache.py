@@ -0,0 +1,343 @@
+"""
+Template Cache Module
+
+Pre-parsed PTD templates. A template workbook is decomposed once into its zip
+members (offsets of their compressed bytes), the sheet name -> worksheet part
+map, the workbook's related parts by type (styles, sharedStrings, ...) and the
+text of the few package parts that change when sheets are replaced. Output
+workbooks are then assembled from that description: untouched members are
+copied as raw compressed bytes and only the replaced parts are written, so
+the template is never loaded into openpyxl.
+
+Entries are keyed by the sha256 of the template's contents. They are kept in
+process memory and, with a stage cache, on disk as
+<cache_dir>/templates/<digest>/ holding a copy of the template,
+manifest.json and a meta.json like the stage entries', so later runs skip the
+parse as well. Template entries count towards the stage cache's size limit
+and are evicted by its policy (--inplace changes the template's contents on
+every run, so each run adds an entry).
+"""
+
+import io
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from .stage_cache import StageCache, file_digest
+from .xlsx_xml import MAIN_NS, REL_NS, PKG_REL_NS
+from .zip_deflate import DeflateOptions, open_member, write_raw_member
+
+# Bump when the manifest layout changes
+TEMPLATE_CACHE_VERSION = "1"
+MEMORY_CACHE_SIZE = 8
+
+CONTENT_TYPES_MEMBER = "[Content_Types].xml"
+WORKBOOK_MEMBER = "xl/workbook.xml"
+WORKBOOK_RELS_MEMBER = "xl/_rels/workbook.xml.rels"
+
+_ARCHIVE_FILE = "template.xlsx"
+_MANIFEST_FILE = "manifest.json"
+_META_FILE = "meta.json"
+_TEMPLATES_DIR = "templates"
+_TEXT_PART_TYPES = ("styles", "sharedStrings")
+_MEMBER_FIELDS = ("filename", "date_time", "compress_type", "flag_bits", "CRC", "compress_size",
+                  "file_size", "external_attr", "internal_attr", "create_system", "create_version",
+                  "extract_version")
+
+_MEMORY: "OrderedDict[str, PreparsedTemplate]" = OrderedDict()
+
+
+def _file_stamp(path: str) -> List[int]:
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def target_to_member(target: str) -> str:
+    """Workbook relationship target -> zip member name."""
+    # Normalize odd targets like '/xl/worksheets/sheet1.xml' or '/worksheets/sheet1.xml'
+    t = (target or "").replace("\\", "/").lstrip("/")
+    if t.startswith("xl/"):
+        t = t[3:]
+    return "xl/" + t
+
+
+class PreparsedTemplate:
+    """
+    A decomposed template workbook (see module docstring).
+
+    Args:
+        digest: sha256 of the template contents
+        archive_path: Zip file the member offsets refer to
+        members: Per-member ZipInfo fields plus data_offset, in archive order
+        sheet_parts: Sheet name -> worksheet member, in workbook order
+        parts: Relationship type (last path segment) -> member
+        texts: Member -> decoded text for the package parts assembly rewrites
+    """
+
+    def __init__(
+        self,
+        digest: str,
+        archive_path: str,
+        members: List[Dict[str, Any]],
+        sheet_parts: Dict[str, str],
+        parts: Dict[str, str],
+        texts: Dict[str, str],
+    ):
+        self.digest = digest
+        self.archive_path = os.path.abspath(archive_path)
+        self.members = members
+        self.sheet_parts = sheet_parts
+        self.parts = parts
+        self.texts = texts
+        self.stamp = _file_stamp(self.archive_path)
+
+    # ------------------------------------------------------------- parsing
+    @classmethod
+    def parse(cls, archive_path: str, digest: Optional[str] = None) -> "PreparsedTemplate":
+        """Decompose an xlsx file (digest is computed when not given)."""
+        digest = digest or file_digest(archive_path)
+        with zipfile.ZipFile(archive_path, "r") as zin:
+            names = set(zin.namelist())
+            rels_root = ET.fromstring(zin.read(WORKBOOK_RELS_MEMBER))
+            rid_to_member = {}
+            parts = {}
+            for rel in rels_root.findall(f"{{{PKG_REL_NS}}}Relationship"):
+                member = target_to_member(rel.attrib.get("Target"))
+                rid_to_member[rel.attrib.get("Id")] = member
+                parts.setdefault(rel.attrib.get("Type", "").rsplit("/", 1)[-1], member)
+
+            sheet_parts = {}
+            root = ET.fromstring(zin.read(WORKBOOK_MEMBER))
+            for sheet in root.findall(f"{{{MAIN_NS}}}sheets/{{{MAIN_NS}}}sheet"):
+                name = sheet.attrib.get("name")
+                rid = sheet.attrib.get(f"{{{REL_NS}}}id")
+                if name and rid in rid_to_member:
+                    sheet_parts[name] = rid_to_member[rid]
+
+            text_members = [CONTENT_TYPES_MEMBER, WORKBOOK_MEMBER, WORKBOOK_RELS_MEMBER]
+            text_members += [parts[t] for t in _TEXT_PART_TYPES if t in parts]
+            texts = {m: zin.read(m).decode("utf-8") for m in text_members if m in names}
+
+            members = []
+            for info in zin.infolist():
+                # Local file header: 30 fixed bytes, then the name and extra field
+                zin.fp.seek(info.header_offset)
+                header = zin.fp.read(30)
+                if header[:4] != b"PK\x03\x04":
+                    raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+                name_len, extra_len = struct.unpack("<HH", header[26:30])
+                member = {field: getattr(info, field) for field in _MEMBER_FIELDS}
+                member["date_time"] = list(info.date_time)
+                member["extra"] = info.extra.hex()
+                member["data_offset"] = info.header_offset + 30 + name_len + extra_len
+                members.append(member)
+        return cls(digest, archive_path, members, sheet_parts, parts, texts)
+
+    def to_manifest(self) -> Dict[str, Any]:
+        return {
+            "version": TEMPLATE_CACHE_VERSION,
+            "digest": self.digest,
+            "members": self.members,
+            "sheet_parts": list(self.sheet_parts.items()),
+            "parts": self.parts,
+            "texts": self.texts,
+        }
+
+    @classmethod
+    def from_manifest(cls, manifest: Dict[str, Any], archive_path: str) -> "PreparsedTemplate":
+        if manifest.get("version") != TEMPLATE_CACHE_VERSION:
+            raise ValueError(f"Unsupported template manifest version {manifest.get('version')!r}")
+        return cls(manifest["digest"], archive_path, manifest["members"], dict(manifest["sheet_parts"]),
+                   manifest["parts"], manifest["texts"])
+
+    def is_current(self) -> bool:
+        """Whether the archive on disk is still the one that was parsed."""
+        try:
+            return _file_stamp(self.archive_path) == self.stamp
+        except OSError:
+            return False
+
+    # ---------------------------------------------------------- assembling
+    def text(self, member: str) -> str:
+        return self.texts[member]
+
+    def sheet_member(self, name: str) -> str:
+        if name not in self.sheet_parts:
+            raise KeyError(f"Sheet '{name}' not found in template workbook (sheets: {list(self.sheet_parts)})")
+        return self.sheet_parts[name]
+
+    def write(
+        self,
+        out_path: str,
+        parts: Dict[str, Callable[[io.TextIOBase], None]],
+        deferred: Iterable[str] = (),
+        omit: Iterable[str] = (),
+        compression: Optional[DeflateOptions] = None,
+    ) -> str:
+        """
+        Assemble a workbook at out_path: every template member is copied as raw
+        compressed bytes except those in parts, which are rewritten by their
+        writer (a callable receiving a text stream) and compressed per
+        compression (zipfile's deflate when None). Members in
+        deferred are written last, after the others (e.g. a shared strings
+        table that the sheet writers fill); parts not in the template are
+        added and members in omit are left out. Written through a temp file,
+        so out_path may be the template.
+        """
+        deferred = [m for m in deferred if m in parts]
+        omit = set(omit)
+        out_dir = os.path.dirname(os.path.abspath(out_path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".ptd_template_", suffix=".xlsx", dir=out_dir)
+        os.close(fd)
+        date_times = {}
+        try:
+            with open(self.archive_path, "rb") as src, zipfile.ZipFile(tmp_path, "w") as zout:
+                for member in self.members:
+                    name = member["filename"]
+                    if name in omit:
+                        continue
+                    if name in parts:
+                        date_times[name] = tuple(member["date_time"])
+                        if name not in deferred:
+                            _write_member(zout, name, date_times[name], parts[name], compression)
+                    else:
+                        _copy_member_raw(src, zout, member)
+                for name, writer in parts.items():
+                    if name not in date_times and name not in deferred:
+                        _write_member(zout, name, (1980, 1, 1, 0, 0, 0), writer, compression)
+                for name in deferred:
+                    _write_member(zout, name, date_times.get(name, (1980, 1, 1, 0, 0, 0)), parts[name], compression)
+            if os.path.exists(out_path):
+                shutil.copymode(out_path, tmp_path)
+            else:
+                # mkstemp creates 0600; give new files the usual umask-based mode
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmp_path, 0o666 & ~umask)
+            os.replace(tmp_path, out_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return os.path.abspath(out_path)
+
+
+def _write_member(zout: zipfile.ZipFile, name: str, date_time, write: Callable[[io.TextIOBase], None],
+                  compression: Optional[DeflateOptions] = None) -> None:
+    zinfo = zipfile.ZipInfo(name, date_time=date_time)
+    with io.TextIOWrapper(open_member(zout, zinfo, compression), encoding="utf-8") as f:
+        write(f)
+
+
+def _copy_member_raw(src, zout: zipfile.ZipFile, member: Dict[str, Any]) -> None:
+    """
+    Copy one member's stored (compressed) bytes without inflating them. The
+    local header is rebuilt from the central directory fields, so members
+    written with a trailing data descriptor get their sizes and CRC in the
+    header instead.
+    """
+    info = zipfile.ZipInfo(member["filename"], date_time=tuple(member["date_time"]))
+    for field in _MEMBER_FIELDS[2:]:
+        setattr(info, field, member[field])
+    info.extra = bytes.fromhex(member["extra"])
+    src.seek(member["data_offset"])
+    write_raw_member(zout, info, src)
+
+
+def _remember(template: PreparsedTemplate) -> PreparsedTemplate:
+    _MEMORY[template.digest] = template
+    _MEMORY.move_to_end(template.digest)
+    while len(_MEMORY) > MEMORY_CACHE_SIZE:
+        _MEMORY.popitem(last=False)
+    return template
+
+
+def _write_meta(entry: str) -> None:
+    """meta.json in the stage cache's format, so the entry is sized and evicted with it."""
+    size = sum(os.path.getsize(os.path.join(entry, n)) for n in (_ARCHIVE_FILE, _MANIFEST_FILE))
+    with open(os.path.join(entry, _META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"stage": "template", "created": time.time(), "size": size}, f)
+
+
+def _load_from_disk(entry: str) -> Optional[PreparsedTemplate]:
+    try:
+        with open(os.path.join(entry, _MANIFEST_FILE), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        template = PreparsedTemplate.from_manifest(manifest, os.path.join(entry, _ARCHIVE_FILE))
+        meta_path = os.path.join(entry, _META_FILE)
+        if os.path.isfile(meta_path):
+            os.utime(meta_path)  # recency for lru
+        else:
+            _write_meta(entry)
+        return template
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Discarding unreadable template cache entry {entry}: {e}")
+        shutil.rmtree(entry, ignore_errors=True)
+        return None
+
+
+def _store_on_disk(template: PreparsedTemplate, cache: StageCache) -> PreparsedTemplate:
+    """
+    Copy the template into the cache and return the entry bound to the cached
+    copy. The cache is then evicted down to its size limit, keeping this entry.
+    """
+    templates_dir = os.path.join(cache.cache_dir, _TEMPLATES_DIR)
+    entry = os.path.join(templates_dir, template.digest)
+    os.makedirs(templates_dir, exist_ok=True)
+    tmp_entry = tempfile.mkdtemp(prefix=".tmp_", dir=templates_dir)
+    try:
+        shutil.copyfile(template.archive_path, os.path.join(tmp_entry, _ARCHIVE_FILE))
+        with open(os.path.join(tmp_entry, _MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(template.to_manifest(), f)
+        _write_meta(tmp_entry)
+        os.replace(tmp_entry, entry)
+    except OSError as e:
+        # Another process may have stored the same template first
+        logging.debug(f"Template cache store skipped ({template.digest[:12]}): {e}")
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        if not os.path.isdir(entry):
+            return template
+    cache.evict(keep=(f"{_TEMPLATES_DIR}/{template.digest}",))
+    return _load_from_disk(entry) or template
+
+
+def load_template(template_xlsx: str, cache: Optional[StageCache] = None) -> PreparsedTemplate:
+    """
+    Return the pre-parsed form of template_xlsx, from process memory, the
+    on-disk cache, or by parsing it (and storing it in both).
+
+    Args:
+        template_xlsx: Template workbook path
+        cache: Stage cache whose directory, size limit and policy the template
+               entries share (they go in its templates/ subdirectory);
+               memory only when None
+    """
+    digest = file_digest(template_xlsx)
+    template = _MEMORY.get(digest)
+    if template is not None and template.is_current():
+        logging.info(f"Template cache hit (memory) for {os.path.basename(template_xlsx)} ({digest[:12]})")
+        return _remember(template)
+
+    if cache is not None:
+        entry = os.path.join(cache.cache_dir, _TEMPLATES_DIR, digest)
+        if os.path.isdir(entry):
+            template = _load_from_disk(entry)
+            if template is not None and template.is_current():
+                logging.info(f"Template cache hit (disk) for {os.path.basename(template_xlsx)} ({digest[:12]})")
+                return _remember(template)
+
+    logging.info(f"Template cache miss for {os.path.basename(template_xlsx)} ({digest[:12]}); parsing")
+    template = PreparsedTemplate.parse(template_xlsx, digest)
+    if cache is not None:
+        template = _store_on_disk(template, cache)
+    return _remember(template)
@@ -0,0 +1,58 @@
+"""
+Watch Module
+
+Polling file watcher behind generate_ptd --watch. It compares (mtime, size)
+stamps of the watched files every interval, waits for a burst of writes to
+settle (editors often truncate, write and rename in several steps) and then
+reports the files that changed. Polling keeps it dependency-free and works
+the same on network drives, where change notifications are unreliable.
+"""
+
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_INTERVAL = 0.25
+# Quiet time required before a change is reported
+SETTLE_SECONDS = 0.1
+
+Stamp = Optional[Tuple[int, int]]
+
+
+def snapshot(paths: Iterable[str]) -> Dict[str, Stamp]:
+    """(mtime_ns, size) of every path; None for paths that do not exist (yet)."""
+    stamps: Dict[str, Stamp] = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamps[path] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamps[path] = None
+    return stamps
+
+
+def watch_files(
+    list_paths: Callable[[], List[str]],
+    on_change: Callable[[List[str]], None],
+    interval: float = DEFAULT_INTERVAL,
+) -> None:
+    """
+    Call on_change(changed_paths) after every settled change of the files
+    returned by list_paths() (re-evaluated on each poll, so new files in a
+    watched directory are picked up). Blocks until interrupted.
+    """
+    state = snapshot(list_paths())
+    while True:
+        time.sleep(interval)
+        current = snapshot(list_paths())
+        if current == state:
+            continue
+        while True:
+            time.sleep(SETTLE_SECONDS)
+            settled = snapshot(list_paths())
+            if settled == current:
+                break
+            current = settled
+        changed = sorted(p for p in set(state) | set(current) if state.get(p) != current.get(p))
+        state = current
+        on_change(changed)
@@ -0,0 +1,579 @@
+"""
+XLSX XML Module
+
+Low-level writers for SpreadsheetML parts, used where the PTD sheets are
+written as raw XML instead of through openpyxl/XlsxWriter (--surgery and the
+template transplant).
+
+ - StyleTable appends the XlsxWriter-style format dicts used by the row models
+   (SCHEDULE_GRID_FORMATS, STUDY_SPECIFIC_FORMS_FORMATS) to an existing
+   styles.xml and hands back their cellXfs indices.
+ - SharedStrings extends (or creates) the shared strings table with repeated
+   labels.
+ - write_sheet_xml streams a row model (rows of (value, format_key) cells plus
+   merges and freeze panes) into a worksheet part with s= style indices,
+   <cols> widths, a frozen pane and <mergeCells>.
+ - StyleTable.import_styles and transplant_sheet_xml move a worksheet written
+   by openpyxl into another package, remapping its style indices.
+ - write_new_workbook zips pre-rendered worksheet parts into a new workbook
+   (--stream --parallel-sheets).
+
+Existing parts are edited textually (insert before the closing tag, bump the
+count) so namespaces and extension lists written by Excel survive untouched.
+"""
+
+import html
+import math
+import numbers
+import re
+import shutil
+import tempfile
+import zipfile
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .zip_deflate import DeflateOptions, open_member
+
+MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+SHARED_STRINGS_REL_TYPE = REL_NS + "/sharedStrings"
+SHARED_STRINGS_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"
+
+# Column widths follow the --stream writers: longest value + 3, clamped to [10, 80]
+MIN_COLUMN_WIDTH = 10
+MAX_COLUMN_WIDTH = 80
+# Excel stores widths including cell padding: 7px max digit width, 5px padding
+_MAX_DIGIT_PX = 7
+_PADDING_PX = 5
+
+# Strings longer than this stay inline even when shared strings are enabled
+SHARED_STRING_MAX_LEN = 255
+
+_VALIGN = {"vcenter": "center", "top": "top", "bottom": "bottom", "vjustify": "justify"}
+_ILLEGAL_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# styles.xml sections StyleTable can append to, with their record element
+_SECTION_CHILDREN = {"numFmts": "numFmt", "fonts": "font", "fills": "fill", "borders": "border", "cellXfs": "xf"}
+
+_DEFAULT_STYLES_XML = (
+    f'<styleSheet xmlns="{MAIN_NS}">'
+    '<fonts count="1"><font><sz val="11"/><color theme="1"/><name val="Calibri"/><family val="2"/>'
+    '<scheme val="minor"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+
+def col_letter(col: int) -> str:
+    """Zero-based column index to Excel letters (0 -> 'A')."""
+    col += 1
+    letters = []
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters.append(chr(65 + rem))
+    return "".join(reversed(letters))
+
+
+def cell_ref(row: int, col: int) -> str:
+    """Zero-based (row, col) to an A1 reference."""
+    return f"{col_letter(col)}{row + 1}"
+
+
+def excel_column_width(width: float) -> float:
+    """Character width as shown in Excel -> stored <col width> (what XlsxWriter writes)."""
+    if width < 1:
+        px = int(width * (_MAX_DIGIT_PX + _PADDING_PX) + 0.5)
+    else:
+        px = int(width * _MAX_DIGIT_PX + 0.5) + _PADDING_PX
+    return int(px / _MAX_DIGIT_PX * 256) / 256.0
+
+
+def escape_text(value: Any) -> str:
+    return html.escape(_ILLEGAL_XML_CHARS.sub("", str(value)), quote=False)
+
+
+class StyleTable:
+    """
+    Registers XlsxWriter-style format dicts (bold, font_size, align, valign,
+    text_wrap, bg_color, border) in a styles.xml part.
+
+    Args:
+        styles_xml: Existing styles.xml content; a minimal stylesheet is used when None
+    """
+
+    def __init__(self, styles_xml: Optional[str] = None):
+        self._xml = styles_xml if styles_xml is not None else _DEFAULT_STYLES_XML
+        root = re.search(r"<(?:(\w+):)?styleSheet\b", self._xml)
+        self._prefix = f"{root.group(1)}:" if root and root.group(1) else ""
+        self._sections: Dict[str, List[str]] = {"numFmts": [], "fonts": [], "fills": [], "borders": [], "cellXfs": []}
+        self._existing = {name: self._count_children(name, child) for name, child in _SECTION_CHILDREN.items()}
+        self._existing_ids: Dict[str, Dict[str, int]] = {}
+        self._numfmt_ids: Optional[Dict[str, int]] = None
+        self._next_numfmt_id = 164
+        self._base_font = self._first_child("fonts", "font") or '<font><sz val="11"/></font>'
+        self._ids: Dict[Tuple[str, str], int] = {}
+        self._xf_ids: Dict[Tuple, int] = {}
+
+    # ------------------------------------------------------------- parsing
+    def _section_body(self, section: str) -> Optional[str]:
+        p = re.escape(self._prefix)
+        m = re.search(rf"<{p}{section}\b[^>]*?(?:/>|>(.*?)</{p}{section}>)", self._xml, re.S)
+        if not m:
+            return None
+        return m.group(1) or ""
+
+    def _count_children(self, section: str, child: str) -> int:
+        body = self._section_body(section)
+        if body is None:
+            return 0
+        # cellXfs children may nest <alignment>/<protection> but never another xf
+        return len(re.findall(rf"<{re.escape(self._prefix)}{child}\b", body))
+
+    def _first_child(self, section: str, child: str) -> Optional[str]:
+        body = self._section_body(section) or ""
+        p = re.escape(self._prefix)
+        m = re.search(rf"<{p}{child}\b[^>]*?(?:/>|>.*?</{p}{child}>)", body, re.S)
+        return m.group(0) if m else None
+
+    def _children(self, section: str, child: str) -> List[str]:
+        body = self._section_body(section) or ""
+        p = re.escape(self._prefix)
+        return re.findall(rf"<{p}{child}\b[^>]*?(?:/>|>.*?</{p}{child}>)", body, re.S)
+
+    # --------------------------------------------------------- registering
+    def _intern(self, section: str, xml: str) -> int:
+        key = (section, xml)
+        if key not in self._ids:
+            if section not in self._existing_ids:
+                existing = self._existing_ids[section] = {}
+                for idx, child in enumerate(self._children(section, _SECTION_CHILDREN[section])):
+                    existing.setdefault(child, idx)
+            if xml in self._existing_ids[section]:
+                self._ids[key] = self._existing_ids[section][xml]
+            else:
+                self._ids[key] = self._existing[section] + len(self._sections[section])
+                self._sections[section].append(xml)
+        return self._ids[key]
+
+    def _font_xml(self, fmt: Dict[str, Any]) -> str:
+        p = self._prefix
+        font = self._base_font
+        if font.endswith("/>"):
+            font = font[:-2] + f"></{p}font>"
+        # Drop any bold flag of the base font, then apply the requested one
+        font = re.sub(rf"<{re.escape(p)}b\b[^>]*/>", "", font)
+        if fmt.get("font_size"):
+            if re.search(rf"<{re.escape(p)}sz\b", font):
+                font = re.sub(rf'<{re.escape(p)}sz\b[^>]*/>', f'<{p}sz val="{fmt["font_size"]}"/>', font)
+            else:
+                font = font.replace(f"</{p}font>", f'<{p}sz val="{fmt["font_size"]}"/></{p}font>')
+        if fmt.get("bold"):
+            open_end = font.index(">") + 1
+            font = font[:open_end] + f"<{p}b/>" + font[open_end:]
+        return font
+
+    def _fill_xml(self, color: str) -> str:
+        p = self._prefix
+        rgb = "FF" + color.lstrip("#").upper()
+        return (f'<{p}fill><{p}patternFill patternType="solid"><{p}fgColor rgb="{rgb}"/>'
+                f'<{p}bgColor indexed="64"/></{p}patternFill></{p}fill>')
+
+    def _border_xml(self) -> str:
+        p = self._prefix
+        sides = "".join(f'<{p}{side} style="thin"><{p}color auto="1"/></{p}{side}>'
+                        for side in ("left", "right", "top", "bottom"))
+        return f"<{p}border>{sides}<{p}diagonal/></{p}border>"
+
+    def add(self, fmt: Dict[str, Any]) -> int:
+        """Register a format dict and return its cellXfs index (deduplicated)."""
+        key = tuple(sorted(fmt.items()))
+        if key in self._xf_ids:
+            return self._xf_ids[key]
+        p = self._prefix
+        font_id = self._intern("fonts", self._font_xml(fmt)) if (fmt.get("bold") or fmt.get("font_size")) else 0
+        fill_id = self._intern("fills", self._fill_xml(fmt["bg_color"])) if fmt.get("bg_color") else 0
+        border_id = self._intern("borders", self._border_xml()) if fmt.get("border") else 0
+
+        align_attrs = []
+        if fmt.get("align"):
+            align_attrs.append(f'horizontal="{fmt["align"]}"')
+        if fmt.get("valign"):
+            align_attrs.append(f'vertical="{_VALIGN.get(fmt["valign"], fmt["valign"])}"')
+        if fmt.get("text_wrap"):
+            align_attrs.append('wrapText="1"')
+
+        attrs = f'numFmtId="0" fontId="{font_id}" fillId="{fill_id}" borderId="{border_id}" xfId="0"'
+        attrs += "".join(f' {flag}="1"' for flag, on in (("applyFont", font_id), ("applyFill", fill_id),
+                                                          ("applyBorder", border_id), ("applyAlignment", align_attrs)) if on)
+        if align_attrs:
+            xf = f'<{p}xf {attrs}><{p}alignment {" ".join(align_attrs)}/></{p}xf>'
+        else:
+            xf = f"<{p}xf {attrs}/>"
+        self._xf_ids[key] = self._intern("cellXfs", xf)
+        return self._xf_ids[key]
+
+    def add_formats(self, formats: Dict[str, Dict[str, Any]]) -> Dict[str, int]:
+        """Register a {format_key: format dict} table and return {format_key: cellXfs index}."""
+        return {key: self.add(fmt) for key, fmt in formats.items()}
+
+    def _numfmt_id(self, code_attr: str) -> int:
+        """Id of a custom number format (formatCode attribute text as written), adding it if new."""
+        if self._numfmt_ids is None:
+            self._numfmt_ids = {}
+            for fmt in self._children("numFmts", "numFmt"):
+                fid = re.search(r'\bnumFmtId="(\d+)"', fmt)
+                code = re.search(r'\bformatCode="([^"]*)"', fmt)
+                if fid and code:
+                    self._numfmt_ids.setdefault(code.group(1), int(fid.group(1)))
+            self._next_numfmt_id = max([163, *self._numfmt_ids.values()]) + 1
+        if code_attr not in self._numfmt_ids:
+            self._numfmt_ids[code_attr] = self._next_numfmt_id
+            self._next_numfmt_id += 1
+            self._sections["numFmts"].append(
+                f'<{self._prefix}numFmt numFmtId="{self._numfmt_ids[code_attr]}" formatCode="{code_attr}"/>')
+        return self._numfmt_ids[code_attr]
+
+    def import_styles(self, styles_xml: str) -> Dict[int, int]:
+        """
+        Register every cellXfs record of another styles.xml (e.g. a workbook
+        written by openpyxl) together with the fonts, fills, borders and
+        custom number formats it uses.
+
+        Returns:
+            Dict of the other part's cellXfs index -> index in this table
+        """
+        other = StyleTable(styles_xml)
+        src = re.escape(other._prefix)
+
+        def retag(xml: str) -> str:
+            if other._prefix == self._prefix:
+                return xml
+            return re.sub(rf"<(/?){src}([A-Za-z_][\w.-]*)(?=[\s/>])", rf"<\1{self._prefix}\2", xml)
+
+        def interned(section: str) -> List[int]:
+            return [self._intern(section, retag(x)) for x in other._children(section, _SECTION_CHILDREN[section])]
+
+        fonts, fills, borders = interned("fonts"), interned("fills"), interned("borders")
+        numfmts = {}
+        for fmt in other._children("numFmts", "numFmt"):
+            fid = re.search(r'\bnumFmtId="(\d+)"', fmt)
+            code = re.search(r'\bformatCode="([^"]*)"', fmt)
+            if fid and code:
+                numfmts[int(fid.group(1))] = self._numfmt_id(code.group(1))
+
+        def lookup(ids: List[int], idx: int) -> int:
+            return ids[idx] if idx < len(ids) else 0
+
+        remap = {
+            "numFmtId": lambda i: numfmts.get(i, i if i < 164 else 0),
+            "fontId": lambda i: lookup(fonts, i),
+            "fillId": lambda i: lookup(fills, i),
+            "borderId": lambda i: lookup(borders, i),
+            # Named cell styles are not carried over; everything hangs off Normal
+            "xfId": lambda i: 0,
+        }
+        mapping = {}
+        for idx, xf in enumerate(other._children("cellXfs", "xf")):
+            xf = re.sub(r'\b(numFmtId|fontId|fillId|borderId|xfId)="(\d+)"',
+                        lambda m: f'{m.group(1)}="{remap[m.group(1)](int(m.group(2)))}"', retag(xf))
+            mapping[idx] = self._intern("cellXfs", xf)
+        return mapping
+
+    # ------------------------------------------------------------- output
+    def to_xml(self) -> str:
+        """The styles.xml content with every registered record appended."""
+        xml = self._xml
+        p = self._prefix
+        for section in ("numFmts", "fonts", "fills", "borders", "cellXfs"):
+            added = self._sections[section]
+            if not added:
+                continue
+            total = self._existing[section] + len(added)
+            pattern = re.compile(rf"<{re.escape(p)}{section}\b([^>]*?)(/>|>(.*?)</{re.escape(p)}{section}>)", re.S)
+            m = pattern.search(xml)
+            if m is None and section == "numFmts":
+                # numFmts is optional but must be the stylesheet's first child
+                root = re.search(rf"<{re.escape(p)}styleSheet\b[^>]*>", xml)
+                xml = xml[:root.end()] + f'<{p}numFmts count="{total}">{"".join(added)}</{p}numFmts>' + xml[root.end():]
+                continue
+            if m is None:
+                raise ValueError(f"styles.xml has no <{section}> element")
+            attrs = re.sub(r'\s*count="\d+"', "", m.group(1))
+            body = (m.group(3) or "") + "".join(added)
+            xml = xml[:m.start()] + f'<{p}{section}{attrs} count="{total}">{body}</{p}{section}>' + xml[m.end():]
+        return xml
+
+
+class SharedStrings:
+    """
+    Appends strings to a sharedStrings.xml part, keeping the existing entries
+    (and their indices) as they are.
+
+    Args:
+        sst_xml: Existing sharedStrings.xml content, or None to start a new table
+    """
+
+    def __init__(self, sst_xml: Optional[str] = None):
+        self._xml = sst_xml
+        self._existing = len(re.findall(r"<(?:\w+:)?si\b", sst_xml)) if sst_xml else 0
+        self._index: Dict[str, int] = {}
+        self._added: List[str] = []
+        self.references = 0
+
+    def add(self, text: str) -> int:
+        """Index of text in the table, appending it on first use."""
+        self.references += 1
+        idx = self._index.get(text)
+        if idx is None:
+            idx = self._existing + len(self._added)
+            self._index[text] = idx
+            self._added.append(text)
+        return idx
+
+    def to_xml(self) -> str:
+        if self._xml is None:
+            return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                    f'<sst xmlns="{MAIN_NS}" count="{self.references}" uniqueCount="{len(self._added)}">'
+                    f'{self._items_xml("")}</sst>')
+        m = re.search(r"<(?:(\w+):)?sst\b([^>]*?)(/?)>", self._xml)
+        p = f"{m.group(1)}:" if m.group(1) else ""
+        count = re.search(r'\bcount="(\d+)"', m.group(2))
+        attrs = re.sub(r'\s*(?:count|uniqueCount)="\d+"', "", m.group(2))
+        total = (int(count.group(1)) if count else self._existing) + self.references
+        head = f'<{p}sst{attrs} count="{total}" uniqueCount="{self._existing + len(self._added)}">'
+        if m.group(3):  # self-closing <sst/>
+            return self._xml[:m.start()] + head + self._items_xml(p) + f"</{p}sst>" + self._xml[m.end():]
+        close = self._xml.rindex(f"</{p}sst>")
+        return self._xml[:m.start()] + head + self._xml[m.end():close] + self._items_xml(p) + self._xml[close:]
+
+    def _items_xml(self, p: str) -> str:
+        items = []
+        for text in self._added:
+            space = ' xml:space="preserve"' if text != text.strip() else ""
+            items.append(f"<{p}si><{p}t{space}>{escape_text(text)}</{p}t></{p}si>")
+        return "".join(items)
+
+
+def add_shared_strings_part(rels_xml: str, content_types_xml: str, target: str = "sharedStrings.xml") -> Tuple[str, str]:
+    """Register a new sharedStrings part in workbook.xml.rels and [Content_Types].xml."""
+    used = set(re.findall(r'\bId="([^"]+)"', rels_xml))
+    n = len(used) + 1
+    while f"rId{n}" in used:
+        n += 1
+    rel = f'<Relationship Id="rId{n}" Type="{SHARED_STRINGS_REL_TYPE}" Target="{target}"/>'
+    rels_xml = rels_xml.replace("</Relationships>", rel + "</Relationships>", 1)
+    override = f'<Override PartName="/xl/{target}" ContentType="{SHARED_STRINGS_CONTENT_TYPE}"/>'
+    content_types_xml = content_types_xml.replace("</Types>", override + "</Types>", 1)
+    return rels_xml, content_types_xml
+
+
+def remove_part(rels_xml: str, content_types_xml: str, member: str) -> Tuple[str, str]:
+    """Drop a workbook part's relationship and content-type override (e.g. a stale calcChain)."""
+    target = member[3:] if member.startswith("xl/") else member
+    rels_xml = re.sub(rf'<Relationship\b[^>]*\bTarget="/?(?:xl/)?{re.escape(target)}"[^>]*/>', "", rels_xml)
+    content_types_xml = re.sub(rf'<Override\b[^>]*\bPartName="/{re.escape(member)}"[^>]*/>', "", content_types_xml)
+    return rels_xml, content_types_xml
+
+
+def shared_string_items(sst_xml: str) -> List[str]:
+    """Inner XML of every <si> in a sharedStrings part, in index order."""
+    m = re.search(r"<(?:(\w+):)?sst\b", sst_xml)
+    p = re.escape(f"{m.group(1)}:" if m and m.group(1) else "")
+    return re.findall(rf"<{p}si>(.*?)</{p}si>|<{p}si/>", sst_xml, re.S)
+
+
+def transplant_sheet_xml(sheet_xml: str, style_map: Dict[int, int], shared_items: Optional[List[str]] = None) -> str:
+    """
+    Rewrite a worksheet part taken from another workbook so it can live in a
+    different package: s=/style= indices go through style_map (from
+    StyleTable.import_styles), shared-string cells become inline strings (the
+    <si> content model is the same as <is>), and tabSelected is dropped so
+    the target keeps its own active sheet.
+    """
+    m = re.search(r"<(?:(\w+):)?worksheet\b", sheet_xml)
+    prefix = f"{m.group(1)}:" if m and m.group(1) else ""
+    p = re.escape(prefix)
+
+    def restyle(tag: re.Match) -> str:
+        return re.sub(r'(?<=\s)(s|style)="(\d+)"',
+                      lambda a: f'{a.group(1)}="{style_map.get(int(a.group(2)), 0)}"', tag.group(0))
+
+    xml = re.sub(rf"<{p}(?:c|row|col)\s[^>]*>", restyle, sheet_xml)
+    xml = re.sub(rf"(<{p}sheetView\b[^>]*?)\s+tabSelected=\"(?:1|true)\"", r"\1", xml)
+    if shared_items is not None:
+        def inline(cell: re.Match) -> str:
+            idx = int(cell.group(3))
+            text = shared_items[idx] if idx < len(shared_items) else ""
+            return f'<{prefix}c{cell.group(1)} t="inlineStr"{cell.group(2)}><{prefix}is>{text}</{prefix}is></{prefix}c>'
+        xml = re.sub(rf'<{p}c\b([^>]*?)\s+t="s"([^>]*)>\s*<{p}v>(\d+)</{p}v>\s*</{p}c>', inline, xml)
+    return xml
+
+
+def _cell_xml(ref: str, value: Any, style: Optional[int], sst: Optional[SharedStrings]) -> Optional[str]:
+    s_attr = f' s="{style}"' if style else ""
+    if value is None or value == "":
+        return f'<c r="{ref}"{s_attr}/>' if style else None
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{s_attr} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, numbers.Real):
+        if not math.isfinite(value):
+            return f'<c r="{ref}"{s_attr}/>' if style else None
+        return f'<c r="{ref}"{s_attr}><v>{value}</v></c>'
+    text = str(value)
+    if sst is not None and len(text) <= SHARED_STRING_MAX_LEN:
+        return f'<c r="{ref}"{s_attr} t="s"><v>{sst.add(text)}</v></c>'
+    space = ' xml:space="preserve"' if text != text.strip() else ""
+    return f'<c r="{ref}"{s_attr} t="inlineStr"><is><t{space}>{escape_text(text)}</t></is></c>'
+
+
+def write_sheet_xml(
+    f,
+    rows: Iterable[Sequence[Tuple[Any, Optional[str]]]],
+    style_ids: Dict[str, int],
+    merges: Sequence[Tuple[int, int, int, int]] = (),
+    freeze_panes: Optional[Tuple[int, int]] = None,
+    column_widths: bool = True,
+    shared_strings: Optional[SharedStrings] = None,
+) -> None:
+    """
+    Stream a row model into a worksheet part.
+
+    <sheetData> is rendered to a spooled temp file first, so the column widths
+    and dimension (which precede it in the XML) can be computed in the same
+    single pass over the rows without holding them in memory.
+
+    Args:
+        f: Text file object receiving the worksheet XML (e.g. a zip member)
+        rows: Rows of (value, format_key) cells, format_key None for unstyled
+        style_ids: format_key -> cellXfs index (from StyleTable.add_formats)
+        merges: Zero-based (first_row, first_col, last_row, last_col) ranges
+        freeze_panes: Zero-based (row, col) of the first unfrozen cell
+        column_widths: Emit <cols> sized to the longest value per column
+        shared_strings: Table for string cells; inline strings when None
+    """
+    widths: Dict[int, int] = {}
+    last_row = -1
+    last_col = 0
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024, mode="w+", encoding="utf-8") as body:
+        for r, row in enumerate(rows):
+            cells = []
+            for c, (value, fmt_key) in enumerate(row):
+                xml = _cell_xml(cell_ref(r, c), value, style_ids.get(fmt_key) if fmt_key else None, shared_strings)
+                if xml is None:
+                    continue
+                cells.append(xml)
+                last_col = max(last_col, c)
+                width = max(1, len(str(value))) if value is not None else 1
+                if width > widths.get(c, 0):
+                    widths[c] = width
+            last_row = r
+            if cells:
+                body.write(f'<row r="{r + 1}">{"".join(cells)}</row>')
+
+        f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n')
+        f.write(f'<worksheet xmlns="{MAIN_NS}" xmlns:r="{REL_NS}">')
+        dimension = f"A1:{cell_ref(last_row, last_col)}" if last_row >= 0 else "A1"
+        f.write(f'<dimension ref="{dimension}"/>')
+        f.write('<sheetViews><sheetView workbookViewId="0">')
+        if freeze_panes and (freeze_panes[0] or freeze_panes[1]):
+            row, col = freeze_panes
+            pane = "bottomRight" if row and col else ("bottomLeft" if row else "topRight")
+            split = (f' xSplit="{col}"' if col else "") + (f' ySplit="{row}"' if row else "")
+            f.write(f'<pane{split} topLeftCell="{cell_ref(row, col)}" activePane="{pane}" state="frozen"/>')
+            f.write(f'<selection pane="{pane}" activeCell="{cell_ref(row, col)}" sqref="{cell_ref(row, col)}"/>')
+        f.write('</sheetView></sheetViews>')
+        f.write('<sheetFormatPr defaultRowHeight="15"/>')
+        if column_widths and widths:
+            f.write("<cols>")
+            for c in sorted(widths):
+                width = excel_column_width(max(MIN_COLUMN_WIDTH, min(MAX_COLUMN_WIDTH, widths[c] + 3)))
+                f.write(f'<col min="{c + 1}" max="{c + 1}" width="{width}" customWidth="1"/>')
+            f.write("</cols>")
+        f.write("<sheetData>")
+        body.seek(0)
+        shutil.copyfileobj(body, f)
+        f.write("</sheetData>")
+
+    if merges:
+        f.write(f'<mergeCells count="{len(merges)}">')
+        for r1, c1, r2, c2 in merges:
+            f.write(f'<mergeCell ref="{cell_ref(r1, c1)}:{cell_ref(r2, c2)}"/>')
+        f.write("</mergeCells>")
+    f.write('<pageMargins left="0.7" right="0.7" top="0.75" bottom="0.75" header="0.3" footer="0.3"/>')
+    f.write("</worksheet>")
+
+
+WORKSHEET_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"
+
+
+def write_new_workbook(out_path: str, sheet_parts: Sequence[Tuple[str, str]], styles_xml: str,
+                       compression: Optional[DeflateOptions] = None) -> None:
+    """
+    Assemble a new workbook from worksheet parts rendered to files (e.g. by
+    write_sheet_xml in worker processes).
+
+    Args:
+        out_path: Workbook to write
+        sheet_parts: (sheet name, worksheet XML file) in tab order
+        styles_xml: The styles.xml all sheets' s= indices refer to
+        compression: Member compression (zipfile's deflate when None)
+    """
+    overrides = [
+        ("/xl/workbook.xml", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"),
+        ("/xl/styles.xml", "application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"),
+    ]
+    overrides += [(f"/xl/worksheets/sheet{i}.xml", WORKSHEET_CONTENT_TYPE) for i in range(1, len(sheet_parts) + 1)]
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        + "".join(f'<Override PartName="{name}" ContentType="{ctype}"/>' for name, ctype in overrides)
+        + "</Types>"
+    )
+    root_rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        f'<Relationships xmlns="{PKG_REL_NS}">'
+        f'<Relationship Id="rId1" Type="{REL_NS}/officeDocument" Target="xl/workbook.xml"/>'
+        "</Relationships>"
+    )
+    sheets = "".join(
+        f'<sheet name="{html.escape(name, quote=True)}" sheetId="{i}" r:id="rId{i}"/>'
+        for i, (name, _) in enumerate(sheet_parts, start=1)
+    )
+    workbook = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        f'<workbook xmlns="{MAIN_NS}" xmlns:r="{REL_NS}">'
+        f'<bookViews><workbookView/></bookViews><sheets>{sheets}</sheets></workbook>'
+    )
+    n = len(sheet_parts)
+    workbook_rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        f'<Relationships xmlns="{PKG_REL_NS}">'
+        + "".join(f'<Relationship Id="rId{i}" Type="{REL_NS}/worksheet" Target="worksheets/sheet{i}.xml"/>'
+                  for i in range(1, n + 1))
+        + f'<Relationship Id="rId{n + 1}" Type="{REL_NS}/styles" Target="styles.xml"/>'
+        "</Relationships>"
+    )
+    if not styles_xml.lstrip().startswith("<?xml"):
+        styles_xml = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' + styles_xml
+
+    texts = [
+        ("[Content_Types].xml", content_types),
+        ("_rels/.rels", root_rels),
+        ("xl/workbook.xml", workbook),
+        ("xl/_rels/workbook.xml.rels", workbook_rels),
+        ("xl/styles.xml", styles_xml),
+    ]
+    with zipfile.ZipFile(out_path, "w") as zout:
+        for name, text in texts:
+            with open_member(zout, zipfile.ZipInfo(name, (1980, 1, 1, 0, 0, 0)), compression) as dst:
+                dst.write(text.encode("utf-8"))
+        for i, (_, part_path) in enumerate(sheet_parts, start=1):
+            zinfo = zipfile.ZipInfo(f"xl/worksheets/sheet{i}.xml", (1980, 1, 1, 0, 0, 0))
+            with open(part_path, "rb") as src, open_member(zout, zinfo, compression) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
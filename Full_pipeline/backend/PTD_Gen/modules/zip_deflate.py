@@ -0,0 +1,239 @@
+"""
+Zip Deflate Module
+
+Compression of the zip members PTD writes itself (surgery, template
+transplant, --parallel-sheets and XlsxWriter workbooks opened with
+open_xlsxwriter_workbook, whose members are repacked after XlsxWriter
+has saved them).
+
+Large parts are deflated the way pigz does it: the data is cut into chunks
+that are compressed independently in a thread pool (zlib releases the GIL),
+each primed with the previous 32 KB as its dictionary and ended with a sync
+flush, so the concatenated chunks form one valid deflate stream. The level
+is selectable: stored (no compression), fast (zlib level 1) or default.
+
+zipfile has no API for appending a member whose compressed bytes already
+exist (a chunk-deflated spool, or a member copied raw from another archive).
+write_raw_member does that and is the only place PTD touches ZipFile
+internals.
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, BinaryIO, Dict, Optional
+
+COMPRESSION_LEVELS = {"stored": None, "fast": 1, "default": zlib.Z_DEFAULT_COMPRESSION}
+DEFAULT_CHUNK_BYTES = 1 << 20
+# Deflate back-reference window carried into the next chunk
+_WINDOW_BYTES = 32 * 1024
+
+
+class DeflateOptions:
+    """
+    How output members are compressed.
+
+    Args:
+        level: "stored", "fast" or "default"
+        threads: Threads compressing chunks of one member (1 = inline)
+        chunk_bytes: Uncompressed bytes per chunk
+    """
+
+    def __init__(self, level: str = "default", threads: int = 1, chunk_bytes: int = DEFAULT_CHUNK_BYTES):
+        if level not in COMPRESSION_LEVELS:
+            raise ValueError(f"Unknown compression level '{level}' (expected one of {tuple(COMPRESSION_LEVELS)})")
+        self.level = level
+        self.threads = max(1, int(threads))
+        self.chunk_bytes = max(_WINDOW_BYTES, int(chunk_bytes))
+
+    @property
+    def compress_type(self) -> int:
+        return zipfile.ZIP_STORED if COMPRESSION_LEVELS[self.level] is None else zipfile.ZIP_DEFLATED
+
+
+def write_raw_member(zout: zipfile.ZipFile, zinfo: zipfile.ZipInfo, src: BinaryIO) -> None:
+    """
+    Append a member to zout from already compressed data: zinfo carries the
+    CRC, sizes and compress_type, and exactly zinfo.compress_size bytes are
+    copied from src's current position. Sizes and CRC go in the local header
+    (no data descriptor).
+
+    This writes through ZipFile's private state (fp, filelist, NameToInfo,
+    start_dir) the same way ZipFile.writestr does, under its lock and with
+    the checks writestr applies, and refuses while a zout.open(..., "w")
+    handle is open (zipfile's _writing guard).
+    """
+    if zout._writing:
+        raise ValueError("Can't write to the ZIP file while there is another write handle open on it. "
+                         "Close the first handle before writing another member.")
+    with zout._lock:
+        zinfo.flag_bits &= ~0x08
+        zinfo.header_offset = zout.fp.tell()
+        zout._writecheck(zinfo)
+        zout._didModify = True
+        zout.fp.write(zinfo.FileHeader())
+        remaining = zinfo.compress_size
+        while remaining:
+            chunk = src.read(min(remaining, 1 << 20))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Truncated member {zinfo.filename}")
+            zout.fp.write(chunk)
+            remaining -= len(chunk)
+        zout.filelist.append(zinfo)
+        zout.NameToInfo[zinfo.filename] = zinfo
+        zout.start_dir = zout.fp.tell()
+
+
+def _deflate_chunk(data: bytes, zdict: bytes, level: int, last: bool) -> bytes:
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return c.compress(data) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class _MemberWriter(io.RawIOBase):
+    """Binary sink for one member: compresses into a spool, then writes header + data on close."""
+
+    def __init__(self, zout: zipfile.ZipFile, zinfo: zipfile.ZipInfo, options: DeflateOptions):
+        super().__init__()
+        self._zout = zout
+        self._zinfo = zinfo
+        self._options = options
+        self._level = COMPRESSION_LEVELS[options.level]
+        zinfo.compress_type = options.compress_type
+        self._spool = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+        self._pending = bytearray()
+        self._window = b""
+        self._crc = 0
+        self._size = 0
+        self._futures = []
+        self._pool = ThreadPoolExecutor(max_workers=options.threads) if options.threads > 1 else None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        n = len(b)
+        self._crc = zlib.crc32(b, self._crc)
+        self._size += n
+        if self._level is None:
+            self._spool.write(b)
+            return n
+        self._pending += b
+        while len(self._pending) > self._options.chunk_bytes:
+            chunk = bytes(self._pending[:self._options.chunk_bytes])
+            del self._pending[:self._options.chunk_bytes]
+            self._submit(chunk, last=False)
+        return n
+
+    def _submit(self, chunk: bytes, last: bool) -> None:
+        zdict, self._window = self._window, chunk[-_WINDOW_BYTES:]
+        if self._pool is None:
+            self._spool.write(_deflate_chunk(chunk, zdict, self._level, last))
+            return
+        self._futures.append(self._pool.submit(_deflate_chunk, chunk, zdict, self._level, last))
+        # Bound memory: keep at most two chunks per thread in flight
+        while len(self._futures) > 2 * self._options.threads:
+            self._spool.write(self._futures.pop(0).result())
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self._level is not None:
+                self._submit(bytes(self._pending), last=True)
+                for future in self._futures:
+                    self._spool.write(future.result())
+                self._futures = []
+            zinfo = self._zinfo
+            zinfo.CRC = self._crc
+            zinfo.file_size = self._size
+            zinfo.compress_size = self._spool.tell()
+            self._spool.seek(0)
+            write_raw_member(self._zout, zinfo, self._spool)
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+            self._spool.close()
+            super().close()
+
+
+def open_member(zout: zipfile.ZipFile, zinfo: zipfile.ZipInfo, options: Optional[DeflateOptions] = None):
+    """
+    Binary file object writing one member of zout; compressed per options
+    (zipfile's own deflate when None). Close it (or use it as a context
+    manager) before writing the next member.
+    """
+    if options is None:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        return zout.open(zinfo, "w")
+    return _MemberWriter(zout, zinfo, options)
+
+
+def repack_zip(src_path: str, dst_path: str, options: Optional[DeflateOptions] = None) -> str:
+    """
+    Copy every member of the zip src_path to dst_path, in order and with the
+    same names, timestamps and attributes, compressed per options (see
+    open_member). Returns dst_path.
+    """
+    with zipfile.ZipFile(src_path, "r") as zin, zipfile.ZipFile(dst_path, "w", allowZip64=True) as zout:
+        for info in zin.infolist():
+            zinfo = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+            zinfo.external_attr = info.external_attr
+            zinfo.create_system = info.create_system
+            with zin.open(info) as src, open_member(zout, zinfo, options) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+    return dst_path
+
+
+@lru_cache(maxsize=None)
+def _deflate_workbook_class() -> type:
+    """Workbook subclass that repacks its saved file per DeflateOptions (built on first use; xlsxwriter is optional)."""
+    import xlsxwriter
+
+    class DeflateWorkbook(xlsxwriter.Workbook):
+        """
+        XlsxWriter saves the workbook to a temporary file next to filename;
+        close() then repacks its members into filename with repack_zip.
+        Only public XlsxWriter API is used, at the cost of inflating
+        XlsxWriter's own deflate output once.
+        """
+
+        def __init__(self, filename: str, options: Optional[Dict[str, Any]] = None,
+                     deflate_options: Optional[DeflateOptions] = None):
+            fd, spool_path = tempfile.mkstemp(prefix=".ptd_workbook_", suffix=".xlsx",
+                                              dir=os.path.dirname(os.path.abspath(filename)))
+            os.close(fd)
+            super().__init__(spool_path, options)
+            self.target_filename = filename
+            self.deflate_options = deflate_options or DeflateOptions()
+
+        def close(self) -> None:
+            if self.fileclosed:
+                return super().close()
+            try:
+                super().close()
+                repack_zip(self.filename, self.target_filename, self.deflate_options)
+            finally:
+                os.remove(self.filename)
+
+    return DeflateWorkbook
+
+
+def open_xlsxwriter_workbook(filename: str, options: Optional[Dict[str, Any]] = None,
+                             deflate_options: Optional[DeflateOptions] = None):
+    """
+    XlsxWriter workbook for filename whose parts are zipped per
+    deflate_options on close (XlsxWriter's own zipfile deflate when None;
+    see DeflateWorkbook).
+    """
+    if deflate_options is None:
+        import xlsxwriter
+        return xlsxwriter.Workbook(filename, options)
+    return _deflate_workbook_class()(filename, options, deflate_options=deflate_options)
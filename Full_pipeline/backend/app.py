@@ -7,13 +7,14 @@ Mirrors the old integration while using updated backend modules in this folder.
 import os
 import sys
 import json
+import html
 import tempfile
 import logging
 import traceback
 from pathlib import Path
 from typing import Optional
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 
@@ -22,6 +23,11 @@ CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 if CURRENT_DIR not in sys.path:
     sys.path.append(CURRENT_DIR)
 
+# PTD generator package (imported in-process for the preview endpoint)
+PTD_GEN_DIR = os.path.join(CURRENT_DIR, "PTD_Gen")
+if PTD_GEN_DIR not in sys.path:
+    sys.path.append(PTD_GEN_DIR)
+
 # Optional helpers (present in project root)
 try:
     from doc_to_pdf import convert_doc_to_pdf  # noqa: F401
@@ -44,6 +50,10 @@ CORS(app)  # Enable CORS for all routes
 UPLOAD_FOLDER = os.path.join(CURRENT_DIR, "uploads")
 OUTPUT_FOLDER = os.path.join(CURRENT_DIR, "output")
 ALLOWED_EXTENSIONS = {"pdf", "doc", "docx", "json"}
+PREVIEW_SHEETS = ("schedule_grid", "study_specific_forms")
+PREVIEW_FORMATS = ("json", "html")
+PREVIEW_DEFAULT_PAGE_SIZE = 200
+PREVIEW_MAX_PAGE_SIZE = 5000
 
 # Ensure directories exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -77,6 +87,7 @@ def home():
                 "/health",
                 "/run_pipeline",
                 "/run_ptd_generation",
+                "/preview",
                 "/download/<filename>",
             ],
         }
@@ -92,6 +103,7 @@ def get_status():
             "version": "1.0.0",
             "endpoints": {
                 "run_pipeline": "/run_pipeline",
+                "preview": "/preview",
                 "status": "/status",
                 "health": "/health",
             },
@@ -300,6 +312,123 @@ def run_ptd_generation():
         return jsonify({"success": False, "error": f"PTD generation failed: {e}"}), 500
 
 
+@app.route("/preview", methods=["POST"])
+def preview():
+    """
+    Run the PTD pipeline up to the layout stage and return the Schedule Grid and
+    Study Specific Forms rows without building a workbook.
+    Expects structured JSON payload with keys: protocol_json, ecrf_json.
+    Query parameters:
+        sheet: schedule_grid | study_specific_forms (default: both)
+        page, page_size: 1-based paging applied to each returned sheet's rows
+        format: json (default) | html
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        if "protocol_json" not in data or "ecrf_json" not in data:
+            return jsonify({"success": False, "error": "Protocol and eCRF JSON data are required"}), 400
+
+        sheet = request.args.get("sheet")
+        if sheet and sheet not in PREVIEW_SHEETS:
+            return jsonify({"success": False, "error": f"Unknown sheet '{sheet}'. Use one of: {', '.join(PREVIEW_SHEETS)}"}), 400
+        try:
+            page = max(1, int(request.args.get("page", 1)))
+            page_size = int(request.args.get("page_size", PREVIEW_DEFAULT_PAGE_SIZE))
+        except ValueError:
+            return jsonify({"success": False, "error": "page and page_size must be integers"}), 400
+        page_size = max(1, min(PREVIEW_MAX_PAGE_SIZE, page_size))
+        output_format = request.args.get("format", "json").lower()
+        if output_format not in PREVIEW_FORMATS:
+            return jsonify({"success": False, "error": f"Unknown format '{output_format}'. Use one of: {', '.join(PREVIEW_FORMATS)}"}), 400
+
+        from generate_ptd import build_ptd_preview
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            protocol_file = os.path.join(temp_dir, "protocol_structured.json")
+            ecrf_file = os.path.join(temp_dir, "ecrf_structured.json")
+            with open(protocol_file, "w", encoding="utf-8") as f:
+                json.dump(data["protocol_json"], f)
+            with open(ecrf_file, "w", encoding="utf-8") as f:
+                json.dump(data["ecrf_json"], f)
+            result = build_ptd_preview(protocol_file, ecrf_file)
+
+        start = (page - 1) * page_size
+        end = start + page_size
+        sheets = {}
+        for name in (sheet,) if sheet else PREVIEW_SHEETS:
+            content = dict(result[name])
+            total_rows = len(content["rows"])
+            content["rows"] = content["rows"][start:end]
+            content["total_rows"] = total_rows
+            content["total_pages"] = max(1, -(-total_rows // page_size))
+            content["first_row"] = start
+            sheets[name] = content
+
+        if output_format == "html":
+            return Response(_render_preview_html(sheets), mimetype="text/html")
+
+        return jsonify(
+            {
+                "success": True,
+                "page": page,
+                "page_size": page_size,
+                "sheets": sheets,
+            }
+        )
+    except Exception as e:
+        logger.error(f"Preview error: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({"success": False, "error": f"Preview failed: {e}"}), 500
+
+
+def _render_preview_html(sheets: dict) -> str:
+    """Render paged preview rows as plain HTML tables (no styling beyond borders)."""
+
+    def cell_text(value) -> str:
+        return "" if value is None else html.escape(str(value)).replace("\n", "<br>")
+
+    parts = [
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>PTD Preview</title>",
+        "<style>table{border-collapse:collapse;margin-bottom:2em;font:12px sans-serif}"
+        "td,th{border:1px solid #999;padding:2px 4px;vertical-align:top}"
+        "th{background:#D9E1F2}</style></head><body>",
+    ]
+
+    grid = sheets.get("schedule_grid")
+    if grid is not None:
+        parts.append(f"<h2>Schedule Grid</h2><p>Rows {grid['first_row'] + 1}-{grid['first_row'] + len(grid['rows'])} of {grid['total_rows']}</p><table>")
+        # Single-row merges become colspans when the row is on this page
+        spans = {(r1, c1): c2 - c1 + 1 for r1, c1, r2, c2 in grid["merges"] if r1 == r2}
+        covered = {(r1, c) for r1, c1, r2, c2 in grid["merges"] if r1 == r2 for c in range(c1 + 1, c2 + 1)}
+        for offset, row in enumerate(grid["rows"]):
+            r = grid["first_row"] + offset
+            parts.append("<tr>")
+            for c, value in enumerate(row):
+                if (r, c) in covered:
+                    continue
+                colspan = spans.get((r, c))
+                attr = f' colspan="{colspan}"' if colspan else ""
+                parts.append(f"<td{attr}>{cell_text(value)}</td>")
+            parts.append("</tr>")
+        parts.append("</table>")
+
+    forms = sheets.get("study_specific_forms")
+    if forms is not None:
+        parts.append(f"<h2>Study Specific Forms</h2><p>Rows {forms['first_row'] + 1}-{forms['first_row'] + len(forms['rows'])} of {forms['total_rows']}</p><table><tr>")
+        for name, span in forms["groups"]:
+            parts.append(f'<th colspan="{span}">{cell_text(name)}</th>')
+        parts.append("</tr><tr>")
+        for header in forms["columns"]:
+            parts.append(f"<th>{cell_text(header)}</th>")
+        parts.append("</tr>")
+        for row in forms["rows"]:
+            parts.append("<tr>" + "".join(f"<td>{cell_text(v)}</td>" for v in row) + "</tr>")
+        parts.append("</table>")
+
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
 @app.route("/download/<path:filename>") 
 def download_file(filename: str):
     try: